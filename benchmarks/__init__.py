@@ -0,0 +1,12 @@
+"""Benchmarks for Norc internals.
+
+Each module is a script that should be run with the Norc environment
+set up, e.g.:
+
+    $ python -m norc.benchmarks.queue_contention --help
+
+Benchmarks that touch the database create their own objects and remove
+them afterwards, but they should still never be pointed at a database
+that a live Norc system is using.
+
+"""
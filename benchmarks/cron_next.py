@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""Micro-benchmark for computing CronSchedule fire times.
+
+Compares the compiled evaluator CronSchedule now uses with the one it
+replaced, which re-validated the encoding when each schedule was loaded
+and then scanned the allowed values of each field, and the calendar day
+by day.  Two cases are timed for each encoding: loading a schedule and
+computing its next fire time, as the Scheduler does for every schedule
+it claims, and computing the next N fire times of one schedule.
+
+"""
+
+import sys
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from norc.core.models import CronSchedule
+
+ENCODINGS = [
+    'o*d*w*h*m*s*',
+    'o*d*w*h*m0,30s0',
+    'o*d*w*h3m15s0',
+    'o*d*w0,2,4h9,17m0s0',
+    'o*d1,15w*h0m0s0',
+    'o2d29w*h0m0s0',
+]
+
+def legacy_next(lists, dt):
+    """CronSchedule.calculate_next() as it used to be."""
+    months, days, daysofweek, hours, minutes, seconds = lists
+    def find_gte(p, ls):
+        for e in ls:
+            if e >= p:
+                return e
+    dt = dt.replace(microsecond=0)
+    dt += timedelta(seconds=1)
+    second = find_gte(dt.second, seconds)
+    if second == None:
+        second = seconds[0]
+        dt += timedelta(minutes=1)
+    dt = dt.replace(second=second)
+    minute = find_gte(dt.minute, minutes)
+    if minute == None:
+        minute = minutes[0]
+        dt += timedelta(hours=1)
+    dt = dt.replace(minute=minute)
+    hour = find_gte(dt.hour, hours)
+    if hour == None:
+        hour = hours[0]
+        dt += timedelta(days=1)
+    dt = dt.replace(hour=hour)
+    cond = lambda d: d.day in days and d.weekday() in daysofweek
+    one_day = timedelta(days=1)
+    while not cond(dt):
+        dt += one_day
+    return dt
+
+def legacy_load(encoding):
+    """What loading a schedule used to cost before its first next."""
+    d = CronSchedule.validate(encoding)[1]
+    return [d[k] for k in 'odwhms']
+
+def rate(f, n):
+    """Calls f n times, returning the calls per second."""
+    start = time.time()
+    for _ in xrange(n):
+        f()
+    elapsed = time.time() - start
+    return n / elapsed if elapsed else 0
+
+def main():
+    usage = "python -m norc.benchmarks.cron_next [-n <loads>] [-f <fires>]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", type="int", default=20000,
+        help="How many schedule loads to time per encoding.")
+    parser.add_option("-f", "--fires", type="int", default=1000,
+        help="How many consecutive fire times to compute per encoding.")
+    
+    (options, args) = parser.parse_args()
+    base = datetime(2011, 1, 1, 12, 34, 56)
+    
+    print '%-22s %12s %12s %8s %12s %12s %8s' % ('Encoding',
+        'Old loads/s', 'New loads/s', 'Speedup',
+        'Old fires/s', 'New fires/s', 'Speedup')
+    for encoding in ENCODINGS:
+        old_load = rate(lambda: legacy_next(legacy_load(encoding), base),
+            options.number)
+        new_load = rate(lambda: CronSchedule.compile(encoding)
+            .next_after(base), options.number)
+        lists = legacy_load(encoding)
+        def old_fires():
+            dt = base
+            for _ in xrange(options.fires):
+                dt = legacy_next(lists, dt)
+        compiled = CronSchedule.compile(encoding)
+        new_fires = lambda: compiled.next_fires(base, options.fires)
+        old_fire = rate(old_fires, 1) * options.fires
+        new_fire = rate(new_fires, 1) * options.fires
+        print '%-22s %12.0f %12.0f %7.1fx %12.0f %12.0f %7.1fx' % (
+            encoding, old_load, new_load, new_load / old_load,
+            old_fire, new_fire, new_fire / old_fire)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
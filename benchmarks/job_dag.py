@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""Query count benchmark for running the nodes of a Job.
+
+Builds a fan-out/fan-in job (one node, then N nodes depending on it, then
+one node depending on all of those, for 2N edges), starts its nodes and
+completes every node as soon as it is enqueued, counting the queries
+made along the way and those made just to start the nodes.  Nodes are
+completed in this process rather than run by Executors, so only the
+cost of moving the job along is measured.
+
+With --legacy, the old approach is measured as well: each child of a
+finished node checked every one of its parents with its own query, so
+the fan-in alone cost N^2 queries.  (The old Job.run() also polled every
+node's status each second while it waited, which isn't counted here.)
+
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from django.conf import settings
+from django.db import connection, reset_queries
+
+from norc.core.models import (Job, JobNode, JobNodeInstance, Dependency,
+    Instance, Schedule, DBQueue, CommandTask)
+from norc.core.constants import Status
+from norc.norc_utils.django_extras import bulk_insert
+
+def make_job(name, n, task):
+    """Creates a fan-out/fan-in job with n nodes in the middle."""
+    job = Job.objects.create(name=name)
+    source = JobNode.objects.create(job=job, task=task)
+    middle = bulk_insert([JobNode(job=job, task=task) for _ in xrange(n)])
+    sink = JobNode.objects.create(job=job, task=task)
+    bulk_insert([Dependency(parent=source, child=m) for m in middle] +
+        [Dependency(parent=m, child=sink) for m in middle])
+    return job
+
+def legacy_start(job, instance, queue):
+    """Job.run() as it used to start nodes, without the waiting."""
+    for node in job.nodes.all():
+        ni = JobNodeInstance.objects.create(node=node, job_instance=instance)
+        if legacy_can_run(ni):
+            queue.push(ni)
+
+def legacy_can_run(ni):
+    for dep in ni.node.super_deps.all():
+        parent = dep.parent.nis.get(job_instance=ni.job_instance)
+        if parent.status != Status.SUCCESS:
+            return False
+    return True
+
+def legacy_completed(ni, queue):
+    """What JobNodeInstance.start() used to do after running."""
+    for sub_dep in ni.node.sub_deps.all():
+        child = sub_dep.child.nis.get(job_instance=ni.job_instance)
+        if legacy_can_run(child):
+            queue.push(child)
+
+def run(job, queue, legacy):
+    """Runs a job's nodes; returns (start queries, queries, seconds)."""
+    schedule = Schedule.objects.create(task=job, queue=queue, period=0,
+        repetitions=1, remaining=0, deleted=True)
+    instance = Instance.objects.create(task=job, schedule=schedule)
+    reset_queries()
+    start = time.time()
+    if legacy:
+        legacy_start(job, instance, queue)
+    else:
+        job.start_nodes(instance)
+    started = len(connection.queries)
+    while True:
+        nis = queue.pop_many(1000)
+        if not nis:
+            break
+        for ni in nis:
+            ni.status = Status.SUCCESS
+            ni.save()
+            if legacy:
+                legacy_completed(ni, queue)
+            else:
+                ni.completed()
+            queue.ack(nis)
+    if not legacy:
+        assert job.wait_for_nodes(instance)
+    elapsed = time.time() - start
+    queries = len(connection.queries)
+    instance.nodis.all().delete()
+    instance.delete()
+    schedule.delete()
+    return started, queries, elapsed
+
+def main():
+    usage = "python -m norc.benchmarks.job_dag [-n 10,100,1000] [--legacy]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", default="10,100,1000",
+        help="Comma separated numbers of nodes to fan out to.")
+    parser.add_option("--legacy", action="store_true", default=False,
+        help="Also measure the old approach (quadratic; keep n small).")
+    
+    (options, args) = parser.parse_args()
+    settings.DEBUG = True
+    
+    queue = DBQueue.objects.create(name='norc_bench_job_dag')
+    task = CommandTask.objects.create(name='norc_bench_job_dag',
+        command='true')
+    try:
+        print '%-8s %7s %7s %7s %9s %9s %9s' % ('Engine', 'Nodes',
+            'Edges', 'Start', 'Queries', 'Per edge', 'Time (s)')
+        for n in map(int, options.number.split(',')):
+            job = Job.objects.get(
+                pk=make_job('norc_bench_job_dag_%s' % n, n, task).pk)
+            engines = [('dag', False)]
+            if options.legacy:
+                engines.append(('legacy', True))
+            for name, legacy in engines:
+                started, queries, elapsed = run(job, queue, legacy)
+                print '%-8s %7d %7d %7d %9d %9.2f %9.2f' % (name, n + 2,
+                    2 * n, started, queries, queries / (2.0 * n), elapsed)
+                sys.stdout.flush()
+            Dependency.objects.filter(parent__job=job).delete()
+            job.nodes.all().delete()
+            job.delete()
+    finally:
+        queue.items.all().delete()
+        queue.delete()
+        task.delete()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+"""Makespan simulator for the order in which a Job's ready nodes run.
+
+Random jobs are generated and run on a simulated pool of Executor slots
+that pop from one shared queue.  Each node takes its expected duration,
+varied by up to --noise either way, the way a node's past durations
+only approximate its next one.  Every job is run three ways:
+
+arbitrary   Ready nodes are enqueued in the order the nodes were loaded
+            and popped first in, first out, as Job.run() used to do.
+ordered     Ready nodes are enqueued highest critical path first, using
+            JobGraph.priorities() on the expected durations, as
+            start_nodes() and completed() now do, but still popped first
+            in, first out, as from a queue that ignores priorities.
+priority    Nodes are popped highest priority first, as from a DBQueue.
+
+Makespans are reported relative to a lower bound no ordering can beat:
+the longer of the job's critical path and its total work divided among
+the slots.  Two shapes of job are generated: "layered" jobs of random
+dependencies between consecutive layers, and "chains" jobs where a few
+long chains compete with many short, independent nodes.
+
+"""
+
+import sys
+import heapq
+import random
+from collections import deque
+from optparse import OptionParser
+
+from norc.core.models.job import JobGraph, JobNode
+
+def layered(n, rand):
+    """A job of n nodes in layers, each depending on earlier ones."""
+    width = max(1, int(n ** 0.5))
+    durations = [rand.expovariate(1 / 10.0) for _ in xrange(n)]
+    edges = []
+    for child in xrange(width, n):
+        layer = child // width
+        for parent in rand.sample(xrange((layer - 1) * width,
+                layer * width), min(width, 2)):
+            edges.append((parent, child))
+    return durations, edges
+
+def chains(n, rand):
+    """A job of a few long chains hidden among many short nodes."""
+    length = max(2, n // 10)
+    count = 2
+    durations = [rand.uniform(5, 15) for _ in xrange(n)]
+    edges = []
+    for c in xrange(count):
+        start = c * length
+        edges.extend([(i, i + 1) for i in xrange(start, start + length - 1)])
+    return durations, edges
+
+SHAPES = dict(layered=layered, chains=chains)
+
+def simulate(durations, edges, actual, slots, key, heap):
+    """Runs a job on slots Executor slots, returning its makespan.
+    
+    key gives each node's place in line; with heap, the lowest key is
+    always popped next, otherwise nodes wait in the order enqueued, each
+    batch of ready nodes sorted by key.
+    
+    """
+    n = len(durations)
+    children = [[] for _ in xrange(n)]
+    pending = [0] * n
+    for parent, child in edges:
+        children[parent].append(child)
+        pending[child] += 1
+    if heap:
+        queue = []
+    else:
+        queue = deque()
+    def push(ready):
+        for node in sorted(ready, key=key):
+            if heap:
+                heapq.heappush(queue, (key(node), node))
+            else:
+                queue.append(node)
+    push([i for i in xrange(n) if not pending[i]])
+    running = []
+    clock = 0.0
+    while queue or running:
+        while queue and len(running) < slots:
+            if heap:
+                node = heapq.heappop(queue)[1]
+            else:
+                node = queue.popleft()
+            heapq.heappush(running, (clock + actual[node], node))
+        clock, node = heapq.heappop(running)
+        ready = []
+        for child in children[node]:
+            pending[child] -= 1
+            if not pending[child]:
+                ready.append(child)
+        push(ready)
+    return clock
+
+def trial(shape, n, slots, noise, rand):
+    """Runs one random job every way, returning makespans and a bound."""
+    durations, edges = SHAPES[shape](n, rand)
+    # Shuffle the node ids, since loading order says nothing about them.
+    ids = range(n)
+    rand.shuffle(ids)
+    shuffled = [0] * n
+    for i, d in enumerate(durations):
+        shuffled[ids[i]] = d
+    durations = shuffled
+    edges = [(ids[p], ids[c]) for p, c in edges]
+    actual = [d * rand.uniform(1 - noise, 1 + noise) for d in durations]
+    graph = JobGraph([JobNode(id=i) for i in xrange(n)], edges)
+    priorities = graph.priorities(dict(enumerate(durations)))
+    bound = max(max(graph.priorities(dict(enumerate(actual))).values()),
+        sum(actual) / slots)
+    by_priority = lambda i: (-priorities[i], i)
+    return [simulate(durations, edges, actual, slots, lambda i: i, False),
+        simulate(durations, edges, actual, slots, by_priority, False),
+        simulate(durations, edges, actual, slots, by_priority, True)], bound
+
+def main():
+    usage = "python -m norc.benchmarks.job_priority [-n 100,1000] " + \
+        "[-w 4,16] [-t <trials>]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", default="100,1000",
+        help="Comma separated numbers of nodes per job.")
+    parser.add_option("-w", "--slots", default="4,16",
+        help="Comma separated numbers of Executor slots.")
+    parser.add_option("-t", "--trials", type="int", default=20,
+        help="How many random jobs to average over.")
+    parser.add_option("--noise", type="float", default=0.3,
+        help="How far actual durations stray from expected ones.")
+    parser.add_option("--seed", type="int", default=0)
+    
+    (options, args) = parser.parse_args()
+    
+    print '%-8s %6s %6s %10s %10s %10s %9s' % ('Shape', 'Nodes', 'Slots',
+        'Arbitrary', 'Ordered', 'Priority', 'Speedup')
+    for shape in sorted(SHAPES):
+        for n in map(int, options.number.split(',')):
+            for slots in map(int, options.slots.split(',')):
+                rand = random.Random(options.seed)
+                totals = [0.0] * 3
+                for _ in xrange(options.trials):
+                    makespans, bound = trial(shape, n, slots,
+                        options.noise, rand)
+                    for i, m in enumerate(makespans):
+                        totals[i] += m / bound / options.trials
+                print '%-8s %6d %6d %10.2f %10.2f %10.2f %8.2fx' % (shape,
+                    n, slots, totals[0], totals[1], totals[2],
+                    totals[0] / totals[2])
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Latency and throughput benchmark for LocalQueue against DBQueue.
+
+Each queue is timed pushing and popping N instances one at a time, then
+pushing them all with push_many() and popping them --batch at a time.
+Finally, LocalQueue's dispatch latency is measured: a thread pushes one
+instance at a time while this one waits in a blocking pop, and the time
+from each push to its pop is reported.  (A DBQueue can't wait for a
+push, so its latency is however often its Executors poll.)  Pops
+include loading the instances from the database.  Needs norc.localq in
+INSTALLED_APPS.
+
+"""
+
+import sys
+import time
+from threading import Thread
+from optparse import OptionParser
+
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import DBQueue, CommandTask, Instance
+from norc.localq.models import LocalQueue
+from norc.norc_utils.django_extras import bulk_insert
+
+def single(queue, instances):
+    """Microseconds per push and per pop, one item at a time."""
+    start = time.time()
+    for i in instances:
+        queue.push(i)
+    pushed = time.time()
+    for _ in instances:
+        queue.ack([queue.pop()])
+    popped = time.time()
+    n = len(instances)
+    return (pushed - start) / n * 1e6, (popped - pushed) / n * 1e6
+
+def batched(queue, instances, batch):
+    """Items pushed and popped per second, in batches."""
+    start = time.time()
+    queue.push_many(instances)
+    pushed = time.time()
+    popped = 0
+    while popped < len(instances):
+        items = queue.pop_many(batch)
+        queue.ack(items)
+        popped += len(items)
+    end = time.time()
+    return len(instances) / (pushed - start), popped / (end - pushed)
+
+def latency(queue, instance, rounds):
+    """Sorted seconds from each push to the blocking pop that gets it."""
+    ContentType.objects.get_for_model(instance)
+    times = []
+    def pusher():
+        for _ in xrange(rounds):
+            time.sleep(0.01)
+            times.append(time.time())
+            queue.push(instance)
+    t = Thread(target=pusher)
+    t.start()
+    delays = []
+    while len(delays) < rounds:
+        if queue.pop_many(1):
+            delays.append(time.time() - times[len(delays)])
+    t.join()
+    return sorted(delays)
+
+def main():
+    usage = "python -m norc.benchmarks.local_queue [-n 10000] [-b 100]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", type="int", default=10000,
+        help="How many instances to push and pop.")
+    parser.add_option("-b", "--batch", type="int", default=100,
+        help="How many items each batched pop asks for.")
+    parser.add_option("-r", "--rounds", type="int", default=200,
+        help="How many pushes to time the dispatch of.")
+    
+    (options, args) = parser.parse_args()
+    
+    task = CommandTask.objects.create(name='norc_bench_local_queue',
+        command='true')
+    queues = [DBQueue.objects.create(name='norc_bench_local_queue_db'),
+        LocalQueue.objects.create(name='norc_bench_local_queue',
+            capacity=max(options.number, 1024))]
+    try:
+        instances = bulk_insert([Instance(task=task)
+            for _ in xrange(options.number)])
+        print '%-12s %7s %10s %10s %12s %12s' % ('Queue', 'Items',
+            'Push (us)', 'Pop (us)', 'Pushes/sec', 'Pops/sec')
+        for q in queues:
+            push, pop = single(q, instances)
+            pushes, pops = batched(q, instances, options.batch)
+            print '%-12s %7d %10.1f %10.1f %12.1f %12.1f' % (
+                type(q).__name__, options.number, push, pop, pushes, pops)
+            sys.stdout.flush()
+        delays = latency(queues[1], instances[0], options.rounds)
+        print
+        print 'LocalQueue dispatch latency over %d pushes (ms): ' \
+            'median %.3f, p99 %.3f, max %.3f' % (options.rounds,
+            delays[len(delays) // 2] * 1000,
+            delays[int(len(delays) * 0.99)] * 1000, delays[-1] * 1000)
+    finally:
+        for q in queues:
+            if isinstance(q, DBQueue):
+                q.items.all().delete()
+            q.delete()
+        task.instances.all().delete()
+        task.delete()
+
+if __name__ == '__main__':
+    main()
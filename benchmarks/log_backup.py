@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""Memory and throughput benchmark for S3 log backups.
+
+Writes a log of --size megabytes and backs it up the old way, reading it
+whole and compressing it at level 9 in one go before a single PUT, and
+then the streaming way, through backup.s3_backup().  Each runs in a
+forked child so that its peak RSS can be reported on its own.  Needs
+BACKUP_SYSTEM = 'AmazonS3'; point BACKUP_HOST at a local stand-in such
+as moto_server to keep network time out of it.
+
+"""
+
+import os
+import sys
+import time
+import zlib
+import random
+import tempfile
+from optparse import OptionParser
+
+from boto.s3.key import Key
+
+from norc.norc_utils import aws, backup
+
+KEY = 'norc_logs/norc_bench_log_backup'
+
+def write_log(path, size):
+    """Writes roughly size bytes of log-like lines to path."""
+    f = open(path, 'w')
+    words = ['Processed', 'record', 'of', 'the', 'nightly', 'batch', 'in',
+        'ms', 'rows', 'retrying', 'connection', 'ok']
+    written = 0
+    while written < size:
+        line = '[2010/07/01 12:00:%02d.%06d] INFO: %s %d\n' % (
+            random.randrange(60), random.randrange(1000000),
+            ' '.join(random.sample(words, 6)), random.randrange(100000))
+        f.write(line)
+        written += len(line)
+    f.close()
+
+def legacy_backup(path):
+    k = Key(aws.get_s3_bucket())
+    k.key = KEY
+    k.set_contents_from_string(zlib.compress(open(path, 'rb').read(), 9))
+
+def streaming_backup(path):
+    f = open(path, 'rb')
+    try:
+        backup.s3_backup(f, KEY)
+    finally:
+        f.close()
+
+def measure(backup_func, path):
+    """Seconds taken and peak RSS in MB of backing up in a child."""
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            backup_func(path)
+            code = 0
+        finally:
+            os._exit(code)
+    start = time.time()
+    _, status, usage = os.wait4(pid, 0)
+    assert status == 0, "The backup failed."
+    maxrss = usage.ru_maxrss / 1024.0
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return time.time() - start, maxrss
+
+def main():
+    usage = "python -m norc.benchmarks.log_backup [-s 256]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-s", "--size", type="int", default=256,
+        help="Megabytes of log to back up.")
+    
+    (options, args) = parser.parse_args()
+    
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        write_log(path, options.size * 1024 * 1024)
+        print '%-10s %9s %10s %9s %14s' % ('Backup', 'Log (MB)',
+            'Stored (MB)', 'MB/sec', 'Peak RSS (MB)')
+        for name, func in [('legacy', legacy_backup),
+                ('streaming', streaming_backup)]:
+            seconds, maxrss = measure(func, path)
+            stored = aws.get_s3_bucket().get_key(KEY).size / 1024.0 ** 2
+            print '%-10s %9d %10.1f %9.1f %14.1f' % (name, options.size,
+                stored, options.size / seconds, maxrss)
+            sys.stdout.flush()
+    finally:
+        os.remove(path)
+        aws.get_s3_bucket().delete_key(KEY)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+"""Throughput and CPU benchmark for instance and daemon logging.
+
+Writes N lines to a fresh log file in each mode, through Log.info()
+and by printing the way task output is logged, either through a LogHook
+(LOG_CAPTURE = 'hook') or to stdout pointed at the log file ('fd'), and
+reports lines per second and the CPU time (user plus system) spent per
+line.  The modes are:
+
+  legacy      Every line formatted from scratch and written and flushed
+              on its own, as logs were before buffering.
+  unbuffered  LOG_BUFFER_SIZE = 0: written and flushed per line, but
+              with timestamps cached to the second.
+  buffered    Written out --buffer bytes at a time.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import datetime
+import resource
+import tempfile
+from optparse import OptionParser
+
+from norc.norc_utils import log
+
+def legacy_timestamp():
+    """The timestamp as it was formatted before caching."""
+    now = datetime.datetime.utcnow()
+    return now.strftime('%Y/%m/%d %H:%M:%S') + '.%06d' % now.microsecond
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def run(path, n, buffer_size, via):
+    """Logs n lines; returns lines/sec and microseconds of CPU per line."""
+    l = log.Log(path, buffer_size=buffer_size)
+    line = 'Processed record %d of the nightly batch.'
+    start, start_cpu = time.time(), cpu()
+    if via != 'info()':
+        if via == 'fd':
+            l.start_capture()
+        else:
+            l.start_redirect()
+        try:
+            for i in xrange(n):
+                print line % i
+        finally:
+            l.stop_redirect()
+    else:
+        for i in xrange(n):
+            l.info(line % i)
+    l.close()
+    end, end_cpu = time.time(), cpu()
+    return n / (end - start), (end_cpu - start_cpu) / n * 1e6
+
+def main():
+    usage = "python -m norc.benchmarks.log_lines [-n 1000000] [-b 65536]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", type="int", default=1000000,
+        help="How many lines to log in each mode.")
+    parser.add_option("-b", "--buffer", type="int", default=65536,
+        help="How many bytes the buffered mode holds.")
+    
+    (options, args) = parser.parse_args()
+    
+    directory = tempfile.mkdtemp()
+    modes = [('legacy', 0, legacy_timestamp), ('unbuffered', 0, None),
+        ('buffered', options.buffer, None)]
+    cached_timestamp = log.timestamp
+    try:
+        print '%-12s %-8s %9s %12s %14s' % ('Mode', 'Via', 'Lines',
+            'Lines/sec', 'CPU/line (us)')
+        for name, buffer_size, timestamp in modes:
+            log.timestamp = timestamp or cached_timestamp
+            for via in ['info()', 'hook', 'fd']:
+                path = os.path.join(directory, '%s.log' % name)
+                rate, per_line = run(path, options.number, buffer_size, via)
+                os.remove(path)
+                print '%-12s %-8s %9d %12.1f %14.2f' % (name, via,
+                    options.number, rate, per_line)
+                sys.stdout.flush()
+    finally:
+        log.timestamp = cached_timestamp
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""Multi-process contention benchmark for DBQueue.pop().
+
+Fills a DBQueue, forks a number of processes that all pop from it until
+it runs dry, and then reports throughput along with how many items were
+delivered more than once (or never).  Items are acked as soon as
+they're popped, so the rate includes removing them.  This needs a real
+database server; the in-memory sqlite database used by the unit tests
+won't work.
+
+"""
+
+import os
+import sys
+import time
+import tempfile
+from optparse import OptionParser
+
+from django.db import connection
+
+from norc import settings
+from norc.core.models import DBQueue, CommandTask, Instance
+
+MODES = ['legacy', 'update', 'skip_locked']
+
+def legacy_pop(queue):
+    """DBQueue.pop() as it used to be: read the head, then delete it."""
+    try:
+        next = queue.items.all()[0]
+    except IndexError:
+        return None
+    next.delete()
+    return next.item
+
+def popper(queue_id, mode, path):
+    """Pops from the queue until it's empty, recording each item's pk."""
+    # The child must not share the parent's database connection.
+    connection.close()
+    if mode != 'legacy':
+        settings.DBQUEUE_POP_MODE = mode
+    queue = DBQueue.objects.get(pk=queue_id)
+    out = open(path, 'w')
+    try:
+        while True:
+            if mode == 'legacy':
+                item = legacy_pop(queue)
+            else:
+                item = queue.pop()
+            if item == None:
+                break
+            if mode != 'legacy':
+                queue.ack([item])
+            out.write('%s\n' % item.pk)
+    finally:
+        out.close()
+
+def run(queue, task, mode, processes, count):
+    """Runs one round of the benchmark and returns a dict of results."""
+    for _ in xrange(count):
+        queue.push(Instance.objects.create(task=task))
+    connection.close()
+    paths = []
+    pids = []
+    start = time.time()
+    for _ in range(processes):
+        fd, path = tempfile.mkstemp(prefix='norc_bench_',
+            dir=settings.NORC_TMP_DIR)
+        os.close(fd)
+        paths.append(path)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                try:
+                    popper(queue.pk, mode, path)
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    code = 1
+            finally:
+                os._exit(code)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    elapsed = time.time() - start
+    popped = []
+    for path in paths:
+        f = open(path)
+        popped.extend([int(l) for l in f if l.strip()])
+        f.close()
+        os.remove(path)
+    unique = len(set(popped))
+    return dict(mode=mode, processes=processes, items=count,
+        popped=len(popped), duplicates=len(popped) - unique,
+        missing=count - unique, elapsed=elapsed,
+        rate=len(popped) / elapsed if elapsed else 0)
+
+def main():
+    usage = "python -m norc.benchmarks.queue_contention " + \
+        "[-p 1,2,4,8,12] [-n <items>] [-m legacy,update,skip_locked]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-p", "--processes", default="1,2,4,8,12",
+        help="Comma separated numbers of popping processes to try.")
+    parser.add_option("-n", "--number", type="int", default=2000,
+        help="How many items to enqueue for each round.")
+    parser.add_option("-m", "--modes", default="legacy,update",
+        help="Comma separated pop modes to compare (%s)." % ', '.join(MODES))
+    
+    (options, args) = parser.parse_args()
+    modes = options.modes.split(',')
+    for m in modes:
+        if not m in MODES:
+            print "Invalid mode '%s'." % m
+            print usage
+            sys.exit(2)
+    
+    name = 'norc_bench_%s' % os.getpid()
+    queue = DBQueue.objects.create(name=name)
+    task = CommandTask.objects.create(name=name, command='true')
+    try:
+        print '%-12s %5s %7s %7s %6s %7s %9s' % ('Mode', 'Procs',
+            'Items', 'Popped', 'Dupes', 'Missing', 'Pops/sec')
+        for mode in modes:
+            for p in map(int, options.processes.split(',')):
+                r = run(queue, task, mode, p, options.number)
+                print '%(mode)-12s %(processes)5d %(items)7d ' \
+                    '%(popped)7d %(duplicates)6d %(missing)7d ' \
+                    '%(rate)9.1f' % r
+                sys.stdout.flush()
+                queue.items.all().delete()
+    finally:
+        queue.items.all().delete()
+        task.instances.all().delete()
+        task.delete()
+        queue.delete()
+
+if __name__ == '__main__':
+    main()
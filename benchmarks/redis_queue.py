@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""Throughput and latency benchmark for RedisQueue.
+
+Pushes N instances in batches, then pops them as an Executor would, up
+to --batch at a time and acking each batch, reporting pops per second;
+DBQueue is run the same way for comparison.  Then measures dispatch
+latency: a thread pushes one instance at a time while this one waits in
+a blocking pop, and the time from each push to its pop is reported.
+(A DBQueue can't wait for a push, so its latency is however often its
+Executors poll.)  Needs a Redis server at the REDIS_* settings and
+norc.redisq in INSTALLED_APPS.
+
+"""
+
+import sys
+import time
+from threading import Thread
+from optparse import OptionParser
+
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import DBQueue, CommandTask, Instance
+from norc.redisq.models import RedisQueue
+from norc.norc_utils.django_extras import bulk_insert
+
+def throughput(queue, instances, batch):
+    """Pushes and then pops all instances; returns pushes/sec, pops/sec."""
+    start = time.time()
+    for i in xrange(0, len(instances), 1000):
+        queue.push_many(instances[i:i + 1000])
+    pushed = time.time()
+    popped = 0
+    while popped < len(instances):
+        items = queue.pop_many(batch)
+        if not items:
+            break
+        queue.ack(items)
+        popped += len(items)
+    end = time.time()
+    assert popped == len(instances)
+    return len(instances) / (pushed - start), popped / (end - pushed)
+
+def latency(queue, instance, rounds):
+    """Sorted seconds from each push to the blocking pop that gets it."""
+    ContentType.objects.get_for_model(instance)
+    times = []
+    def pusher():
+        for _ in xrange(rounds):
+            time.sleep(0.01)
+            times.append(time.time())
+            queue.push(instance)
+    t = Thread(target=pusher)
+    t.start()
+    delays = []
+    while len(delays) < rounds:
+        items = queue.pop_many(1)
+        if items:
+            delays.append(time.time() - times[len(delays)])
+            queue.ack(items)
+    t.join()
+    return sorted(delays)
+
+def main():
+    usage = "python -m norc.benchmarks.redis_queue [-n 10000] [-b 100]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", type="int", default=10000,
+        help="How many instances to push and pop.")
+    parser.add_option("-b", "--batch", type="int", default=100,
+        help="How many items each pop asks for.")
+    parser.add_option("-r", "--rounds", type="int", default=200,
+        help="How many pushes to time the dispatch of.")
+    
+    (options, args) = parser.parse_args()
+    
+    task = CommandTask.objects.create(name='norc_bench_redis_queue',
+        command='true')
+    queues = [DBQueue.objects.create(name='norc_bench_redis_queue_db'),
+        RedisQueue.objects.create(name='norc_bench_redis_queue')]
+    try:
+        instances = bulk_insert([Instance(task=task)
+            for _ in xrange(options.number)])
+        print '%-12s %7s %12s %12s' % ('Queue', 'Items', 'Pushes/sec',
+            'Pops/sec')
+        for q in queues:
+            pushes, pops = throughput(q, instances, options.batch)
+            print '%-12s %7d %12.1f %12.1f' % (type(q).__name__,
+                options.number, pushes, pops)
+            sys.stdout.flush()
+        delays = latency(queues[1], instances[0], options.rounds)
+        print
+        print 'RedisQueue dispatch latency over %d pushes (ms): ' \
+            'median %.3f, p99 %.3f, max %.3f' % (options.rounds,
+            delays[len(delays) // 2] * 1000,
+            delays[int(len(delays) * 0.99)] * 1000, delays[-1] * 1000)
+    finally:
+        for q in queues:
+            if isinstance(q, DBQueue):
+                q.items.all().delete()
+            q.delete()
+        task.instances.all().delete()
+        task.delete()
+
+if __name__ == '__main__':
+    main()
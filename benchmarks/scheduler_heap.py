@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""Throughput and memory benchmark for the Scheduler's schedule heap.
+
+The default mode runs the timer core alone on a simulated clock: N
+schedules with periods between a minute and a day are put in an
+ArrayHeap, and every due entry is popped and pushed back at its next
+firing, the same way Scheduler.timer_run() and Scheduler.add() do.  This
+shows how many firings per second the core can sustain and what holding
+N schedules costs, compared to the model objects and timer tuples the
+old MultiTimer kept for each one.
+
+With --db, N real Schedules are created and then claimed and fired
+through a Scheduler, which measures the database side as well.  With -p,
+that many Scheduler processes split the schedules between them the way
+concurrent Schedulers do, and any schedule fired more than once is
+counted as a duplicate.
+
+"""
+
+import os
+import sys
+import time
+import random
+import gc
+import traceback
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from django.db import connection, transaction
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import (Scheduler, Schedule, DBQueue, CommandTask,
+    Instance)
+from norc.core.constants import Status
+from norc.core.workers import rss_mb
+from norc.norc_utils.heap import ArrayHeap
+from norc.norc_utils.log import Log
+
+PERIODS = [60, 300, 900, 3600, 6 * 3600, 86400]
+
+def legacy_bytes_per_schedule(sample=20000):
+    """Measures what the old timer held per schedule, using RSS."""
+    gc.collect()
+    before = rss_mb()
+    now = datetime.utcnow()
+    tasks = []
+    for i in xrange(sample):
+        s = Schedule(id=i, task_type_id=1, task_id=1, queue_type_id=1,
+            queue_id=1, repetitions=0, remaining=0, period=60, next=now)
+        tasks.append((time.time(), lambda: None, [s], {}))
+    used = rss_mb() - before
+    del tasks
+    gc.collect()
+    return used * 1024 * 1024 / sample
+
+def run_heap(n, seconds):
+    """Simulates a timer core with n schedules for a number of seconds."""
+    start = time.time()
+    periods = [random.choice(PERIODS) for _ in xrange(n)]
+    heap = ArrayHeap((random.random() * periods[i], 0, i)
+        for i in xrange(n))
+    build = time.time() - start
+    fired = 0
+    start = time.time()
+    clock = 0
+    while clock < seconds:
+        clock += 1
+        due = heap.pop_due(clock)
+        heap.push_many([(t + periods[pk], kind, pk) for t, kind, pk in due])
+        fired += len(due)
+    elapsed = time.time() - start
+    return dict(n=n, build=build, fired=fired, elapsed=elapsed,
+        rate=fired / elapsed if elapsed else 0,
+        heap_mb=heap.nbytes / (1024.0 * 1024), heap_bytes=heap.nbytes / n)
+
+def create_schedules(n, task, queue):
+    """Inserts n Schedules that are all due, without per-row overhead."""
+    table = connection.ops.quote_name(Schedule._meta.db_table)
+    columns = ['task_type_id', 'task_id', 'queue_type_id', 'queue_id',
+        'repetitions', 'remaining', 'make_up', 'added', 'changed',
+        'deleted', 'next', 'period']
+    task_ct = ContentType.objects.get_for_model(task).pk
+    queue_ct = ContentType.objects.get_for_model(queue).pk
+    past = datetime.utcnow() - timedelta(seconds=1)
+    row = [task_ct, task.pk, queue_ct, queue.pk, 1, 1, False, past,
+        False, False, past, 0]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, ', '.join(columns),
+        ', '.join(['%s'] * len(columns)))
+    cursor = connection.cursor()
+    for i in xrange(0, n, 10000):
+        cursor.executemany(sql, [row] * min(10000, n - i))
+    transaction.commit_unless_managed()
+
+def claim_and_fire(scheduler):
+    """Claims and fires everything in a Scheduler's partition."""
+    scheduler.log = Log(os.devnull)
+    scheduler.last_beat = time.time()
+    scheduler.claim()
+    while len(scheduler.heap):
+        scheduler.fire(scheduler.heap.pop_due(time.time(), 1000))
+
+def run_db(n, task, queue, procs):
+    """Claims and fires n due Schedules with procs Schedulers."""
+    create_schedules(n, task, queue)
+    schedulers = [Scheduler.objects.create(status=Status.RUNNING,
+        heartbeat=datetime.utcnow()) for _ in range(procs)]
+    # Each child process opens its own connection.
+    connection.close()
+    start = time.time()
+    pids = []
+    for i, scheduler in enumerate(schedulers):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                try:
+                    if procs > 1:
+                        scheduler.partition = (i, procs)
+                    claim_and_fire(scheduler)
+                    code = 0
+                except:
+                    traceback.print_exc()
+            finally:
+                os._exit(code)
+        pids.append(pid)
+    failed = [p for p in pids if os.waitpid(p, 0)[1]]
+    elapsed = time.time() - start
+    instances = Instance.objects.filter(task_id=task.pk,
+        task_type=ContentType.objects.get_for_model(task))
+    fired = instances.count()
+    distinct = len(set(instances.values_list('schedule_id', flat=True)))
+    instances.delete()
+    Schedule.objects.filter(queue_id=queue.pk).delete()
+    for scheduler in schedulers:
+        scheduler.delete()
+    if failed:
+        print '%s of %s Scheduler processes failed.' % (len(failed), procs)
+    return dict(n=n, procs=procs, fired=fired, elapsed=elapsed,
+        rate=fired / elapsed if elapsed else 0, duplicates=fired - distinct)
+
+def main():
+    usage = "python -m norc.benchmarks.scheduler_heap " + \
+        "[-n 10000,100000,1000000] [-s <seconds>] [--db [-p 1,2,4]]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", default="10000,100000,1000000",
+        help="Comma separated numbers of schedules to try.")
+    parser.add_option("-s", "--seconds", type="int", default=3600,
+        help="How many simulated seconds to run the timer core for.")
+    parser.add_option("--db", action="store_true", default=False,
+        help="Claim and fire real Schedules instead of simulating.")
+    parser.add_option("-p", "--schedulers", default="1",
+        help="Comma separated numbers of Schedulers to try with --db.")
+    
+    (options, args) = parser.parse_args()
+    sizes = map(int, options.number.split(','))
+    
+    if not options.db:
+        print 'Old timer: ~%d bytes per schedule.' % \
+            legacy_bytes_per_schedule()
+        print '%9s %9s %10s %11s %10s %10s' % ('Schedules', 'Build (s)',
+            'Firings', 'Firings/sec', 'Heap MB', 'Bytes/ea')
+        for n in sizes:
+            r = run_heap(n, options.seconds)
+            print '%(n)9d %(build)9.2f %(fired)10d %(rate)11.0f ' \
+                '%(heap_mb)10.1f %(heap_bytes)10d' % r
+            sys.stdout.flush()
+        return
+    
+    name = 'norc_bench_%s' % os.getpid()
+    queue = DBQueue.objects.create(name=name)
+    task = CommandTask.objects.create(name=name, command='true')
+    try:
+        print '%9s %10s %9s %10s %11s %10s' % ('Schedules', 'Schedulers',
+            'Time (s)', 'Firings', 'Firings/sec', 'Duplicates')
+        for n in sizes:
+            for procs in map(int, options.schedulers.split(',')):
+                r = run_db(n, task, queue, procs)
+                print '%(n)9d %(procs)10d %(elapsed)9.2f %(fired)10d ' \
+                    '%(rate)11.1f %(duplicates)10d' % r
+                sys.stdout.flush()
+    finally:
+        queue.items.all().delete()
+        task.instances.all().delete()
+        Schedule.objects.filter(queue_id=queue.pk).delete()
+        task.delete()
+        queue.delete()
+
+if __name__ == '__main__':
+    main()
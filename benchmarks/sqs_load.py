@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""Benchmark for loading SQSQueues, against a local stand-in for SQS.
+
+SQSQueues used to connect to SQS and look their queue up as soon as they
+were constructed, which is every time one is loaded from the database:
+Queue.get(), Queue.all_queues() in reports and every fetch of a queue
+group's members.  Now handles are pooled per thread and looked up the
+first time they're used.  Both are timed loading N queues, then using
+each once, then loading and using them all again.
+
+SQS is replaced by a fake connection that takes --latency seconds for
+each request it would have made, and counts them.  Queues are built the
+way the ORM builds them from rows, so no sqs tables are needed.
+
+"""
+
+import sys
+import time
+from optparse import OptionParser
+
+from norc.sqs import models
+from norc.sqs.models import SQSQueue, SQSPool
+
+class FakeQueue(object):
+    
+    def __init__(self, name):
+        self.name = name
+    
+
+class FakeConnection(object):
+    """Stands in for SQSConnection, counting and delaying requests."""
+    
+    latency = 0
+    requests = 0
+    
+    def __init__(self, *args, **kwargs):
+        pass
+    
+    def request(self):
+        FakeConnection.requests += 1
+        time.sleep(FakeConnection.latency)
+    
+    def lookup(self, name):
+        self.request()
+        return FakeQueue(name)
+    
+    def create_queue(self, name, timeout):
+        self.request()
+        return FakeQueue(name)
+    
+
+def legacy_init(queue):
+    """What SQSQueue.__init__() used to do after Queue.__init__()."""
+    c = models.SQSConnection(None, None)
+    handle = c.lookup(queue.name)
+    if not handle:
+        handle = c.create_queue(queue.name, 1)
+    return c, handle
+
+def load(n, legacy):
+    """Builds n SQSQueues the way the ORM does from their rows."""
+    queues = [SQSQueue(id=i, name='norc_bench_%s' % i) for i in xrange(n)]
+    if legacy:
+        for q in queues:
+            legacy_init(q)
+    return queues
+
+def use(queues, legacy):
+    if not legacy:
+        for q in queues:
+            q.queue
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return (time.time() - start) * 1000
+
+def main():
+    usage = "python -m norc.benchmarks.sqs_load [-n 100] [-l 0.02]"
+    
+    parser = OptionParser(usage)
+    parser.add_option("-n", "--number", type="int", default=100,
+        help="How many SQSQueues to load.")
+    parser.add_option("-l", "--latency", type="float", default=0.02,
+        help="Seconds each SQS request takes.")
+    
+    (options, args) = parser.parse_args()
+    models.SQSConnection = FakeConnection
+    FakeConnection.latency = options.latency
+    
+    print '%-8s %7s %10s %10s %10s %9s' % ('Engine', 'Queues',
+        'Load (ms)', 'Use (ms)', 'Again (ms)', 'Requests')
+    for name, legacy in [('legacy', True), ('pooled', False)]:
+        models.POOL = SQSPool()
+        FakeConnection.requests = 0
+        queues = []
+        loading = timed(lambda: queues.extend(load(options.number, legacy)))
+        using = timed(use, queues, legacy)
+        again = timed(lambda: use(load(options.number, legacy), legacy))
+        print '%-8s %7d %10.1f %10.1f %10.1f %9d' % (name, options.number,
+            loading, using, again, FakeConnection.requests)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@ from norc.core.models import Executor, Queue, DBQueue
 from norc.norc_utils.log import make_log
 
 def main():
-    usage = "norc_executor <queue_name> -c <n> [-e] [-d]"
+    usage = "norc_executor <queue_name> -c <n> [-w] [-e] [-d]"
     
     def bad_args(message):
         print message
@@ -21,6 +21,8 @@ def main():
         help="How many instances can be run concurrently.")
     parser.add_option("-q", "--create_queue", action="store_true",
         default=False, help="Force creation of a DBQueue with this name.")
+    parser.add_option("-w", "--workers", action="store_true", default=False,
+        help="Run instances in a pool of pre-forked worker processes.")
     parser.add_option("-e", "--echo", action="store_true", default=False,
         help="Echo log messages to stdout.")
     parser.add_option("-d", "--debug", action="store_true", default=False,
@@ -42,6 +44,7 @@ def main():
             bad_args("Invalid queue name '%s'." % args[0])
     
     executor = Executor.objects.create(queue=queue, concurrent=options.concurrent)
+    executor.use_workers = options.workers
     executor.log = make_log(executor.log_path,
         echo=options.echo, debug=options.debug)
     executor.start()
@@ -3,14 +3,19 @@
 """A command-line script to run a Norc scheduler."""
 
 import sys, time
+import itertools
+from datetime import datetime
 from optparse import OptionParser
 
 from norc.core import reports
-from norc.norc_utils.parsing import parse_since
+from norc.core.models import Schedule, CronSchedule, queue_load
+from norc.norc_utils.parsing import parse_since, parse_date_relative
 from norc.norc_utils.formatting import untitle, pprint_table
+from norc.norc_utils.django_extras import bulk_generic_objects
 
 def main():
-    usage = "norc_reporter [--executors] [--schedulers] [--queues]"
+    usage = "norc_reporter [--executors] [--schedulers] [--queues] " + \
+        "[--forecast <window>]"
     
     def bad_args(message):
         print message
@@ -24,6 +29,9 @@ def main():
         help="Report on schedulers.")
     parser.add_option("-q", "--queues", action="store_true",
         help="Report on queues.")
+    parser.add_option("-f", "--forecast", metavar="WINDOW",
+        help="Predict instances per queue per minute over the next " +
+            "WINDOW (e.g. '1h').")
     parser.add_option("-t", "--timeframe",
         help="Filter to only things in this timeframe (e.g. '10m').")
     parser.add_option("-n", "--number", default=20, type="int",
@@ -32,7 +40,8 @@ def main():
     (options, args) = parser.parse_args()
     since = parse_since(options.timeframe)
     
-    if not any([options.executors, options.schedulers, options.queues]):
+    if not any([options.executors, options.schedulers, options.queues,
+            options.forecast]):
         options.executors = True
     
     print time.strftime('[%Y/%m/%d %H:%M:%S]'),
@@ -63,9 +72,35 @@ def main():
     if options.queues:
         print '\n## Queues ##'
         print_report(reports.queues)
-        
-        
-        
+    if options.forecast:
+        print '\n## Forecast ##'
+        try:
+            now = datetime.utcnow()
+            end = now + (now - parse_date_relative(options.forecast, now))
+        except TypeError:
+            bad_args("Invalid forecast window '%s'." % options.forecast)
+        print_forecast(now, end, options.number)
+    
+
+def print_forecast(start, end, number):
+    """Prints the instances each queue will receive per minute."""
+    load = queue_load(itertools.chain(Schedule.objects.unfinished.iterator(),
+        CronSchedule.objects.unfinished.iterator()), start, end)
+    if not load:
+        print 'None found.'
+        return
+    keys = load.keys()
+    names = [q.name if q else '#%s' % key[1]
+        for key, q in zip(keys, bulk_generic_objects(keys))]
+    minutes = sorted(set([m for counts in load.values() for m in counts]))
+    if number > 0:
+        minutes = minutes[:number]
+    table = [['Minute (UTC)'] + names]
+    for m in minutes:
+        table.append([time.strftime('%Y/%m/%d %H:%M', time.gmtime(m))] +
+            [str(load[key].get(m, 0)) for key in keys])
+    table.append(['Total'] + [str(sum(load[key].values())) for key in keys])
+    pprint_table(sys.stdout, table)
 
 if __name__ == '__main__':
     main()
@@ -20,11 +20,15 @@ admin.site.register(models.DBQueue, DBQueueAdmin)
 
 class DBQueueItemAdmin(admin.ModelAdmin):
     list_display = ['id', 'dbqueue', 'item', 'enqueued']
+    
+    def queryset(self, request):
+        """Loads each page's enqueued items in bulk."""
+        return super(DBQueueItemAdmin, self).queryset(request).with_items()
 
 admin.site.register(models.DBQueueItem, DBQueueItemAdmin)
 
 class QueueGroupAdmin(admin.ModelAdmin):
-    list_display = ['id', 'name', 'count_']
+    list_display = ['id', 'name', 'policy', 'count_']
     
     def count_(self, qg):
         return qg.count()
@@ -33,7 +37,7 @@ class QueueGroupAdmin(admin.ModelAdmin):
 admin.site.register(models.QueueGroup, QueueGroupAdmin)
 
 class QueueGroupItemAdmin(admin.ModelAdmin):
-    list_display = ['id', 'group', 'queue', 'priority']
+    list_display = ['id', 'group', 'queue', 'priority', 'weight']
 
 admin.site.register(models.QueueGroupItem, QueueGroupItemAdmin)
 
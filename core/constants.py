@@ -17,6 +17,28 @@ SCHEDULER_LIMIT = 10000
 
 EXECUTOR_PERIOD = 0.5
 
+# How often an idle executor polls when a notification system is set up
+# to wake it; see NOTIFY_SYSTEM.
+EXECUTOR_FALLBACK_PERIOD = 10
+
+# How long a QueueGroup's members are cached before being loaded again.
+# Changes to a group are seen at once by the process that made them.
+QUEUEGROUP_REFRESH = 60
+
+# How often a running Job checks on its nodes, without and with a
+# notification system to wake it when they finish; see NOTIFY_SYSTEM.
+JOB_PERIOD = 1
+JOB_FALLBACK_PERIOD = 10
+
+# How many past runs of a Job the durations of its nodes are averaged
+# over when prioritizing them.
+JOB_HISTORY = 10
+
+# Executor workers (see core/workers.py) are replaced after running this
+# many instances or growing past this many megabytes.
+WORKER_MAX_TASKS = 100
+WORKER_MAX_RSS = 256
+
 # A list of all Task implementations.
 TASK_MODELS = [] # NOTE: This is dynamically generated by MetaTask.
 
@@ -32,6 +54,20 @@ HEARTBEAT_PERIOD = 3
 # cause failsafes to activate erroneously.
 HEARTBEAT_FAILED = HEARTBEAT_PERIOD + 20
 
+# How long a Scheduler's claim on its schedules lasts after its last
+# heartbeat.  Other Schedulers only reclaim the schedules once the heart
+# has failed, so the difference is a safety margin for clock skew and
+# batches that were already firing; a Scheduler whose heart can't beat
+# stops firing well before anyone else may start.
+SCHEDULER_LEASE = HEARTBEAT_FAILED - 3 * HEARTBEAT_PERIOD
+
+# How long an item popped from a DBQueue (or RedisQueue) stays invisible
+# to other pops before it is delivered again, unless it is acked or its
+# lease renewed.  Executors renew the leases of running instances every
+# heartbeat, so items are only delivered again once their Executor's
+# heart has failed.
+DBQUEUE_LEASE = HEARTBEAT_FAILED
+
 # Controls how long an instance's finally method has to run.
 FINALLY_TIMEOUT = 30
 
@@ -122,5 +158,5 @@ class Request(object):
     PAUSE = 7
     RESUME = 8
     RELOAD = 9
-    
-    
+
+
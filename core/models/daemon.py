@@ -11,6 +11,7 @@ from django.db.models import Model, CharField, DateTimeField, IntegerField
 from norc import settings
 from norc.core.constants import (Status, Request,
     HEARTBEAT_PERIOD, HEARTBEAT_FAILED)
+from norc.norc_utils import notify
 from norc.norc_utils.log import make_log
 from norc.norc_utils.backup import backup_log
 from norc.norc_utils.parsing import parse_since
@@ -63,6 +64,9 @@ class AbstractDaemon(Model):
         self.heart = Thread(target=self.heart_run)
         self.heart.daemon = True
         self.heart.flag = Event()
+        self.listener = None
+        # The time.time() at which the last saved heartbeat was taken.
+        self.last_beat = None
     
     def heart_run(self):
         """Method to be run by the heart thread."""
@@ -71,6 +75,11 @@ class AbstractDaemon(Model):
             
             self.heartbeat = datetime.utcnow()
             self.save(safe=True)
+            self.last_beat = start
+            try:
+                self.beat()
+            except Exception:
+                self.log.error("Error in %s's heartbeat." % self, trace=True)
             
             # In case the database is slow and saving takes longer
             # than HEARTBEAT_PERIOD to complete.
@@ -79,6 +88,24 @@ class AbstractDaemon(Model):
                 self.heart.flag.wait(wait)
                 self.heart.flag.clear()
     
+    def beat(self):
+        """Called by the heart after each heartbeat is saved.
+        
+        Daemons can override this for work that must happen at least
+        every HEARTBEAT_PERIOD, even while their main loop is busy.
+        
+        """
+        pass
+    
+    def prepare(self):
+        """Called by start() before any of the daemon's threads start.
+        
+        Anything that forks should do it here, since a child forked while
+        other threads run can inherit a lock one of them holds.
+        
+        """
+        pass
+    
     def start(self):
         """Starts the daemon.  Does initialization then calls run()."""
         
@@ -108,9 +135,14 @@ class AbstractDaemon(Model):
         self.log.info("%s initialized; starting..." % self)
         
         self.status = Status.RUNNING
+        start = time.time()
         self.heartbeat = self.started = datetime.utcnow()
         self.save()
+        self.last_beat = start
+        self.prepare()
         self.heart.start()
+        self.listener = notify.listen(self.wakeup_channels(),
+            lambda channel: self.flag.set(), self.log)
         
         try:
             self.run()
@@ -128,12 +160,16 @@ class AbstractDaemon(Model):
                 self.log.error("Clean up function failed.", trace=True)
             if not Status.is_final(self.status):
                 self.set_status(Status.ERROR)
+            if self.listener:
+                self.listener.stop()
             self.heart.flag.set()
             self.heart.join()
             self.ended = datetime.utcnow()
             self.save()
             if settings.BACKUP_SYSTEM:
                 self.log.info('Backing up log file...')
+                # Everything buffered so far has to be in the backup.
+                self.log.flush()
                 try:
                     if backup_log(self.log_path):
                         self.log.info('Completed log backup.')
@@ -168,12 +204,19 @@ class AbstractDaemon(Model):
     def wait(self, t=1):
         """Waits on the flag.
         
+        The flag is cleared after waking rather than before waiting, so
+        a wakeup that arrives while the daemon is busy isn't lost.
+        
         For whatever reason, when this is done signals are no longer
         handled properly, so we must catch the exceptions explicitly.
         
         """
-        self.flag.clear()
         self.flag.wait(t)
+        self.flag.clear()
+    
+    def wakeup_channels(self):
+        """Notification channels that should wake this daemon up."""
+        return [notify.channel(self)]
     
     def is_alive(self):
         """Whether the Daemon is still alive.
@@ -200,6 +243,7 @@ class AbstractDaemon(Model):
             self.request = request
             self.save()
             self.flag.set()
+            notify.notify(notify.channel(self))
             return True
         else:
             return False
@@ -220,4 +264,4 @@ class AbstractDaemon(Model):
         return u"[%s #%s on %s]" % (type(self).__name__, self.id, self.host)
     
     __repr__ = __unicode__
-    
+
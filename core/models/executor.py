@@ -2,6 +2,8 @@
 """The Norc Executor is defined here."""
 
 import os
+import errno
+import fcntl
 import signal
 import time
 from datetime import datetime, timedelta
@@ -20,12 +22,16 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import (GenericForeignKey)
 
 from norc.core.models.daemon import AbstractDaemon
+from norc.core.models.queue import DBQueue
+from norc.core.models.queuegroup import QueueGroup
 from norc.core.constants import (Status, Request,
-    EXECUTOR_PERIOD, HEARTBEAT_FAILED, INSTANCE_MODELS)
+    EXECUTOR_PERIOD, EXECUTOR_FALLBACK_PERIOD, HEARTBEAT_FAILED,
+    DBQUEUE_LEASE,
+    INSTANCE_MODELS, WORKER_MAX_TASKS, WORKER_MAX_RSS)
+from norc.core.workers import WorkerPool
 from norc.norc_utils.django_extras import QuerySetManager, MultiQuerySet
 from norc.norc_utils.log import make_log
-from norc.norc_utils.parallel import ThreadPool
-from norc.norc_utils.backup import backup_log
+from norc.norc_utils.backup import BackupPool
 from norc import settings
 
 class Executor(AbstractDaemon):
@@ -91,6 +97,10 @@ class Executor(AbstractDaemon):
     # The number of things that can be run concurrently.
     concurrent = IntegerField()
     
+    # Whether instances are run by a pool of pre-forked workers instead
+    # of a new norc_taskrunner process each.  See core/workers.py.
+    use_workers = False
+    
     @property
     def alive(self):
         return self.status == Status.RUNNING and self.heartbeat > \
@@ -99,13 +109,45 @@ class Executor(AbstractDaemon):
     def __init__(self, *args, **kwargs):
         AbstractDaemon.__init__(self, *args, **kwargs)
         self.processes = {}
+        self.workers = None
+        self.sigchld = False
+        # When beat() may next release expired DBQueue leases.
+        self.next_release = 0
+    
+    def prepare(self):
+        """Forks the worker pool while this is still single threaded."""
+        if self.use_workers:
+            self.workers = WorkerPool(self.concurrent,
+                WORKER_MAX_TASKS, WORKER_MAX_RSS)
     
     def run(self):
         """Core executor function."""
         if settings.BACKUP_SYSTEM:
-            self.pool = ThreadPool(self.concurrent + 1)
+            self.pool = BackupPool(settings.BACKUP_THREADS,
+                settings.BACKUP_QUEUE_LIMIT, self.log)
         self.log.info("%s is now running on host %s." % (self, self.host))
         
+        # Wake up as soon as a child exits.  Like the handlers in
+        # AbstractDaemon.start(), this can't be done in a thread.
+        try:
+            self.child_pipe = os.pipe()
+            for fd in self.child_pipe:
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+            fcntl.fcntl(self.child_pipe[1], fcntl.F_SETFL, os.O_NONBLOCK)
+            signal.signal(signal.SIGCHLD, self.sigchld_handler)
+            signal.siginterrupt(signal.SIGCHLD, False)
+            self.sigchld = True
+        except ValueError:
+            for fd in self.child_pipe:
+                os.close(fd)
+        else:
+            # Workers forked from now on mustn't hold the pipe open.
+            if self.workers:
+                self.workers.inherited.extend(self.child_pipe)
+            waker = Thread(target=self.wake_on_sigchld)
+            waker.daemon = True
+            waker.start()
+        
         if self.log.debug_on:
             self.resource_reporter = Thread(target=self.report_resources)
             self.resource_reporter.daemon = True
@@ -116,52 +158,139 @@ class Executor(AbstractDaemon):
             if self.request:
                 self.handle_request()
             
+            # Clean up completed tasks first so their slots can be refilled.
+            finished = self.reap()
+            if finished:
+                self.finish_instances(finished)
+            
             if self.status == Status.RUNNING:
-                while len(self.processes) < self.concurrent:
-                    # self.log.debug("Popping instance...")
-                    instance = self.queue.pop()
-                    if instance:
-                        # self.log.debug("Popped %s" % instance)
+                # Fill every free slot with a single request to the queue.
+                free = self.concurrent - len(self.processes)
+                if free > 0:
+                    for instance in self.queue.pop_many(free):
                         self.start_instance(instance)
-                    else:
-                        # self.log.debug("No instance in queue.")
-                        break
             
             elif self.status == Status.STOPPING and len(self.processes) == 0:
                 self.set_status(Status.ENDED)
                 self.save(safe=True)
             
-            # Clean up completed tasks before iterating.
-            for pid, p in self.processes.items()[:]:
-                p.poll()
-                self.log.debug(
-                    "Checking pid %s: return code %s." % (pid, p.returncode))
-                if not p.returncode == None:
-                    i = type(p.instance).objects.get(pk=p.instance.pk)
-                    if i.status == Status.CREATED:
-                        self.log.info(("%s fail to initialize properly; " +
-                            "entering suspension to avoid more errors.") % i)
-                        self.set_status(Status.SUSPENDED)
-                        self.save()
-                    if not Status.is_final(i.status):
-                        self.log.info(("%s ended with invalid " +
-                            "status %s, changing to ERROR.") %
-                            (i, Status.name(i.status)))
-                        i.status = Status.ERROR
-                        i.save()
-                    self.log.info("%s ended with status %s." %
-                        (i, Status.name(i.status)))
-                    del self.processes[pid]
-                    if settings.BACKUP_SYSTEM:
-                        self.pool.queueTask(self.backup_instance_log, [i])
-            
             if not Status.is_final(self.status):
-                self.wait(EXECUTOR_PERIOD)
+                # With a listener, pushes and requests wake us up, and
+                # with SIGCHLD so do finished processes.  Otherwise
+                # whatever isn't covered must be checked on often.
+                if self.listener and (self.sigchld or not self.processes):
+                    self.wait(EXECUTOR_FALLBACK_PERIOD)
+                else:
+                    self.wait(EXECUTOR_PERIOD)
                 self.request = Executor.objects.get(pk=self.pk).request
     
+    def reap(self):
+        """Returns the processes of all instances that have finished.
+        
+        Only the processes this Executor started are waited on, so the
+        exit statuses of other children of the process aren't taken from
+        whoever started them.  Pooled workers don't exit between
+        instances and are checked through their pipes instead.
+        
+        """
+        return [p for p in self.processes.itervalues() if p.poll() != None]
+    
+    def finish_instances(self, finished):
+        """Reconciles the statuses of finished instances in bulk."""
+        by_model = {}
+        for p in finished:
+            del self.processes[p.pid]
+            by_model.setdefault(type(p.instance), []).append(p.instance)
+        for model, instances in by_model.iteritems():
+            fresh = model.objects.in_bulk([i.pk for i in instances])
+            invalid = []
+            for i in [fresh.get(i.pk, i) for i in instances]:
+                if i.status == Status.CREATED:
+                    self.log.info(("%s fail to initialize properly; " +
+                        "entering suspension to avoid more errors.") % i)
+                    self.set_status(Status.SUSPENDED)
+                if not Status.is_final(i.status):
+                    self.log.info(("%s ended with invalid " +
+                        "status %s, changing to ERROR.") %
+                        (i, Status.name(i.status)))
+                    i.status = Status.ERROR
+                    invalid.append(i.pk)
+                self.log.info("%s ended with status %s." %
+                    (i, Status.name(i.status)))
+                if settings.BACKUP_SYSTEM:
+                    self.pool.add(i.log_path)
+            if invalid:
+                model.objects.filter(pk__in=invalid).update(
+                    status=Status.ERROR)
+        self.queue.ack([p.instance for p in finished])
+        if self.status == Status.SUSPENDED:
+            self.save()
+    
+    def beat(self):
+        """Renews the leases of running instances and frees lost ones.
+        
+        Instances popped by an Executor that has since died are released
+        once their leases run out, to be run by whichever Executor pops
+        them next.  That is a table-wide UPDATE, so it is only done by
+        Executors that pop from DBQueues, and at most every half lease.
+        
+        """
+        self.queue.renew([p.instance for p in self.processes.values()])
+        now = time.time()
+        if now >= self.next_release and self.pops_dbqueues():
+            self.next_release = now + DBQUEUE_LEASE / 2.0
+            DBQueue.release_expired()
+    
+    def pops_dbqueues(self):
+        """Whether this Executor's queue is or includes a DBQueue."""
+        if isinstance(self.queue, QueueGroup):
+            return any([isinstance(q, DBQueue) for q in self.queue.queues])
+        return isinstance(self.queue, DBQueue)
+    
+    def wakeup_channels(self):
+        """Executors also wake up when their queue is pushed to."""
+        return AbstractDaemon.wakeup_channels(self) + \
+            self.queue.wakeup_channels()
+    
+    def sigchld_handler(self, signum, frame=None):
+        """Wakes the main loop when a child exits.
+        
+        Setting the flag here could deadlock, since the main thread holds
+        the flag's lock while waiting on or clearing it, so this only
+        writes to a pipe that wake_on_sigchld() reads.
+        
+        """
+        try:
+            os.write(self.child_pipe[1], 'x')
+        except OSError:
+            # The pipe is full, so a wakeup is already pending.
+            pass
+    
+    def wake_on_sigchld(self):
+        """Sets the flag for each wakeup written by sigchld_handler()."""
+        while True:
+            try:
+                if not os.read(self.child_pipe[0], 1024):
+                    break
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    break
+                continue
+            self.flag.set()
+        os.close(self.child_pipe[0])
+    
     def clean_up(self):
+        if self.sigchld:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            # Ends wake_on_sigchld().
+            os.close(self.child_pipe[1])
+        if self.workers:
+            self.workers.close()
         if settings.BACKUP_SYSTEM:
-            self.pool.joinAll()
+            spilled = self.pool.close(settings.BACKUP_SHUTDOWN_TIMEOUT)
+            if spilled:
+                self.log.info("Left %s log backups for the next Executor "
+                    "on this host." % spilled)
     
     def report_resources(self):
         while not Status.is_final(self.status):
@@ -170,19 +299,53 @@ class Executor(AbstractDaemon):
             self.log.debug(rself)
             rchildren = resource.getrusage(resource.RUSAGE_CHILDREN)
             self.log.debug(rchildren)
+            if settings.BACKUP_SYSTEM:
+                self.log.debug("Log backups: %s" % self.pool.metrics())
+    
+    def redeliver(self, instance):
+        """Decides whether an instance that was popped again should run.
+        
+        Instances come off the queue again when their lease runs out
+        before they were acked.  Ones still running here keep running
+        under the new pop's lease, which is renewed.  Ones that have
+        ended, or whose Executor is still alive to finish them, are acked
+        and dropped.  Ones whose Executor was lost are reset to run again.
+        
+        """
+        for p in self.processes.values():
+            if p.instance == instance:
+                # The old lease was claimed by this pop, so hold the new one.
+                p.instance = instance
+                self.queue.renew([instance])
+                return False
+        owner = instance.executor
+        if Status.is_final(instance.status) or \
+                (owner and owner.pk != self.pk and owner.alive):
+            self.queue.ack([instance])
+            return False
+        self.log.info("Rerunning %s, whose Executor was lost." % instance)
+        instance.status = Status.CREATED
+        instance.started = None
+        return True
     
     def start_instance(self, instance):
         """Starts a given instance in a new process."""
+        if instance.status != Status.CREATED and \
+                not self.redeliver(instance):
+            return
         instance.executor = self
         instance.save()
         self.log.info("Starting %s..." % instance)
         # p = Process(target=self.execute, args=[instance.start])
         # p.start()
         ct = ContentType.objects.get_for_model(instance)
-        f = make_log(instance.log_path).file
-        p = Popen('norc_taskrunner --ct_pk %s --target_pk %s' %
-            (ct.pk, instance.pk), stdout=f, stderr=STDOUT, shell=True)
-        p.instance = instance
+        if self.workers:
+            p = self.workers.start(ct.pk, instance)
+        else:
+            f = make_log(instance.log_path).file
+            p = Popen('norc_taskrunner --ct_pk %s --target_pk %s' %
+                (ct.pk, instance.pk), stdout=f, stderr=STDOUT, shell=True)
+            p.instance = instance
         self.processes[p.pid] = p
     
     # This should be used in 2.6, but with subprocess it's not possible.
@@ -224,14 +387,7 @@ class Executor(AbstractDaemon):
                 os.kill(pid, signal.SIGTERM)
             self.set_status(Status.KILLED)
     
-    def backup_instance_log(self, instance):
-        self.log.info("Attempting upload of log for %s..." % instance)
-        if backup_log(instance.log_path):
-            self.log.info("Completed upload of log for %s." % instance)
-        else:
-            self.log.info("Failed to upload log for %s." % instance)
-    
     @property
     def log_path(self):
         return 'executors/executor-%s' % self.id
-    
+
@@ -1,18 +1,25 @@
 
 import os
-import time
+from itertools import groupby
+from threading import Event
 
-from django.db.models import (Model, query,
+from django.db import transaction
+from django.db.models import (Model, query, F,
     BooleanField,
+    FloatField,
     PositiveIntegerField,
     ForeignKey)
+from django.db.models.signals import post_save, post_delete
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import (GenericRelation,
                                                  GenericForeignKey)
 
-from norc.core.constants import Status
+from norc.core.constants import (Status,
+    JOB_PERIOD, JOB_FALLBACK_PERIOD, JOB_HISTORY)
 from norc.core.models.task import Task, AbstractInstance, Instance
-from norc.norc_utils.django_extras import queryset_exists, QuerySetManager
+from norc.norc_utils import notify
+from norc.norc_utils.django_extras import (queryset_exists, QuerySetManager,
+    in_bulk, bulk_insert, CounterField)
 
 class Job(Task):
     """A Task composed of running several other Tasks."""
@@ -21,28 +28,177 @@ class Job(Task):
         app_label = 'core'
         db_table = 'norc_job'
     
+    # Incremented whenever a node or dependency of the job is saved or
+    # deleted, so that cached graphs can be told apart.  Code that adds
+    # nodes or dependencies without signals (see bulk_insert) must
+    # increment it itself.  Saving a Job doesn't write it.
+    graph_revision = CounterField(default=0)
+    
+    # Loaded graphs as ((date_added, graph_revision), JobGraph) by job
+    # id.  The date tells apart jobs that reuse the id of a deleted one.
+    GRAPHS = {}
+    
+    def graph(self):
+        """The job's nodes and dependencies, loaded with two queries.
+        
+        Graphs are cached for as long as graph_revision is unchanged, so
+        this costs no queries at all for a job that has run before.
+        
+        """
+        version = (self.date_added, self.graph_revision)
+        cached = Job.GRAPHS.get(self.pk)
+        if cached and cached[0] == version:
+            return cached[1]
+        graph = JobGraph(list(self.nodes.all()),
+            Dependency.objects.filter(child__job=self)
+                .values_list('parent', 'child'))
+        Job.GRAPHS[self.pk] = (version, graph)
+        return graph
+    
+    def node_durations(self, history=JOB_HISTORY):
+        """The mean duration in seconds of each node over recent runs.
+        
+        Only node instances that succeeded in the last history finished
+        instances of this job count; nodes without any are left out.
+        
+        """
+        instances = list(self.instances.filter(ended__isnull=False)
+            .order_by('-id').values_list('id', flat=True)[:history])
+        totals = {}
+        for node, started, ended in JobNodeInstance.objects.filter(
+                job_instance__in=instances, status=Status.SUCCESS,
+                started__isnull=False, ended__isnull=False) \
+                .values_list('node', 'started', 'ended'):
+            d = ended - started
+            total, count = totals.get(node, (0.0, 0))
+            totals[node] = (total + d.days * 86400 + d.seconds +
+                d.microseconds / 1e6, count + 1)
+        return dict([(node, seconds / n)
+            for node, (seconds, n) in totals.iteritems()])
+    
     def start(self, instance):
         """Modified to give run() the instance object."""
         return self.run(instance)
     
     def run(self, instance):
-        """Enqueue instances for all nodes that don't have dependencies."""
-        for node in self.nodes.all():
-            node_instance = JobNodeInstance.objects.create(
-                node=node,
-                job_instance=instance)
-            if node_instance.can_run():
-                instance.schedule.queue.push(node_instance)
-        while True:
-            complete = True
-            for ni in instance.nodis.all():
-                if not Status.is_final(ni.status):
-                    complete = False
-                elif Status.is_failure(ni.status):
+        """Runs the nodes of the job and waits for them to finish."""
+        self.start_nodes(instance)
+        return self.wait_for_nodes(instance)
+    
+    def start_nodes(self, instance):
+        """Creates an instance of every node and enqueues the roots.
+        
+        Each node instance is given the number of parents it has, which
+        they count down as they succeed; see JobNodeInstance.completed().
+        The instances are inserted together, and the roots are known from
+        the graph, so this costs a handful of queries for any job.
+        
+        Each is also given its priority, the length of the longest path
+        of nodes from it to the end of the job, weighted by their mean
+        durations.  Ready nodes are enqueued with their priorities, so
+        long chains of nodes get started before short ones.
+        
+        """
+        graph = self.graph()
+        priorities = graph.priorities(self.node_durations())
+        nis = bulk_insert([JobNodeInstance(node=node, job_instance=instance,
+            pending=graph.parents.get(node.pk) or None,
+            priority=priorities[node.pk])
+            for node in graph.nodes])
+        push_by_priority(instance.schedule.queue,
+            [ni for ni in nis if ni.pending == None])
+        return nis
+    
+    def wait_for_nodes(self, instance):
+        """Waits until every node has finished or any has failed.
+        
+        Node instances notify the job instance's channel as they end, so
+        with a NOTIFY_SYSTEM this only checks the statuses again when
+        something has changed.
+        
+        """
+        woken = Event()
+        listener = notify.listen([notify.channel(instance)],
+            lambda channel: woken.set())
+        try:
+            while True:
+                # Don't read the statuses from a stale transaction.
+                transaction.commit_unless_managed()
+                statuses = set(instance.nodis.values_list('status',
+                    flat=True).distinct())
+                if [s for s in statuses if Status.is_failure(s)]:
                     return False
-            if complete and instance.nodis.count() == self.nodes.count():
-                return True
-            time.sleep(1)
+                if all(map(Status.is_final, statuses)):
+                    return True
+                woken.wait(JOB_FALLBACK_PERIOD if listener else JOB_PERIOD)
+                woken.clear()
+        finally:
+            if listener:
+                listener.stop()
+    
+
+class JobGraph(object):
+    """The nodes and dependencies of a Job, held in memory."""
+    
+    def __init__(self, nodes, edges):
+        """ Parameters:
+        
+        nodes   The JobNodes of the job.
+        edges   (parent id, child id) pairs, one per Dependency.
+        
+        """
+        self.nodes = nodes
+        # The number of parents of each node that has any, and the ids
+        # of the children of each node that has any.  A parent finishing
+        # counts its child down once, so duplicate edges count once too.
+        self.parents = {}
+        self.children = {}
+        for parent, child in sorted(set(edges)):
+            self.parents[child] = self.parents.get(child, 0) + 1
+            self.children.setdefault(parent, []).append(child)
+    
+    @property
+    def roots(self):
+        """The nodes that don't depend on any others."""
+        return [n for n in self.nodes if not n.pk in self.parents]
+    
+    def priorities(self, durations):
+        """The critical path length from each node, by node id.
+        
+        That is the node's own duration plus the largest priority among
+        its children.  durations maps node ids to seconds; nodes missing
+        from it are assumed to take the mean of the others, or a second
+        if there are none.  Nodes on a cycle, which can never run, just
+        get their own duration.
+        
+        """
+        if durations:
+            default = sum(durations.values()) / len(durations)
+        else:
+            default = 1.0
+        duration = lambda pk: durations.get(pk, default)
+        # Visit children before parents by counting down the number of
+        # children each node has left to visit, from the leaves up.
+        remaining = dict([(pk, len(children))
+            for pk, children in self.children.items()])
+        parents = {}
+        for parent, children in self.children.items():
+            for child in children:
+                parents.setdefault(child, []).append(parent)
+        priorities = {}
+        leaves = [n.pk for n in self.nodes if not n.pk in self.children]
+        while leaves:
+            pk = leaves.pop()
+            priorities[pk] = duration(pk) + max([priorities[c]
+                for c in self.children.get(pk, [])] or [0])
+            for parent in parents.get(pk, []):
+                remaining[parent] -= 1
+                if remaining[parent] == 0:
+                    leaves.append(parent)
+        for n in self.nodes:
+            if not n.pk in priorities:
+                priorities[n.pk] = duration(n.pk)
+        return priorities
     
 
 class JobNode(Model):
@@ -79,20 +235,51 @@ class JobNodeInstance(AbstractInstance):
     # The JobInstance that this NodeInstance belongs to.
     job_instance = ForeignKey(Instance, related_name='nodis')
     
+    # How many parents have yet to succeed, or None once this has been
+    # enqueued.
+    pending = PositiveIntegerField(null=True)
+    
+    # The node's critical path length in seconds; see Job.start_nodes().
+    priority = FloatField(default=0)
+    
     def start(self):
+        # Only a first start may count down the children.
+        first = self.status == Status.CREATED
         try:
             AbstractInstance.start(self)
         finally:
-            ji = self.job_instance
-            if not Status.is_failure(self.status):
-                for sub_dep in self.node.sub_deps.all():
-                    sub_node = sub_dep.child
-                    ni = sub_node.nis.get(job_instance=ji)
-                    if ni.can_run():
-                        self.job_instance.schedule.queue.push(ni)
+            if first:
+                self.completed()
+    
+    def completed(self):
+        """Called when this has ended to move the job along.
+        
+        On success, the pending count of each child is decremented and
+        children that reach zero are enqueued with their priorities.
+        Every child is then claimed by setting pending to None with an
+        UPDATE that only matches zero, so if several parents finish at
+        once exactly one of them enqueues it.  Either way, the job
+        instance is woken.
+        
+        """
+        if not Status.is_failure(self.status):
+            children = JobNodeInstance.objects.filter(
+                job_instance=self.job_instance_id,
+                node__in=Dependency.objects.filter(
+                    parent=self.node_id).values('child'))
+            children.update(pending=F('pending') - 1)
+            ready = []
+            for pk in children.filter(pending=0).values_list('id', flat=True):
+                if JobNodeInstance.objects.filter(
+                        pk=pk, pending=0).update(pending=None):
+                    ready.append(pk)
+            if ready:
+                push_by_priority(self.job_instance.schedule.queue,
+                    in_bulk(JobNodeInstance.objects, ready).values())
+        notify.notify(notify.channel(self.job_instance))
     
     def run(self):
-        self.node.task.run()
+        return self.node.task.run()
     
     @property
     def timeout(self):
@@ -113,11 +300,11 @@ class JobNodeInstance(AbstractInstance):
     
     def can_run(self):
         """Whether dependencies are met for this instance to run."""
-        for dep in self.node.super_deps.all():
-            ni = dep.parent.nis.get(job_instance=self.job_instance)
-            if ni.status != Status.SUCCESS:
-                return False
-        return True
+        return not queryset_exists(JobNodeInstance.objects.filter(
+            job_instance=self.job_instance_id,
+            node__in=Dependency.objects.filter(
+                child=self.node_id).values('parent')).exclude(
+            status=Status.SUCCESS))
     
     def __unicode__(self):
         return u'[NodeInstance #%s of %s]' % \
@@ -148,3 +335,32 @@ class Dependency(Model):
     
     __repr__ = __unicode__
     
+
+def push_by_priority(queue, nis):
+    """Enqueues node instances with their priorities, highest first.
+    
+    Nodes of equal priority, such as the branches of a fan-out, are
+    pushed together, in order of id.
+    
+    """
+    nis = sorted(nis, key=lambda ni: (-ni.priority, ni.pk))
+    for priority, group in groupby(nis, lambda ni: ni.priority):
+        queue.push_many(list(group), priority)
+
+def _graph_changed(sender, instance, **kwargs):
+    """Moves a job to a new graph revision when its graph changes."""
+    if isinstance(instance, Dependency):
+        jobs = Job.objects.filter(nodes=instance.parent_id)
+    else:
+        jobs = Job.objects.filter(pk=instance.job_id)
+    jobs.update(graph_revision=F('graph_revision') + 1)
+
+def _forget_graph(sender, instance, **kwargs):
+    """Drops the cached graph of a deleted job."""
+    Job.GRAPHS.pop(instance.pk, None)
+
+post_save.connect(_graph_changed, sender=JobNode)
+post_delete.connect(_graph_changed, sender=JobNode)
+post_save.connect(_graph_changed, sender=Dependency)
+post_delete.connect(_graph_changed, sender=Dependency)
+post_delete.connect(_forget_graph, sender=Job)
@@ -1,20 +1,30 @@
 
 """All queueing related models."""
 
+import copy
 import datetime, time
+import itertools
+import uuid
 
+from django.db import connection, transaction
 from django.db.models.base import ModelBase
-from django.db.models import (Model, Manager,
+from django.db.models import (Model, Manager, query,
     BooleanField,
     CharField,
     DateTimeField,
+    FloatField,
     PositiveIntegerField,
     ForeignKey)
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import (GenericRelation,
                                                  GenericForeignKey)
 
+from norc import settings
+from norc.core.constants import DBQUEUE_LEASE
 from norc.core.models.task import AbstractInstance
+from norc.norc_utils import notify
+from norc.norc_utils.django_extras import (QuerySetManager,
+    POSTGRESQL_ENGINES, IN_BULK_CHUNK, bulk_generic_objects, bulk_insert)
 
 class MetaQueue(ModelBase):
     """This metaclass is used to create a list of Queue implementations."""
@@ -76,17 +86,68 @@ class Queue(Model):
     def pop(self, timeout=None):
         raise NotImplementedError
     
-    def push(self, item):
+    def pop_many(self, n, timeout=None):
+        """Retrieves and removes up to n items, returned as a list.
+        
+        Queues that can wait for a push when they're empty wait up to
+        timeout seconds, or their own default if it's None; 0 means not
+        to wait.  This default makes n separate pops, only the first of
+        which waits; implementations should override it if they can fetch
+        several items in one request.
+        
+        """
+        items = []
+        while len(items) < n:
+            item = self.pop(0 if items else timeout)
+            if item == None:
+                break
+            items.append(item)
+        return items
+    
+    def push(self, item, priority=None):
+        """Adds an item to the queue.
+        
+        Queues that support priorities pop items with higher priorities
+        first; others ignore it.
+        
+        """
         raise NotImplementedError
     
+    def push_many(self, items, priority=None):
+        """Adds a list of items to the queue.
+        
+        This default makes separate pushes; implementations should
+        override it if they can add several items in one request.
+        
+        """
+        for item in items:
+            self.push(item, priority)
+    
+    def ack(self, items):
+        """Acknowledges that popped items have been dealt with.
+        
+        Queues that lease popped items, like DBQueue, deliver them again
+        if they aren't acknowledged in time; others do nothing.
+        
+        """
+        pass
+    
+    def renew(self, items):
+        """Extends the leases of popped items that are still being run."""
+        pass
+    
     def count(self):
         raise NotImplementedError
     
+    def wakeup_channels(self):
+        """Notification channels that are signalled when this is pushed to."""
+        return [notify.channel(self)]
+    
     def __unicode__(self):
         return u"[%s %s]" % (type(self).__name__, self.name)
     
     __repr__ = __unicode__
-
+    
 
 class DBQueue(Queue):
     """A distributed queue implementation that uses the Norc database.
@@ -94,6 +155,16 @@ class DBQueue(Queue):
     In order to reduce database load, it is recommended to use an
     indepedent distributed queueing system, like Amazon's SQS.
     
+    Items are popped highest priority first, and items of equal priority
+    in the order they were pushed.  An item's priority is the one it was
+    pushed with, or 0.
+    
+    Popping an item only leases it for DBQUEUE_LEASE seconds.  Unless
+    the popper acks the item by then, or renews the lease, the item
+    becomes visible again (see release_expired()) and is delivered to
+    another popper, so that items are delivered at least once even if
+    an Executor dies with them.
+    
     """
     class Meta:
         app_label = 'core'
@@ -106,27 +177,124 @@ class DBQueue(Queue):
         
         """
         try:
-            return self.items.all()[0].item
+            return self.items.filter(claim__isnull=True).with_items()[0].item
         except IndexError:
             return None
     
-    def pop(self):
-        """Retrieves the next item and removes it from the queue."""
-        try:
-            next = self.items.all()[0]
-        except IndexError:
-            return None
-        next.delete()
-        return next.item
+    def pop(self, timeout=None):
+        """Retrieves the next item and leases it.
+        
+        The item is claimed atomically, so any number of Executors can
+        pop from the same DBQueue without an item being delivered twice
+        while its lease lasts.
+        
+        """
+        items = self.pop_many(1, timeout)
+        return items[0] if items else None
+    
+    def pop_many(self, n, timeout=None):
+        """Retrieves and leases up to n items with a single claim.
+        
+        DBQueues can't wait for a push, so timeout is ignored.
+        
+        """
+        return DBQueue.pop_from([self], n)
+    
+    @staticmethod
+    def pop_from(queues, n):
+        """Retrieves and leases up to n items from several DBQueues.
+        
+        The items are claimed together, taking those of earlier queues
+        first and then going by priority, so that a QueueGroup can pop
+        from all of its DBQueues with a single claim.
+        
+        How the claim is made depends on the DBQUEUE_POP_MODE setting:
+        
+        skip_locked     Rows are locked with SELECT ... FOR UPDATE SKIP
+                        LOCKED, so concurrent poppers never wait on each
+                        other.  Needs PostgreSQL 9.5+ or MySQL 8+ (InnoDB).
+        update          A single UPDATE stamps a random claim token on the
+                        next unclaimed rows; whichever process's UPDATE
+                        hits a row owns it.  Works on any backend,
+                        including MyISAM tables.
+        auto            skip_locked on PostgreSQL, update elsewhere.
+        
+        """
+        if n < 1 or not queues:
+            return []
+        ids = [q.pk for q in queues]
+        token = uuid.uuid4().hex
+        expires = datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=DBQUEUE_LEASE)
+        mode = _pop_mode()
+        if mode == 'skip_locked':
+            rows = _claim_skip_locked(ids, n, token, expires)
+        elif mode == 'update':
+            rows = _claim_update(ids, n, token, expires)
+        else:
+            raise ValueError("Invalid DBQUEUE_POP_MODE '%s'." % mode)
+        rank = dict([(pk, i) for i, pk in enumerate(ids)])
+        rows.sort(key=lambda r: (rank[r[3]], -r[4], r[0]))
+        return _resolve_rows([r[:3] for r in rows], token)
+    
+    @staticmethod
+    def release_expired():
+        """Makes items whose leases have run out visible again.
+        
+        A single UPDATE finds them off the index on lease_expires.
+        Returns how many items were released.
+        
+        """
+        released = DBQueueItem.objects.filter(
+            lease_expires__lt=datetime.datetime.utcnow()).update(
+            claim=None, lease_expires=None)
+        transaction.commit_unless_managed()
+        return released
     
-    def push(self, item):
+    def ack(self, items):
+        """Removes popped items for good."""
+        ack_leases(items)
+    
+    def renew(self, items):
+        """Extends the leases of popped items by DBQUEUE_LEASE seconds."""
+        renew_leases(items)
+    
+    @staticmethod
+    def nonempty(queues):
+        """The ids of those of several DBQueues that have items waiting.
+        
+        One query finds them all, each checked off the index.
+        
+        """
+        if not queues:
+            return set()
+        qn = connection.ops.quote_name
+        return set(DBQueue.objects.filter(pk__in=[q.pk for q in queues])
+            .extra(where=[("EXISTS (SELECT 1 FROM %(i)s WHERE " +
+                "%(i)s.dbqueue_id = %(q)s.id AND %(i)s.claim IS NULL)") %
+                dict(i=qn(DBQueueItem._meta.db_table),
+                    q=qn(DBQueue._meta.db_table))])
+            .values_list('id', flat=True))
+    
+    def push(self, item, priority=None):
         """Adds an item to the queue."""
         Queue.validate(item)
-        DBQueueItem.objects.create(dbqueue=self, item=item)
+        DBQueueItem.objects.create(dbqueue=self, item=item,
+            priority=priority or 0)
+        notify.notify(notify.channel(self))
+    
+    def push_many(self, items, priority=None):
+        """Adds a list of items to the queue with multi-row INSERTs."""
+        for item in items:
+            Queue.validate(item)
+        if items:
+            bulk_insert([DBQueueItem(dbqueue=self, item=item,
+                priority=priority or 0) for item in items])
+            notify.notify(notify.channel(self))
     
     def count(self):
-        return self.items.count()
-
+        return self.items.filter(claim__isnull=True).count()
+    
 
 class DBQueueItem(Model):
     """An item in a DBQueue."""
@@ -134,7 +302,47 @@ class DBQueueItem(Model):
     class Meta:
         app_label = 'core'
         db_table = 'norc_dbqueueitem'
-        ordering = ['id']
+        ordering = ['-priority', 'id']
+    
+    objects = QuerySetManager()
+    
+    class QuerySet(query.QuerySet):
+        
+        # How many queue items have their items resolved at once.
+        CHUNK_SIZE = 100
+        
+        def with_items(self):
+            """Loads the enqueued items in bulk as the results are read.
+            
+            Without this, each access of .item costs its own queries.
+            
+            """
+            return self._clone(_with_items=True)
+        
+        def iterator(self):
+            results = super(DBQueueItem.QuerySet, self).iterator()
+            if getattr(self, '_with_items', False):
+                results = DBQueueItem.QuerySet._resolve(
+                    results, self.CHUNK_SIZE)
+            return results
+        
+        def _clone(self, *args, **kwargs):
+            c = super(DBQueueItem.QuerySet, self)._clone(*args, **kwargs)
+            if getattr(self, '_with_items', False):
+                c._with_items = True
+            return c
+        
+        @staticmethod
+        def _resolve(results, chunk_size):
+            while True:
+                chunk = list(itertools.islice(results, chunk_size))
+                if not chunk:
+                    break
+                objects = bulk_generic_objects(
+                    [(qi.item_type_id, qi.item_id) for qi in chunk])
+                for qi, obj in zip(chunk, objects):
+                    setattr(qi, DBQueueItem.item.cache_attr, obj)
+                    yield qi
     
     # The queue this item is a part of.
     dbqueue = ForeignKey(DBQueue, related_name='items')
@@ -144,9 +352,189 @@ class DBQueueItem(Model):
     item_id = PositiveIntegerField()
     item = GenericForeignKey('item_type', 'item_id')
     
+    # Items with higher priorities are popped first.
+    priority = FloatField(default=0)
+    
     # The datetime at which this item was enqueued.
     enqueued = DateTimeField(default=datetime.datetime.utcnow, db_index=True)
     
+    # Token of the pop that has claimed this item, if any.
+    claim = CharField(max_length=32, null=True, db_index=True)
+    
+    # When the claim runs out unless the item is acked or renewed.
+    lease_expires = DateTimeField(null=True, db_index=True)
+    
     def __unicode__(self):
         return u'[DBQueueItem #%s, %s]' % (self.id, self.enqueued)
-        
+    
+
+def _pop_mode():
+    """The DBQueue pop mode to use for the configured database."""
+    mode = settings.DBQUEUE_POP_MODE
+    if mode == 'auto':
+        if settings.DATABASE_ENGINE in POSTGRESQL_ENGINES:
+            return 'skip_locked'
+        return 'update'
+    return mode
+
+# The columns of a claimed row, as the claim functions return them.
+CLAIM_COLUMNS = "id, item_type_id, item_id, dbqueue_id, priority"
+
+def _claim_select(columns, queue_ids, limit, lock=""):
+    """SQL and parameters selecting the next rows to claim from DBQueues.
+    
+    Rows of earlier queues come first, then those of higher priority.
+    With several queues, each one's first rows are read off the
+    (dbqueue_id, priority, id) index by a subquery of its own, and only
+    those are sorted; ordering all the queues' rows together would
+    have to sort every unclaimed row in them.  lock, if given, is the
+    locking clause for the rows the subqueries read.
+    
+    """
+    table = connection.ops.quote_name(DBQueueItem._meta.db_table)
+    select = ("SELECT %s FROM %s WHERE dbqueue_id = %%s AND claim IS NULL " +
+        "ORDER BY priority DESC, id LIMIT %%s%s")
+    if len(queue_ids) == 1:
+        return select % (columns, table, lock), [queue_ids[0], limit]
+    members = ' UNION ALL '.join(["SELECT %s, %d AS member FROM (%s) m%d" %
+        (CLAIM_COLUMNS, i, select % (CLAIM_COLUMNS, table, lock), i)
+        for i in range(len(queue_ids))])
+    params = []
+    for pk in queue_ids:
+        params.extend([pk, limit])
+    return ("SELECT %s FROM (%s) claimable " +
+        "ORDER BY member, priority DESC, id LIMIT %%s") % (columns, members), \
+        params + [limit]
+
+def _claim_skip_locked(queue_ids, limit, token, expires):
+    """Claims rows with row locks that concurrent poppers skip over."""
+    table = connection.ops.quote_name(DBQueueItem._meta.db_table)
+    cursor = connection.cursor()
+    try:
+        if settings.DATABASE_ENGINE in POSTGRESQL_ENGINES:
+            # Lock, claim and return the rows in a single statement.
+            select, params = _claim_select("id", queue_ids, limit,
+                " FOR UPDATE SKIP LOCKED")
+            cursor.execute(("UPDATE %s SET claim = %%s, lease_expires = %%s " +
+                "WHERE id IN (%s) RETURNING %s") %
+                (table, select, CLAIM_COLUMNS), [token, expires] + params)
+            rows = cursor.fetchall()
+        else:
+            cursor.execute(*_claim_select(CLAIM_COLUMNS, queue_ids, limit,
+                " FOR UPDATE SKIP LOCKED"))
+            rows = cursor.fetchall()
+            if rows:
+                cursor.execute(("UPDATE %s SET claim = %%s, " +
+                    "lease_expires = %%s WHERE id IN (%s)") %
+                    (table, ', '.join(['%s'] * len(rows))),
+                    [token, expires] + [r[0] for r in rows])
+        transaction.commit_unless_managed()
+    except:
+        transaction.rollback_unless_managed()
+        raise
+    return list(rows)
+
+def _claim_update(queue_ids, limit, token, expires):
+    """Claims rows by stamping them with a token in one UPDATE."""
+    table = connection.ops.quote_name(DBQueueItem._meta.db_table)
+    cursor = connection.cursor()
+    try:
+        if settings.DATABASE_ENGINE == 'mysql' and len(queue_ids) == 1:
+            # MySQL can't select from the table it is updating.
+            cursor.execute(("UPDATE %s SET claim = %%s, lease_expires = %%s " +
+                "WHERE dbqueue_id = %%s AND claim IS NULL " +
+                "ORDER BY priority DESC, id LIMIT %%s") % table,
+                [token, expires] + list(queue_ids) + [limit])
+        else:
+            select, params = _claim_select("id", queue_ids, limit)
+            if settings.DATABASE_ENGINE == 'mysql':
+                # Unless the rows are selected into a derived table first.
+                select = "SELECT id FROM (%s) claimed" % select
+            cursor.execute(("UPDATE %s SET claim = %%s, lease_expires = %%s " +
+                "WHERE claim IS NULL AND id IN (%s)") % (table, select),
+                [token, expires] + params)
+        rows = []
+        if cursor.rowcount:
+            cursor.execute("SELECT %s FROM %s WHERE claim = %%s" %
+                (CLAIM_COLUMNS, table), [token])
+            rows = list(cursor.fetchall())
+        transaction.commit_unless_managed()
+    except:
+        transaction.rollback_unless_managed()
+        raise
+    return rows
+
+def _resolve_rows(rows, token):
+    """Converts (id, item_type_id, item_id) rows into the enqueued items.
+    
+    Each item is given the (id, claim token) of its lease as
+    dbqueue_lease, for acking.  Rows whose object no longer exists are
+    dropped from the queue.
+    
+    """
+    objects = bulk_generic_objects([(ct_id, pk) for _, ct_id, pk in rows])
+    items = []
+    missing = []
+    for row, obj in zip(rows, objects):
+        if obj == None:
+            missing.append(row[0])
+            continue
+        if getattr(obj, 'dbqueue_lease', None):
+            # The item was pushed more than once; each needs its own lease.
+            obj = copy.copy(obj)
+        obj.dbqueue_lease = (row[0], token)
+        items.append(obj)
+    if missing:
+        _delete_leases([(pk, token) for pk in missing])
+    return items
+
+def _leases(items):
+    """The (id, claim token) leases of popped items that have them."""
+    return [i.dbqueue_lease for i in items
+        if getattr(i, 'dbqueue_lease', None)]
+
+def _delete_leases(leases):
+    """Deletes the rows of leases that are still held.
+    
+    Leases are grouped by claim token, since matching ids and tokens
+    separately would also delete a row another pop has claimed since.
+    
+    """
+    table = connection.ops.quote_name(DBQueueItem._meta.db_table)
+    by_token = {}
+    for pk, token in leases:
+        by_token.setdefault(token, []).append(pk)
+    cursor = connection.cursor()
+    try:
+        for token, pks in by_token.iteritems():
+            for i in range(0, len(pks), IN_BULK_CHUNK):
+                chunk = pks[i:i + IN_BULK_CHUNK]
+                cursor.execute("DELETE FROM %s WHERE claim = %%s AND id IN "
+                    "(%s)" % (table, ', '.join(['%s'] * len(chunk))),
+                    [token] + chunk)
+        transaction.commit_unless_managed()
+    except:
+        transaction.rollback_unless_managed()
+        raise
+
+def ack_leases(items):
+    """Removes popped items from whichever DBQueues they came from.
+    
+    An item whose lease has run out and been claimed by another pop is
+    left alone.
+    
+    """
+    leases = _leases(items)
+    if leases:
+        _delete_leases(leases)
+    for i in items:
+        i.dbqueue_lease = None
+
+def renew_leases(items):
+    """Extends the leases of popped items by DBQUEUE_LEASE seconds."""
+    tokens = list(set([token for _, token in _leases(items)]))
+    if tokens:
+        DBQueueItem.objects.filter(claim__in=tokens).update(
+            lease_expires=datetime.datetime.utcnow() +
+                datetime.timedelta(seconds=DBQUEUE_LEASE))
+        transaction.commit_unless_managed()
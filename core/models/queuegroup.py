@@ -1,53 +1,184 @@
 
-from django.db.models import Model, ForeignKey, PositiveIntegerField
+import time
+
+from django.db.models import (Model, ForeignKey,
+    CharField,
+    PositiveIntegerField)
+from django.db.models.signals import post_save, post_delete
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.generic import \
     GenericRelation, GenericForeignKey
 
-from norc.core.models.queue import Queue
+from norc.core.constants import QUEUEGROUP_REFRESH
+from norc.core.models.queue import (Queue, DBQueue, DBQueueItem,
+    ack_leases, renew_leases)
+from norc.norc_utils.django_extras import bulk_generic_objects
+from norc.norc_utils.log import make_log
 
 class QueueGroup(Queue):
-    """A group of Norc queues."""
+    """A group of Norc queues.
+    
+    Which members items are popped from is decided by the group's
+    policy; see POLICIES.
     
+    """
     class Meta:
         app_label = "core"
         db_table = "norc_queuegroup"
     
+    # Loaded members as (time loaded, [(queue, weight)]) by group id.
+    MEMBERS = {}
+    
+    # How pops are shared among the members; one of POLICIES.
+    policy = CharField(max_length=16, default='priority')
+    
+    def members(self):
+        """(queue, weight) for each member queue in priority order.
+        
+        Members are loaded in bulk and cached for QUEUEGROUP_REFRESH
+        seconds, so most pops don't need to look them up at all.
+        
+        """
+        cached = QueueGroup.MEMBERS.get(self.pk)
+        if cached and time.time() - cached[0] < QUEUEGROUP_REFRESH:
+            return cached[1]
+        rows = list(self.items.values_list('queue_type', 'queue_id',
+            'weight'))
+        queues = bulk_generic_objects([r[:2] for r in rows])
+        members = [(q, r[2]) for q, r in zip(queues, rows) if q != None]
+        QueueGroup.MEMBERS[self.pk] = (time.time(), members)
+        return members
+    
     @property
     def queues(self):
-        return [i.queue for i in self.items.all()]
+        """The member queues in priority order."""
+        return [q for q, _ in self.members()]
+    
+    @property
+    def selector(self):
+        """This process's instance of the group's policy."""
+        if getattr(self, '_selector', (None,))[0] != self.policy:
+            if not self.policy in POLICIES:
+                raise ValueError(
+                    "Invalid QueueGroup policy '%s'." % self.policy)
+            self._selector = (self.policy, POLICIES[self.policy]())
+        return self._selector[1]
+    
+    def runs(self):
+        """The member queues in priority order, with DBQueues batched.
+        
+        Consecutive DBQueues are grouped into a list, since they can be
+        popped from together with DBQueue.pop_from().
+        
+        """
+        runs = []
+        for q in self.queues:
+            if isinstance(q, DBQueue):
+                if runs and isinstance(runs[-1], list):
+                    runs[-1].append(q)
+                else:
+                    runs.append([q])
+            else:
+                runs.append(q)
+        return runs
+    
+    def ready(self):
+        """The (queue, weight) of each member that may have items.
+        
+        Empty DBQueues are found with a single query and left out.
+        Other queues can't be checked as cheaply, so are always kept.
+        
+        """
+        members = self.members()
+        ids = DBQueue.nonempty(
+            [q for q, _ in members if isinstance(q, DBQueue)])
+        return [(q, w) for q, w in members
+            if not isinstance(q, DBQueue) or q.pk in ids]
+    
+    def pop_member(self, member, n):
+        """Pops up to n items from a member or a list of DBQueues.
+        
+        A member that fails is logged and treated as empty, so that one
+        broken queue doesn't stop the others from being popped.  Members
+        never wait for a push, since an empty one would hold up the rest
+        and the Executor popping them.
+        
+        """
+        try:
+            if isinstance(member, list):
+                return DBQueue.pop_from(member, n)
+            return member.pop_many(n, timeout=0)
+        except Exception:
+            self.log_failure("pop from", member)
+            return []
+    
+    def log_failure(self, action, member):
+        """Logs the exception being handled for a member."""
+        if not hasattr(self, 'log'):
+            self.log = make_log('queuegroups/%s' % self.name)
+        self.log.error("Failed to %s %s." % (action, member), trace=True)
     
     def peek(self):
         """Retrieves the next item but does not remove it from the queue.
         
-        Returns None if the queue is empty.
+        Returns None if the queue is empty.  Members are looked at in
+        priority order, whatever the group's policy.
         
         """
-        for q in self.queues:
+        for q, _ in self.ready():
             try:
                 i = q.peek()
                 if i != None:
                     return i
-            except:
-                pass
+            except Exception:
+                self.log_failure("peek at", q)
         return None
     
-    def pop(self):
-        """Retrieves the next item and removes it from the queue."""
-        for q in self.queues:
-            try:
-                i = q.pop()
-                if i != None:
-                    return i
-            except:
-                pass
-        return None
+    def pop(self, timeout=None):
+        """Retrieves the next item and leases or removes it."""
+        items = self.pop_many(1, timeout)
+        return items[0] if items else None
     
-    def push(self, item):
+    def pop_many(self, n, timeout=None):
+        """Retrieves up to n items, shared among members by the policy.
+        
+        Groups never wait for a push, so timeout is ignored.
+        
+        """
+        if n < 1:
+            return []
+        return self.selector.pop_many(self, n)
+    
+    def push(self, item, priority=None):
         raise NotImplementedError("Cannot push to a queue group.")
     
+    def ack(self, items):
+        """Acks popped items, whichever members they came from."""
+        ack_leases(items)
+        for q in self.queues:
+            if not isinstance(q, DBQueue):
+                q.ack(items)
+    
+    def renew(self, items):
+        """Renews the leases of popped items from any member."""
+        renew_leases(items)
+        for q in self.queues:
+            if not isinstance(q, DBQueue):
+                q.renew(items)
+    
     def count(self):
-        return sum([q.count() for q in self.queues])
+        """The items waiting in all members, with one query for DBQueues."""
+        queues = self.queues
+        ids = [q.pk for q in queues if isinstance(q, DBQueue)]
+        total = 0
+        if ids:
+            total = DBQueueItem.objects.filter(dbqueue__in=ids,
+                claim__isnull=True).count()
+        return total + sum([q.count() for q in queues
+            if not isinstance(q, DBQueue)])
+    
+    def wakeup_channels(self):
+        return sum([q.wakeup_channels() for q in self.queues], [])
     
 
 class QueueGroupItem(Model):
@@ -67,8 +198,147 @@ class QueueGroupItem(Model):
     
     priority = PositiveIntegerField()
     
+    # The member's share of pops under the round-robin policies.
+    weight = PositiveIntegerField(default=1)
+    
     def __unicode__(self):
         return u'[QueueGroupItem G:%s Q:%s P:%s]' % (self.group, self.queue, self.priority)
     
     __repr__ = __unicode__
     
+
+def _key(queue):
+    """Tells apart queues of different types with the same id."""
+    return (type(queue).__name__, queue.pk)
+
+class StrictPriority(object):
+    """Pops from lower priority members only once higher ones are empty.
+    
+    This is how QueueGroups have always worked.  Adjacent DBQueues are
+    popped from together with a single claim.
+    
+    """
+    def pop_many(self, group, n):
+        items = []
+        for run in group.runs():
+            if len(items) >= n:
+                break
+            items.extend(group.pop_member(run, n - len(items)))
+        return items
+    
+
+class WeightedRoundRobin(object):
+    """Shares pops among members with items in proportion to weight.
+    
+    Members are picked one item at a time and interleaved (smooth
+    weighted round-robin), so with weights 3 and 1 the first member gets
+    three of every four items, and no member with items waits for more
+    than a round.  Empty members are skipped without losing their place.
+    
+    """
+    def __init__(self):
+        self.current = {}
+    
+    def share(self, members, n):
+        """How many of the next n items each member gets, by key."""
+        total = sum([w for _, w in members])
+        counts = {}
+        for _ in xrange(n):
+            best = None
+            for q, w in members:
+                k = _key(q)
+                self.current[k] = self.current.get(k, 0) + w
+                if best == None or self.current[k] > self.current[best]:
+                    best = k
+            self.current[best] -= total
+            counts[best] = counts.get(best, 0) + 1
+        return counts
+    
+    def pop_many(self, group, n):
+        items = []
+        ready = group.ready()
+        while ready and len(items) < n:
+            counts = self.share(ready, n - len(items))
+            empty = []
+            for q, w in ready:
+                want = counts.get(_key(q), 0)
+                if want:
+                    got = group.pop_member(q, want)
+                    items.extend(got)
+                    if len(got) < want:
+                        empty.append((q, w))
+            ready = [m for m in ready if not m in empty]
+        return items
+    
+
+class DeficitRoundRobin(object):
+    """Visits members in turn, popping bursts as large as their deficits.
+    
+    Each turn adds a member's weight to its deficit, and each item it
+    gives takes one away.  What a member doesn't use carries over to its
+    next turn, but an empty member's deficit is dropped so it can't save
+    up.  A turn cut short because the pop is full resumes at the next.
+    
+    """
+    def __init__(self):
+        self.deficits = {}
+        # The member visited last, and whether its turn is still open.
+        self.last = None
+        self.open = False
+    
+    def pop_many(self, group, n):
+        keys = [_key(q) for q, _ in group.members()]
+        ready = group.ready()
+        ready_keys = [_key(q) for q, _ in ready]
+        for k in self.deficits.keys():
+            if not k in ready_keys:
+                del self.deficits[k]
+        # Pick up where the last pop left off.
+        if self.last in keys:
+            start = keys.index(self.last) + (not self.open)
+            order = keys[start:] + keys[:start]
+            ready.sort(key=lambda m: order.index(_key(m[0])))
+        items = []
+        while ready and len(items) < n:
+            progress = False
+            for q, w in list(ready):
+                if len(items) >= n:
+                    break
+                k = _key(q)
+                if not (self.open and self.last == k):
+                    self.deficits[k] = self.deficits.get(k, 0) + w
+                self.last, self.open = k, True
+                want = min(self.deficits[k], n - len(items))
+                got = []
+                if want:
+                    got = group.pop_member(q, want)
+                items.extend(got)
+                self.deficits[k] -= len(got)
+                if len(got) < want:
+                    del self.deficits[k]
+                    ready.remove((q, w))
+                    self.open = False
+                elif self.deficits[k] == 0:
+                    self.open = False
+                progress = progress or got or len(got) < want
+            if not progress:
+                break
+        return items
+    
+
+POLICIES = {
+    'priority': StrictPriority,
+    'weighted': WeightedRoundRobin,
+    'deficit': DeficitRoundRobin,
+}
+
+def _members_changed(sender, instance, **kwargs):
+    """Drops the cached members of a group when they change."""
+    if isinstance(instance, QueueGroupItem):
+        QueueGroup.MEMBERS.pop(instance.group_id, None)
+    else:
+        QueueGroup.MEMBERS.pop(instance.pk, None)
+
+post_save.connect(_members_changed, sender=QueueGroupItem)
+post_delete.connect(_members_changed, sender=QueueGroupItem)
+post_delete.connect(_members_changed, sender=QueueGroup)
@@ -1,20 +1,24 @@
 
 """The Norc Scheduler is defined here.
 
-Norc requires that at least one of these is running at all times.
+Norc requires that at least one of these is running at all times.  Any
+number of them can run at once; each owns a share of the schedules.
 
 """
 
 import os
 import re
+import copy
+import itertools
 import signal
 import random
 import time
 from datetime import datetime, timedelta
-from threading import Thread, Event
-import itertools
+from threading import Thread, Event, Lock
 
 # from django.db.models.query import QuerySet
+from django.db import connection
+from django.contrib.contenttypes.models import ContentType
 from django.db.models import (Model, Manager,
     BooleanField,
     CharField,
@@ -26,14 +30,19 @@ from norc.core.models.task import Instance
 from norc.core.models.schedules import Schedule, CronSchedule
 from norc.core.models.daemon import AbstractDaemon
 from norc.core.constants import (Status, Request,
-    SCHEDULER_PERIOD, SCHEDULER_LIMIT, HEARTBEAT_PERIOD, HEARTBEAT_FAILED)
-from norc.norc_utils import search
-from norc.norc_utils.parallel import MultiTimer
+    SCHEDULER_PERIOD, SCHEDULER_LIMIT, SCHEDULER_LEASE,
+    HEARTBEAT_PERIOD, HEARTBEAT_FAILED)
+from norc.norc_utils import search, timestamp
+from norc.norc_utils.heap import ArrayHeap
 from norc.norc_utils.log import make_log
-from norc.norc_utils.django_extras import queryset_exists, get_object
-from norc.norc_utils.django_extras import QuerySetManager, MultiQuerySet
+from norc.norc_utils.django_extras import queryset_exists
+from norc.norc_utils.django_extras import (QuerySetManager,
+    IN_BULK_CHUNK, in_bulk, bulk_insert, bulk_update, bulk_generic_objects)
 from norc.norc_utils.backup import backup_log
 
+# The schedule models, indexed by the kind number of their heap entries.
+SCHEDULE_KINDS = [Schedule, CronSchedule]
+
 class Scheduler(AbstractDaemon):
     """Scheduling process for handling Schedules.
     
@@ -41,9 +50,20 @@ class Scheduler(AbstractDaemon):
     instance to a timer.  At the appropriate time, the instance is
     added to its queue and the Schedule is updated.
     
-    Idea: Split this up into two threads, one which continuously handles
-    already claimed schedules, the other which periodically polls the DB
-    for new schedules.
+    The main thread periodically claims new schedules in bulk, while the
+    timer thread fires claimed ones as they come due.  Claimed schedules
+    are only kept as (next_fire, kind, id) entries in an ArrayHeap, and
+    are loaded from the database in batches when they fire.
+    
+    Several Schedulers can run at once.  Live Schedulers are ordered by
+    id, and each only claims the unclaimed schedules whose id modulo
+    their number is its own position, releasing any others it holds
+    whenever the membership changes.  A claim lasts as long as its
+    Scheduler's heartbeat: once the heart fails, the other Schedulers
+    release the schedules so that they can be claimed again, and the
+    Scheduler itself stops firing after SCHEDULER_LEASE seconds without
+    a heartbeat, well before that can happen.  Schedules are checked to
+    still be claimed by this Scheduler as they fire.
     
     """
     class Meta:
@@ -87,16 +107,16 @@ class Scheduler(AbstractDaemon):
     
     def __init__(self, *args, **kwargs):
         AbstractDaemon.__init__(self, *args, **kwargs)
-        self.timer = MultiTimer()
-        self.set = set()
-    
-    def start(self):
-        """Starts the Scheduler."""
-        # Temporary check until multiple schedulers is supported fully.
-        if Scheduler.objects.alive().count() > 0:
-            print "Cannot run more than one scheduler at a time."
-            return
-        AbstractDaemon.start(self)
+        self.heap = ArrayHeap()
+        self.heap_lock = Lock()
+        self.timer = Thread(target=self.timer_run)
+        self.timer.daemon = True
+        self.timer.flag = Event()
+        # Held while firing, so that schedules aren't released mid-fire.
+        self.fire_lock = Lock()
+        # This Scheduler's (position, count) among the live Schedulers,
+        # or None to claim every unclaimed schedule.
+        self.partition = None
     
     def run(self):
         """Main run loop of the Scheduler."""
@@ -106,18 +126,10 @@ class Scheduler(AbstractDaemon):
             if self.request:
                 self.handle_request()
             
-            if self.status == Status.RUNNING:
-                # Clean up orphaned schedules and undead schedulers.
-                # Schedule.objects.orphaned().update(scheduler=None)
-                # CronSchedule.objects.orphaned().update(scheduler=None)
-                
-                cron = CronSchedule.objects.unclaimed()[:SCHEDULER_LIMIT]
-                simple = Schedule.objects.unclaimed()[:SCHEDULER_LIMIT]
-                for schedule in itertools.chain(cron, simple):
-                    self.log.info('Claiming %s.' % schedule)
-                    schedule.scheduler = self
-                    schedule.save()
-                    self.add(schedule)
+            if self.status == Status.RUNNING and self.has_lease():
+                self.reclaim()
+                self.rebalance()
+                self.claim()
             if not Status.is_final(self.status):
                 self.wait()
                 self.request = Scheduler.objects.get(pk=self.pk).request
@@ -126,8 +138,13 @@ class Scheduler(AbstractDaemon):
         """Waits on the flag."""
         AbstractDaemon.wait(self, SCHEDULER_PERIOD)
     
+    def has_lease(self):
+        """Whether this Scheduler's claims are still safe to act on."""
+        return self.last_beat != None and \
+            time.time() - self.last_beat < SCHEDULER_LEASE
+    
     def clean_up(self):
-        self.timer.cancel()
+        self.timer.flag.set()
         self.timer.join()
         cron = self.cronschedules.all()
         simple = self.schedules.all()
@@ -163,66 +180,319 @@ class Scheduler(AbstractDaemon):
             self.set_status(Status.KILLED)
         
         elif request == Request.RELOAD:
-            changed = MultiQuerySet(Schedule, CronSchedule)
-            changed = changed.objects.unfinished.filter(
-                changed=True, scheduler=self)
-            for item in self.timer.tasks:
-                s = item[2][0]
-                if s in changed:
-                    self.log.info("Removing outdated: %s" % s)
-                    self.timer.tasks.remove(item)
-                    self.set.remove(s)
-                s = type(s).objects.get(pk=s.pk)
-            for s in changed:
-                self.log.info("Adding updated: %s" % s)
-                self.add(s)
-            changed.update(changed=False)
-    
-    def add(self, schedule):
-        """Adds the schedule to the timer."""
-        try:
-            if schedule in self.set:
-                self.log.error("%s has already been added to this Scheduler." %
-                    schedule)
-                return
-            self.log.debug('Adding %s to timer for %s.' %
-                (schedule, schedule.next))
-            self.timer.add_task(schedule.next, self._enqueue, [schedule])
-            self.set.add(schedule)
-        except:
-            self.log.error(
-                "Invalid schedule %s found, deleting." % schedule)
-            schedule.soft_delete()
-    
-    def _enqueue(self, schedule):
-        """Called by the timer to add an instance to the queue."""
-        updated_schedule = get_object(type(schedule), pk=schedule.pk)
-        self.set.remove(schedule)
-        if updated_schedule == None or updated_schedule.deleted:
-            self.log.info('%s was removed.' % schedule)
-            if updated_schedule != None:
-                updated_schedule.scheduler = None
-                updated_schedule.save()
+            for kind, model in enumerate(SCHEDULE_KINDS):
+                changed = list(model.objects.unfinished.filter(
+                    changed=True, scheduler=self))
+                if not changed:
+                    continue
+                self.heap_lock.acquire()
+                try:
+                    self.heap.discard(set([(kind, s.pk) for s in changed]))
+                finally:
+                    self.heap_lock.release()
+                for s in changed:
+                    self.log.info("Reloading updated: %s" % s)
+                self.add(changed)
+                model.objects.filter(pk__in=[s.pk for s in changed]) \
+                    .update(changed=False)
+    
+    def reclaim(self):
+        """Releases the schedules of Schedulers whose hearts have failed."""
+        for model in SCHEDULE_KINDS:
+            dead = set(model.objects.orphaned().filter(scheduler__isnull=False)
+                .values_list('scheduler', flat=True))
+            if dead:
+                count = model.objects.filter(scheduler__in=dead) \
+                    .update(scheduler=None)
+                self.log.info('Released %s %ss of failed Schedulers %s.' %
+                    (count, model.__name__, ', '.join(map(str, sorted(dead)))))
+    
+    def rebalance(self):
+        """Finds this Scheduler's partition among the live Schedulers.
+        
+        When it changes, claimed schedules that now belong to another
+        partition are taken off the timer and released.
+        
+        """
+        members = list(Scheduler.objects.alive().order_by('id')
+            .values_list('id', flat=True))
+        if not self.id in members:
+            members = sorted(members + [self.id])
+        partition = (members.index(self.id), len(members))
+        if partition == self.partition:
             return
-        schedule = updated_schedule
+        self.partition = partition
+        self.log.info('Claiming partition %s of %s.' %
+            (partition[0] + 1, partition[1]))
+        for kind, model in enumerate(SCHEDULE_KINDS):
+            # Locked so a schedule isn't released partway through firing.
+            self.fire_lock.acquire()
+            try:
+                pks = list(self._in_partition(model.objects.filter(
+                    scheduler=self), False).values_list('id', flat=True))
+                if not pks:
+                    continue
+                self.heap_lock.acquire()
+                try:
+                    self.heap.discard(set([(kind, pk) for pk in pks]))
+                finally:
+                    self.heap_lock.release()
+                for i in range(0, len(pks), IN_BULK_CHUNK):
+                    model.objects.filter(pk__in=pks[i:i + IN_BULK_CHUNK],
+                        scheduler=self).update(scheduler=None)
+            finally:
+                self.fire_lock.release()
+            self.log.info('Released %s %ss to other Schedulers.' %
+                (len(pks), model.__name__))
+    
+    def _in_partition(self, queryset, inside=True):
+        """Filters a schedule queryset by this Scheduler's partition."""
+        if not self.partition or self.partition[1] < 2:
+            return queryset if inside else queryset.none()
+        column = '%s.%s' % (
+            connection.ops.quote_name(queryset.model._meta.db_table),
+            connection.ops.quote_name('id'))
+        return queryset.extra(where=['%s %%%% %%s %s %%s' %
+            (column, '=' if inside else '!=')],
+            params=[self.partition[1], self.partition[0]])
+    
+    def claim(self):
+        """Claims unclaimed schedules and adds them to the timer.
+        
+        Only schedules in this Scheduler's partition are claimed,
+        SCHEDULER_LIMIT at a time, with an UPDATE that only touches rows
+        which are still unclaimed, so concurrent claims can't both
+        succeed, until there are none left.
+        
+        """
+        for model in SCHEDULE_KINDS:
+            while True:
+                pks = list(self._in_partition(model.objects.unclaimed())
+                    .values_list('id', flat=True)[:SCHEDULER_LIMIT])
+                if not pks:
+                    break
+                for i in range(0, len(pks), IN_BULK_CHUNK):
+                    model.objects.filter(pk__in=pks[i:i + IN_BULK_CHUNK],
+                        scheduler__isnull=True).update(scheduler=self)
+                claimed = in_bulk(model.objects.filter(scheduler=self), pks)
+                self.log.info('Claimed %s %ss.' %
+                    (len(claimed), model.__name__))
+                self.add(claimed.values())
+                if len(pks) < SCHEDULER_LIMIT:
+                    break
+    
+    def add(self, schedules):
+        """Adds schedules to the timer."""
+        entries = []
+        for schedule in schedules:
+            try:
+                # Formatting a schedule fetches its task, so don't
+                # unless the message will actually be logged.
+                if self.log.debug_on:
+                    self.log.debug('Adding %s to timer for %s.' %
+                        (schedule, schedule.next))
+                entries.append((timestamp(schedule.next),
+                    SCHEDULE_KINDS.index(type(schedule)), schedule.pk))
+            except Exception:
+                self.log.error(
+                    "Invalid schedule %s found, deleting." % schedule)
+                schedule.soft_delete()
+        self._push(entries)
+    
+    def _push(self, entries):
+        """Pushes heap entries, waking the timer if one is now first."""
+        self.heap_lock.acquire()
+        try:
+            first = self.heap.peek()
+            self.heap.push_many(entries)
+            if self.heap.peek() != first:
+                # Wake the timer so it doesn't oversleep the new entry.
+                self.timer.flag.set()
+        finally:
+            self.heap_lock.release()
+    
+    def timer_run(self):
+        """Method to be run by the timer thread."""
+        while not Status.is_final(self.status):
+            now = time.time()
+            self.heap_lock.acquire()
+            try:
+                due = self.heap.pop_due(now, SCHEDULER_LIMIT)
+                head = self.heap.peek()
+            finally:
+                self.heap_lock.release()
+            if due and not self.has_lease():
+                # Without a heartbeat, the schedules may already be
+                # claimed elsewhere; hold them until the heart recovers.
+                self.log.error("Heartbeat lost; not firing %s schedules." %
+                    len(due))
+                self._push(due)
+                self.timer.flag.wait(HEARTBEAT_PERIOD)
+                self.timer.flag.clear()
+            elif due:
+                self.fire_lock.acquire()
+                try:
+                    try:
+                        self.fire(due)
+                    except Exception:
+                        # Nothing was enqueued; see _enqueue().
+                        self.log.error("Failed to fire %s schedules; "
+                            "retrying them." % len(due), trace=True)
+                        self._push_later(due)
+                finally:
+                    self.fire_lock.release()
+            else:
+                wait = SCHEDULER_PERIOD
+                if head:
+                    wait = min(wait, head[0] - now)
+                self.timer.flag.wait(wait)
+                self.timer.flag.clear()
+    
+    def fire(self, due):
+        """Enqueues instances for a batch of due heap entries.
+        
+        The schedules are loaded with one query per kind, and an entry
+        duplicated within the batch only fires once.
         
-        if not schedule.scheduler == self:
-            self.log.info("%s is no longer tied to this Scheduler." %
-                schedule)
-            # self.set.remove(schedule)
+        """
+        pks_by_kind = {}
+        seen = set()
+        for _, kind, pk in due:
+            if not (kind, pk) in seen:
+                seen.add((kind, pk))
+                pks_by_kind.setdefault(kind, []).append(pk)
+        ready = []
+        for kind, pks in pks_by_kind.iteritems():
+            model = SCHEDULE_KINDS[kind]
+            schedules = in_bulk(model.objects, pks)
+            removed = []
+            for pk in pks:
+                schedule = schedules.get(pk)
+                if schedule == None or schedule.deleted:
+                    self.log.info('[%s #%s] was removed.' %
+                        (model.__name__, pk))
+                    if schedule != None:
+                        removed.append(pk)
+                elif not schedule.scheduler_id == self.id:
+                    self.log.info("%s is no longer tied to this Scheduler." %
+                        schedule)
+                else:
+                    ready.append(schedule)
+            if removed:
+                model.objects.filter(pk__in=removed).update(scheduler=None)
+        if ready:
+            self._enqueue(ready)
+    
+    def _enqueue(self, schedules):
+        """Adds an instance of each due schedule to its queue.
+        
+        The schedules are advanced and saved with one statement per
+        schedule type, and then their instances are inserted together
+        and pushed with one push_many() per queue, so firing thousands of
+        schedules in the same second costs a handful of queries rather
+        than thousands.  A schedule that can't be advanced is skipped.
+        Schedules that can't be saved, or whose instances can't be
+        enqueued, are put back as they were and retried after
+        SCHEDULER_PERIOD, so a failure neither loses them nor fires them
+        twice.
+        
+        """
+        now = datetime.utcnow()
+        advanced = []
+        originals = []
+        for s in schedules:
+            original = copy.copy(s)
+            try:
+                s.advance(now)
+            except Exception:
+                self.log.error("Failed to advance %s; skipping it." % s,
+                    trace=True)
+                continue
+            if s.finished():
+                s.scheduler = None
+            advanced.append(s)
+            originals.append(original)
+        if not self._save(advanced):
+            self._retry(originals)
+            return
+        by_queue = {}
+        for s, original in zip(advanced, originals):
+            by_queue.setdefault((s.queue_type_id, s.queue_id), []) \
+                .append((s, original))
+        keys = by_queue.keys()
+        try:
+            queues = bulk_generic_objects(keys)
+            instances = [Instance(task_type_id=s.task_type_id,
+                task_id=s.task_id, schedule_id=s.pk,
+                schedule_type=ContentType.objects.get_for_model(s))
+                for s, _ in itertools.chain(*[by_queue[k] for k in keys])]
+            bulk_insert(instances)
+        except Exception:
+            self.log.error("Failed to create instances.", trace=True)
+            self._undo(advanced, originals)
             return
-        instance = Instance.objects.create(
-            task=schedule.task, schedule=schedule)
-        self.log.info('Enqueuing %s.' % instance)
-        schedule.queue.push(instance)
-        schedule.enqueued()
-        if not schedule.finished():
-            self.add(schedule)
+        fired = []
+        failed = []
+        i = 0
+        for key, queue in zip(keys, queues):
+            batch = by_queue[key]
+            pushed = instances[i:i + len(batch)]
+            i += len(batch)
+            if queue == None:
+                self.log.error("Queue for %s instances no longer exists." %
+                    len(batch))
+                fired.extend(batch)
+                continue
+            try:
+                queue.push_many(pushed)
+            except Exception:
+                self.log.error("Failed to push %s instances to %s." %
+                    (len(batch), queue), trace=True)
+                Instance.objects.filter(
+                    pk__in=[p.pk for p in pushed]).delete()
+                failed.extend(batch)
+            else:
+                self.log.info('Enqueued %s instances to %s.' %
+                    (len(batch), queue))
+                fired.extend(batch)
+        if failed:
+            self._undo([s for s, _ in failed], [o for _, o in failed])
+        self.add([s for s, _ in fired if not s.finished()])
+    
+    def _save(self, schedules):
+        """Saves advanced schedules, returning whether that worked."""
+        by_model = {}
+        for s in schedules:
+            by_model.setdefault(type(s), []).append(s)
+        try:
+            for model, changed in by_model.iteritems():
+                bulk_update(changed, model.ADVANCED_FIELDS)
+        except Exception:
+            self.log.error("Failed to save %s schedules." % len(schedules),
+                trace=True)
+            return False
+        return True
+    
+    def _undo(self, advanced, originals):
+        """Puts back schedules that were saved but not enqueued."""
+        if self._save(originals):
+            self._retry(originals)
         else:
-            schedule.scheduler = None
-            schedule.save()
+            # They can't fire again without firing twice.
+            self.log.error("Skipping a run of %s schedules." % len(advanced))
+            self.add([s for s in advanced if not s.finished()])
+    
+    def _retry(self, schedules):
+        """Fires schedules again after SCHEDULER_PERIOD."""
+        self._push_later([(None, SCHEDULE_KINDS.index(type(s)), s.pk)
+            for s in schedules])
+    
+    def _push_later(self, entries):
+        """Pushes heap entries back to be fired after SCHEDULER_PERIOD."""
+        retry = time.time() + SCHEDULER_PERIOD
+        self._push([(retry, kind, pk) for _, kind, pk in entries])
     
     @property
     def log_path(self):
         return 'schedulers/scheduler-%s' % self.id
-    
+
@@ -2,6 +2,8 @@
 import re
 import random
 import time
+import bisect
+from array import array
 from datetime import datetime, timedelta
 
 from django.db.models import (Model, Manager, Q,
@@ -16,9 +18,10 @@ from django.contrib.contenttypes.generic import GenericForeignKey
 
 from norc.core.constants import HEARTBEAT_FAILED, Request
 from norc.core.models.task import Instance
-from norc.norc_utils import search
+from norc.norc_utils import search, timestamp
 from norc.norc_utils.django_extras import QuerySetManager
 from norc.norc_utils.parallel import MultiTimer
+from norc.norc_utils.cron import CompiledCron
 from norc.norc_utils.log import make_log
 
 
@@ -82,10 +85,41 @@ class AbstractSchedule(Model):
         return Instance.objects.filter(
             schedule_type__pk=schedule_type.pk, schedule_id=self.id)
     
+    # The fields that advance() changes, along with scheduler.
+    ADVANCED_FIELDS = ['remaining', 'scheduler']
+    
     def enqueued(self):
         """Called when the next instance has been enqueued."""
         raise NotImplementedError
     
+    def advance(self, now):
+        """Moves the schedule past an execution without saving.
+        
+        The caller must make sure the schedule is up to date, since this
+        reads nothing from the database.
+        
+        """
+        raise NotImplementedError
+    
+    def fire_times(self, start, end, cache=None):
+        """The times this schedule will fire from start up to end.
+        
+        Times are returned as an array('l') of UTC timestamps in seconds,
+        in order.  Runs that are already overdue at start are counted
+        then: only the first, or all of them if the schedule makes up
+        missed runs.  cache is a dict that fire_times() shares between
+        schedules so they can share work.
+        
+        """
+        raise NotImplementedError
+    
+    def _overdue(self, missed):
+        """How many of missed overdue runs will happen at once."""
+        overdue = missed if self.make_up else min(missed, 1)
+        if self.repetitions > 0:
+            overdue = min(overdue, self.remaining)
+        return overdue
+    
     def finished(self):
         """Checks whether all runs of the Schedule have been completed."""
         return self.remaining == 0 and self.repetitions > 0
@@ -115,6 +149,8 @@ class Schedule(AbstractSchedule):
     # The delay in between executions.
     period = PositiveIntegerField()
     
+    ADVANCED_FIELDS = AbstractSchedule.ADVANCED_FIELDS + ['next']
+    
     @staticmethod
     def create(task, queue, period=0, reps=1, start=0, make_up=False):
         if type(start) == int:
@@ -126,12 +162,16 @@ class Schedule(AbstractSchedule):
     
     def enqueued(self):
         """Called when the next instance has been enqueued."""
-        now = datetime.utcnow()
+        self.period = Schedule.objects.get(pk=self.pk).period
+        self.advance(datetime.utcnow())
+        self.save()
+    
+    def advance(self, now):
+        """Counts down the repetitions and moves next past now."""
         # Sanity check: this method should never be called before self.next.
         assert self.next < now, "Enqueued too early!"
         if self.repetitions > 0:
             self.remaining -= 1
-        self.period = Schedule.objects.get(pk=self.pk).period
         if not self.finished() and self.period > 0:
             period = timedelta(seconds=self.period)
             self.next += period
@@ -139,7 +179,36 @@ class Schedule(AbstractSchedule):
                 self.next += period
         elif self.finished():
             self.next = None
-        self.save()
+    
+    def fire_times(self, start, end, cache=None):
+        """The times this schedule will fire from start up to end.
+        
+        Runs fall on next plus a multiple of the period, so they are
+        computed by arithmetic alone.
+        
+        """
+        times = array('l')
+        if self.deleted or self.finished() or self.next == None:
+            return times
+        first, start, end = [int(timestamp(dt))
+            for dt in (self.next, start, end)]
+        left = self.remaining if self.repetitions > 0 else None
+        if self.period == 0:
+            # Every run is due at once.
+            if first < end:
+                times.extend([max(first, start)] * (left or 1))
+            return times
+        if first < start:
+            missed = (start - first - 1) // self.period + 1
+            overdue = self._overdue(missed)
+            times.extend([start] * overdue)
+            first += missed * self.period
+            if left != None:
+                left -= overdue
+        if left != None:
+            end = min(end, first + left * self.period)
+        times.extend(xrange(first, end, self.period))
+        return times
     
     def __unicode__(self):
         return u'[Schedule #%s, %s:%ss]' % \
@@ -147,6 +216,36 @@ class Schedule(AbstractSchedule):
     
     __repr__ = __unicode__
 
+def fire_times(schedules, start, end):
+    """Finds when each of many schedules will fire from start up to end.
+    
+    schedules can be any iterable of schedules, such as a queryset, and
+    a list of (schedule, times) pairs is returned, where times is as
+    returned by the schedule's fire_times().  Work is shared between
+    schedules where possible.
+    
+    """
+    cache = {}
+    return [(s, s.fire_times(start, end, cache)) for s in schedules]
+
+def queue_load(schedules, start, end, bucket=60):
+    """Predicts how many instances each queue will receive over time.
+    
+    Returns a dict keyed by (queue_type_id, queue_id) of dicts mapping
+    the UTC timestamp at the start of each bucket of the given number
+    of seconds to the number of instances enqueued within it.
+    
+    """
+    load = {}
+    for s, times in fire_times(schedules, start, end):
+        if not times:
+            continue
+        counts = load.setdefault((s.queue_type_id, s.queue_id), {})
+        for t in times:
+            t -= t % bucket
+            counts[t] = counts.get(t, 0) + 1
+    return load
+
 ri = random.randint
 
 def _make_halfhourly():
@@ -200,6 +299,12 @@ class CronSchedule(AbstractSchedule):
     
     FIELDS = ['months', 'days', 'daysofweek', 'hours', 'minutes', 'seconds']
     
+    ADVANCED_FIELDS = AbstractSchedule.ADVANCED_FIELDS + ['base']
+    
+    # Compiled encodings by encoding string, shared by every schedule
+    # with the same encoding.
+    COMPILED = {}
+    
     MAKE_PREDEFINED = {
         'HALFHOURLY': _make_halfhourly,
         'HOURLY': _make_hourly,
@@ -266,6 +371,16 @@ class CronSchedule(AbstractSchedule):
             SYNS[k][1] else ','.join(map(str, results[k])) for k in 'odwhms'])
         return new_encoding, results
     
+    @staticmethod
+    def compile(encoding):
+        """The CompiledCron for an encoding, from the cache if possible."""
+        compiled = CronSchedule.COMPILED.get(encoding)
+        if compiled == None:
+            d = CronSchedule.validate(encoding)[1]
+            compiled = CompiledCron(*[d[k] for k in 'odwhms'])
+            CronSchedule.COMPILED[encoding] = compiled
+        return compiled
+    
     def __init__(self, *args, **kwargs):
         AbstractSchedule.__init__(self, *args, **kwargs)
         self._next = None
@@ -293,7 +408,12 @@ class CronSchedule(AbstractSchedule):
     
     def enqueued(self):
         """Called when the next instance has been enqueued."""
-        now = datetime.utcnow()
+        self.advance(datetime.utcnow())
+        self.encoding = CronSchedule.objects.get(pk=self.pk).encoding
+        self.save()
+    
+    def advance(self, now):
+        """Counts down the repetitions and moves the base up."""
         # Sanity check: this method should never be called before self.next.
         assert self.next < now, "Enqueued too early!"
         if self.repetitions > 0:
@@ -304,8 +424,6 @@ class CronSchedule(AbstractSchedule):
             else:
                 self.base = now
         self._next = None # Don't calculate now, but clear the old value.
-        self.encoding = CronSchedule.objects.get(pk=self.pk).encoding
-        self.save()
     
     @property
     def next(self):
@@ -319,39 +437,59 @@ class CronSchedule(AbstractSchedule):
         return self._next
     
     def calculate_next(self, dt=None):
-        if not hasattr(self, "months"):
-            self.set_lists()
-        if not dt:
-            dt = self.base
-        dt = dt.replace(microsecond=0)
-        dt += timedelta(seconds=1)
-        second = self.find_gte(dt.second, self.seconds)
-        if second == None:
-            second = self.seconds[0]
-            dt += timedelta(minutes=1)
-        dt = dt.replace(second=second)
-        minute = self.find_gte(dt.minute, self.minutes)
-        if minute == None:
-            minute = self.minutes[0]
-            dt += timedelta(hours=1)
-        dt = dt.replace(minute=minute)
-        hour = self.find_gte(dt.hour, self.hours)
-        if hour == None:
-            hour = self.hours[0]
-            dt += timedelta(days=1)
-        dt = dt.replace(hour=hour)
-        cond = lambda d: d.day in self.days and d.weekday() in self.daysofweek
-        one_day = timedelta(days=1)
-        while not cond(dt):
-            dt += one_day
-        return dt
-    
-    def find_gte(self, p, ls):
-        """Return the first element of ls that is >= p."""
-        # TODO: Binary search.
-        for e in ls:
-            if e >= p:
-                return e
+        """The first fire time after dt, which defaults to base.
+        
+        Returns None if the encoding can never fire.
+        
+        """
+        return CronSchedule.compile(self.encoding).next_after(dt or self.base)
+    
+    def next_fires(self, n, dt=None):
+        """The next n fire times after dt, which defaults to base."""
+        return CronSchedule.compile(self.encoding).next_fires(
+            dt or self.base, n)
+    
+    def fire_times(self, start, end, cache=None):
+        """The times this schedule will fire from start up to end.
+        
+        Every schedule with the same encoding fires at the same times
+        once it is past its base, so these are found once per encoding
+        and cached.
+        
+        """
+        times = array('l')
+        if self.deleted or self.finished() or self.next == None:
+            return times
+        if cache == None:
+            cache = {}
+        window = cache.get(self.encoding)
+        if window == None:
+            window = array('l', [int(timestamp(dt)) for dt in
+                CronSchedule.compile(self.encoding).fires_between(start, end)])
+            cache[self.encoding] = window
+        first = int(timestamp(self.next))
+        start = int(timestamp(start))
+        if first < start:
+            missed = 1
+            if self.make_up:
+                missed += len(CronSchedule.compile(self.encoding)
+                    .fires_between(self.next + timedelta(seconds=1),
+                        datetime.utcfromtimestamp(start)))
+            overdue = self._overdue(missed)
+            times.extend([start] * overdue)
+            # Then the base moves up to the last missed run, or to start.
+            if self.make_up:
+                i = bisect.bisect_left(window, start)
+            else:
+                i = bisect.bisect_right(window, start)
+        else:
+            overdue = 0
+            i = bisect.bisect_left(window, first)
+        if self.repetitions > 0:
+            times.extend(window[i:i + self.remaining - overdue])
+        else:
+            times.extend(window[i:])
+        return times
     
     def pretty_name(self):
         """Returns the pretty (predefined) name for this schedule."""
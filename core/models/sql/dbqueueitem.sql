@@ -0,0 +1 @@
+CREATE INDEX norc_dbqueueitem_pop ON norc_dbqueueitem (dbqueue_id, priority DESC, id);
@@ -168,7 +168,10 @@ class AbstractInstance(Model):
             signal.signal(signal.SIGALRM, self.timeout_handler)
             signal.alarm(self.timeout)
         self.log.info('Starting %s.' % self)
-        self.log.start_redirect()
+        if settings.LOG_CAPTURE == 'fd':
+            self.log.start_capture()
+        else:
+            self.log.start_redirect()
         self.status = Status.RUNNING
         self.revision = self.get_revision()
         self.started = datetime.utcnow()
@@ -204,6 +207,7 @@ class AbstractInstance(Model):
         self.log.info("Task ended with status %s." %
             Status.name(self.status))
         self.log.stop_redirect()
+        self.log.flush()
     
     def run(self):
         """Runs the instance."""
@@ -231,6 +235,8 @@ class AbstractInstance(Model):
     
     def _nuke(self, *args, **kwargs):
         self.log.info("Ceasing execution.")
+        # os._exit skips atexit, so buffered messages must go out now.
+        self.log.flush()
         os._exit(1)
     
     def get_revision(self):
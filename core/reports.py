@@ -198,14 +198,30 @@ class schedulers(BaseReport):
 #     total = instances.count()
 #     return '%.2f%%' % (100.0 * failed / total) if total > 0 else 'n/a'
 
+def _queue_items(queue):
+    """The items waiting in a queue, loaded in bulk a page at a time."""
+    if isinstance(queue, QueueGroup):
+        ids = [q.id for q in queue.queues if isinstance(q, DBQueue)]
+    elif isinstance(queue, DBQueue):
+        ids = [queue.id]
+    else:
+        return []
+    return DBQueueItem.objects.filter(dbqueue__id__in=ids,
+        claim__isnull=True).select_related('dbqueue').with_items()
+
 class queues(BaseReport):
     
     get = Queue.get
     get_all = Queue.all_queues
     order_by = lambda data, o: sorted(data, key=lambda v: v.name)
     
+    details = {
+        'queue_items': lambda id, **kws: _queue_items(_parse_content_ids(id)),
+    }
     headers = ['Name', 'Type', 'Items', 'Executors']
     data = {
+        'id': lambda obj, **kws: '%s_%s' %
+            (ContentType.objects.get_for_model(obj).id, obj.id),
         'type': lambda obj, **kws: type(obj).__name__,
         'items': lambda obj, **kws: obj.count(),
         'executors': lambda obj, **kws:
@@ -213,6 +229,15 @@ class queues(BaseReport):
         # 'failure_rate': _queue_failure_rate,
     }
 
+class queue_items(BaseReport):
+    
+    headers = ['ID', 'Item', 'Type', 'Queue', 'Enqueued']
+    data = {
+        'item': lambda qi, **kws: qi.item,
+        'type': lambda qi, **kws: type(qi.item).__name__,
+        'queue': lambda qi, **kws: qi.dbqueue.name,
+    }
+
 class tasks(BaseReport):
     
     get_all = lambda: reduce(lambda a, b: a + b,
@@ -5,6 +5,12 @@ from schedule_test import *
 from scheduler_test import *
 from executor_test import *
 from queue_test import *
+from notify_test import *
+from worker_test import *
+from log_test import *
+from backup_test import *
 
 from norc import settings
+if settings.BACKUP_SYSTEM == 'AmazonS3':
+    from s3_test import S3BackupTest
 settings.BACKUP_SYSTEM = None
@@ -0,0 +1,139 @@
+"""Tests for streaming log backups."""
+
+import os
+import time
+import zlib
+import shutil
+import tempfile
+from threading import Event
+from cStringIO import StringIO
+
+from django.test import TestCase
+
+from norc.norc_utils import backup, log, wait_until
+
+class CompressedPartsTest(TestCase):
+    """Tests splitting a compressed file into upload parts."""
+    
+    def setUp(self):
+        self.chunk_size = backup.CHUNK_SIZE
+        backup.CHUNK_SIZE = 1000
+    
+    def parts(self, data, part_size):
+        return list(backup.compressed_parts(StringIO(data), part_size))
+    
+    def test_round_trip(self):
+        data = os.urandom(10000)
+        parts = self.parts(data, 3000)
+        self.assertEqual(zlib.decompress(''.join(parts)), data)
+        self.assertTrue(len(parts) > 3)
+        self.assertEqual(set(map(len, parts[:-1])), set([3000]))
+        self.assertTrue(0 < len(parts[-1]) <= 3000)
+    
+    def test_small(self):
+        """Test that something small, or empty, is one part."""
+        for data in ['', 'line\n' * 100]:
+            parts = self.parts(data, 3000)
+            self.assertEqual(len(parts), 1)
+            self.assertEqual(zlib.decompress(parts[0]), data)
+    
+    def test_streaming(self):
+        """Test that parts come out before the whole file is read."""
+        data = StringIO(os.urandom(500000))
+        parts = backup.compressed_parts(data, 3000)
+        parts.next()
+        self.assertTrue(data.tell() < 100000)
+    
+    def tearDown(self):
+        backup.CHUNK_SIZE = self.chunk_size
+
+class BackupPoolTest(TestCase):
+    """Tests backing logs up in the background."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old = backup.NORC_LOG_DIR, backup.backup_log
+        backup.NORC_LOG_DIR = self.dir
+        backup.backup_log = self.backup_log
+        self.index = os.path.join(self.dir, 'pending')
+        self.uploaded = []
+        self.go = Event()
+        self.go.set()
+        self.pools = []
+    
+    def backup_log(self, path):
+        self.go.wait()
+        self.uploaded.append(path)
+        return True
+    
+    def pool(self, threads=2, limit=100):
+        pool = backup.BackupPool(threads, limit, log.Log(os.devnull),
+            self.index)
+        self.pools.append(pool)
+        return pool
+    
+    def logs(self, n):
+        paths = ['log%s' % i for i in range(n)]
+        for p in paths:
+            open(os.path.join(self.dir, p), 'w').write('x' * 100)
+        return paths
+    
+    def test_upload(self):
+        pool = self.pool()
+        paths = self.logs(20)
+        for p in paths:
+            pool.add(p)
+        wait_until(lambda: pool.metrics()['uploaded'] == 20, 5, 0.01)
+        self.assertEqual(sorted(self.uploaded), sorted(paths))
+        metrics = pool.metrics()
+        self.assertEqual(metrics['pending'] + metrics['in_flight'], 0)
+        self.assertEqual(metrics['bytes_per_sec'],
+            2000.0 / pool.RATE_WINDOW)
+    
+    def test_failure(self):
+        pool = self.pool()
+        pool.add('missing')
+        wait_until(lambda: pool.metrics()['failed'] == 1, 5, 0.01)
+    
+    def test_spill(self):
+        """Test that a backlog past the limit waits on disk."""
+        self.go.clear()
+        pool = self.pool(threads=1, limit=2)
+        paths = self.logs(10)
+        for p in paths:
+            pool.add(p)
+        metrics = pool.metrics()
+        self.assertTrue(metrics['pending'] <= 2)
+        # The thread may have taken up to two before blocking on upload.
+        self.assertTrue(metrics['in_flight'] <= 2)
+        self.assertEqual(metrics['pending'] + metrics['in_flight'] +
+            metrics['spilled'], 10)
+        self.go.set()
+        wait_until(lambda: len(self.uploaded) == 10, 5, 0.01)
+        self.assertEqual(sorted(self.uploaded), sorted(paths))
+        self.assertEqual(pool.metrics()['spilled'], 0)
+    
+    def test_close(self):
+        """Test that closing doesn't wait on a stuck backlog for long."""
+        self.go.clear()
+        pool = self.pool(threads=1)
+        paths = self.logs(5)
+        for p in paths:
+            pool.add(p)
+        start = time.time()
+        self.assertEqual(pool.close(0.2), 5)
+        self.assertTrue(time.time() - start < 1)
+        # The next pool on the host picks up where this one left off.
+        self.uploaded = []
+        self.go.set()
+        self.pool()
+        wait_until(lambda: len(set(self.uploaded)) == 5, 5, 0.01)
+        self.assertEqual(sorted(set(self.uploaded)), sorted(paths))
+    
+    def tearDown(self):
+        self.go.set()
+        for pool in self.pools:
+            pool.close(1)
+        backup.NORC_LOG_DIR, backup.backup_log = self.old
+        shutil.rmtree(self.dir)
+
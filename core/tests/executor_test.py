@@ -2,13 +2,18 @@
 """Module for testing anything related to executors."""
 
 import os
+import signal
+from datetime import datetime, timedelta
 from threading import Thread
+from subprocess import Popen
 
 from django.test import TestCase
 
-from norc.core.models import Executor, DBQueue, CommandTask, Instance
-from norc.core.constants import Status, Request
+from norc.core.models import (Executor, DBQueue, QueueGroup,
+    QueueGroupItem, CommandTask, Instance)
+from norc.core.constants import Status, Request, HEARTBEAT_FAILED
 from norc.norc_utils import wait_until, log
+from norc.norc_utils.testing import make_task
 
 class ExecutorTest(TestCase):
     """Tests for a Norc executor."""
@@ -32,7 +37,7 @@ class ExecutorTest(TestCase):
         self.executor.make_request(Request.STOP)
         wait_until(lambda: Status.is_final(self.executor.status), 5)
         self.assertEqual(self.executor.status, Status.ENDED)
-        
+    
     def test_kill(self):
         self.thread.start()
         wait_until(lambda: self.executor.status == Status.RUNNING, 3)
@@ -72,3 +77,142 @@ class ExecutorTest(TestCase):
         self._executor.heart.join(7)
         assert not self.thread.isAlive()
         assert not self._executor.heart.isAlive()
+
+class ReapTest(TestCase):
+    """Tests the collection of finished instance processes."""
+    
+    def setUp(self):
+        self.queue = DBQueue.objects.create(name='test')
+        self.executor = Executor.objects.create(queue=self.queue,
+            concurrent=4, status=Status.RUNNING)
+        self.executor.log = log.Log(os.devnull)
+        self.task = make_task()
+    
+    def start(self, command, status):
+        p = Popen(command, shell=True)
+        p.instance = Instance.objects.create(task=self.task, status=status)
+        self.executor.processes[p.pid] = p
+        return p
+    
+    def reap(self, n):
+        wait_until(lambda: len(self.executor.reap()) == n, 5, 0.05)
+        return self.executor.reap()
+    
+    def test_reap(self):
+        p1 = self.start('exit 0', Status.SUCCESS)
+        p2 = self.start('exit 3', Status.FAILURE)
+        self.start('sleep 5', Status.RUNNING)
+        finished = self.reap(2)
+        self.assertEqual(set(finished), set([p1, p2]))
+        self.assertEqual(p1.returncode, 0)
+        self.assertEqual(p2.returncode, 3)
+    
+    def test_other_children(self):
+        """Test that children the Executor didn't start are left alone."""
+        other = Popen('exit 4', shell=True)
+        p = self.start('sleep 0.2', Status.SUCCESS)
+        self.assertEqual(self.reap(1), [p])
+        self.assertEqual(other.wait(), 4)
+    
+    def test_finish_instances(self):
+        good = self.start('exit 0', Status.SUCCESS)
+        bad = self.start('exit 1', Status.RUNNING)
+        self.executor.finish_instances(self.reap(2))
+        self.assertEqual(self.executor.processes, {})
+        self.assertEqual(Instance.objects.get(pk=good.instance.pk).status,
+            Status.SUCCESS)
+        self.assertEqual(Instance.objects.get(pk=bad.instance.pk).status,
+            Status.ERROR)
+        self.assertEqual(self.executor.status, Status.RUNNING)
+    
+    def test_suspend(self):
+        self.start('exit 1', Status.CREATED)
+        self.executor.finish_instances(self.reap(1))
+        self.assertEqual(Executor.objects.get(pk=self.executor.pk).status,
+            Status.SUSPENDED)
+    
+    def test_ack_finished(self):
+        """Test that finished instances are removed from the queue."""
+        p = self.start('exit 0', Status.SUCCESS)
+        self.queue.push(p.instance)
+        p.instance = self.queue.pop()
+        self.executor.finish_instances(self.reap(1))
+        self.assertEqual(self.queue.items.count(), 0)
+    
+    def test_redeliver(self):
+        """Test that only instances of lost Executors are rerun."""
+        cutoff = datetime.utcnow() - timedelta(seconds=HEARTBEAT_FAILED)
+        lost = Executor.objects.create(queue=self.queue, concurrent=1,
+            status=Status.RUNNING, heartbeat=cutoff - timedelta(seconds=1))
+        alive = Executor.objects.create(queue=self.queue, concurrent=1,
+            status=Status.RUNNING, heartbeat=datetime.utcnow())
+        self.queue.push_many([
+            Instance.objects.create(task=self.task, executor=lost,
+                status=Status.SUCCESS),
+            Instance.objects.create(task=self.task, executor=alive,
+                status=Status.RUNNING),
+            Instance.objects.create(task=self.task, executor=lost,
+                status=Status.RUNNING)])
+        done, busy, orphan = self.queue.pop_many(3)
+        self.assertFalse(self.executor.redeliver(done))
+        self.assertFalse(self.executor.redeliver(busy))
+        self.assertTrue(self.executor.redeliver(orphan))
+        self.assertEqual(orphan.status, Status.CREATED)
+        self.assertEqual(orphan.started, None)
+        self.assertEqual(self.queue.items.count(), 1)
+    
+    def test_beat_release(self):
+        """Test that expired leases are released at most every half lease."""
+        self.queue.push(Instance.objects.create(task=self.task))
+        expire = lambda: self.queue.items.update(
+            claim='x', lease_expires=datetime.utcnow())
+        expire()
+        self.executor.beat()
+        self.assertEqual(self.queue.count(), 1)
+        expire()
+        self.executor.beat()
+        self.assertEqual(self.queue.count(), 0)
+        self.executor.next_release = 0
+        self.executor.beat()
+        self.assertEqual(self.queue.count(), 1)
+        group = QueueGroup.objects.create(name='group')
+        self.executor.queue = group
+        QueueGroup.MEMBERS.clear()
+        self.assertFalse(self.executor.pops_dbqueues())
+        QueueGroupItem.objects.create(group=group, queue=self.queue,
+            priority=1)
+        QueueGroup.MEMBERS.clear()
+        self.assertTrue(self.executor.pops_dbqueues())
+    
+    def test_sigchld_wakeup(self):
+        """Test that SIGCHLD wakes the executor through its pipe."""
+        self.executor.child_pipe = os.pipe()
+        waker = Thread(target=self.executor.wake_on_sigchld)
+        waker.start()
+        self.executor.sigchld_handler(signal.SIGCHLD)
+        wait_until(self.executor.flag.isSet, 2)
+        os.close(self.executor.child_pipe[1])
+        waker.join(2)
+        self.assertFalse(waker.isAlive())
+    
+    def test_redeliver_running(self):
+        """Test that an instance still running here isn't run again."""
+        p = self.start('sleep 5', Status.RUNNING)
+        self.queue.push(p.instance)
+        p.instance = self.queue.pop()
+        # Let the lease run out so the instance is popped again.
+        self.queue.items.update(lease_expires=datetime.utcnow())
+        DBQueue.release_expired()
+        again = self.queue.pop()
+        self.assertFalse(self.executor.redeliver(again))
+        self.assertTrue(p.instance is again)
+        self.assertTrue(self.queue.items.get().lease_expires >
+            datetime.utcnow() + timedelta(seconds=1))
+        self.queue.ack([p.instance])
+        self.assertEqual(self.queue.items.count(), 0)
+    
+    def tearDown(self):
+        for p in self.executor.processes.values():
+            if p.returncode == None:
+                p.kill()
+                p.wait()
@@ -5,11 +5,14 @@ import os
 import unittest
 import re
 from threading import Thread
+from datetime import datetime, timedelta
 
 from django.test import TestCase
 
-from norc.core.models import Job, JobNode, Dependency, Instance, Schedule
-from norc.norc_utils import wait_until, log, testing
+from norc.core.models import (Job, JobNode, JobNodeInstance, Dependency,
+    Instance, Schedule)
+from norc.core.constants import Status
+from norc.norc_utils import wait_until, log, testing, django_extras
 
 class JobTest(TestCase):
     
@@ -17,6 +20,8 @@ class JobTest(TestCase):
         items = []
         while self.queue.count() > 0:
             items.append(self.queue.pop())
+        # Executors ack what they pop; nothing here needs redelivering.
+        self.queue.ack(items)
         return items
     
     def _start_instance(self, instance):
@@ -66,3 +71,100 @@ class JobTest(TestCase):
         self.thread.join(2)
         self.assertFalse(self.thread.isAlive())
     
+    
+    def queued_nodes(self):
+        return set([i.item.node for i in self.queue.items.all()])
+    
+    def test_graph(self):
+        """Test running the nodes of a job without its own thread."""
+        schedule = Schedule.create(self.job, self.queue, 1)
+        instance = Instance.objects.create(task=self.job, schedule=schedule)
+        nis = self.job.start_nodes(instance)
+        self.assertEqual([ni.pending for ni in nis],
+            [None, None, 1, 2, 1, 3])
+        n = self.nodes
+        for ready in [[n[0], n[1]], [n[2], n[4]], [n[3]], [n[5]]]:
+            self.assertEqual(self.queued_nodes(), set(ready))
+            items = self.queue_items()
+            self.assertTrue(all([i.can_run() for i in items]))
+            for i in items:
+                self._start_instance(i)
+            # A second start mustn't count the children down again.
+            self._start_instance(items[0])
+        self.assertEqual(self.queue.count(), 0)
+        self.assertTrue(self.job.wait_for_nodes(instance))
+    
+    def test_ids_not_consecutive(self):
+        """Test starting nodes where INSERTs may not get consecutive ids."""
+        django_extras._consecutive_ids = False
+        try:
+            self.test_graph()
+        finally:
+            django_extras._consecutive_ids = None
+    
+    def test_duplicate_dependency(self):
+        """Test that a duplicated edge doesn't leave its child pending."""
+        Dependency.objects.create(parent=self.nodes[0], child=self.nodes[2])
+        self.test_graph()
+    
+    def test_failure(self):
+        schedule = Schedule.create(self.job, self.queue, 1)
+        instance = Instance.objects.create(task=self.job, schedule=schedule)
+        self.tasks[1].command = 'false'
+        self.tasks[1].save()
+        self.job.start_nodes(instance)
+        for i in self.queue_items():
+            self._start_instance(i)
+        self.assertEqual(self.queued_nodes(), set([self.nodes[2]]))
+        ni = JobNodeInstance.objects.get(node=self.nodes[4])
+        self.assertEqual(ni.pending, 1)
+        self.assertFalse(ni.can_run())
+        self.assertFalse(self.job.wait_for_nodes(instance))
+    
+    def test_graph_cache(self):
+        job = Job.objects.get(pk=self.job.pk)
+        graph = job.graph()
+        self.assertTrue(job.graph() is graph)
+        self.assertEqual(graph.roots, self.nodes[:2])
+        self.assertEqual(graph.parents[self.nodes[5].pk], 3)
+        self.assertEqual(sorted(graph.children[self.nodes[0].pk]),
+            [self.nodes[2].pk, self.nodes[3].pk])
+        Dependency.objects.create(parent=self.nodes[0], child=self.nodes[1])
+        job = Job.objects.get(pk=self.job.pk)
+        self.assertTrue(job.graph() is not graph)
+        self.assertEqual(job.graph().roots, self.nodes[:1])
+        Dependency.objects.filter(child=self.nodes[1]).delete()
+        job = Job.objects.get(pk=self.job.pk)
+        self.assertEqual(job.graph().roots, self.nodes[:2])
+        # Saving a copy loaded before a change doesn't undo it.
+        stale = Job.objects.get(pk=self.job.pk)
+        Dependency.objects.create(parent=self.nodes[0], child=self.nodes[1])
+        stale.save()
+        job = Job.objects.get(pk=self.job.pk)
+        self.assertTrue(job.graph_revision > stale.graph_revision)
+        self.assertEqual(job.graph().roots, self.nodes[:1])
+        job.delete()
+        self.assertFalse(self.job.pk in Job.GRAPHS)
+    
+    def test_priorities(self):
+        n = [node.pk for node in self.nodes]
+        graph = self.job.graph()
+        self.assertEqual(graph.priorities({}), {n[0]: 4, n[1]: 3,
+            n[2]: 3, n[3]: 2, n[4]: 2, n[5]: 1})
+        self.assertEqual(graph.priorities({n[1]: 10, n[3]: 2})[n[1]], 22)
+        # Record a past run in which node 1 took much longer.
+        schedule = Schedule.create(self.job, self.queue, 1)
+        now = datetime.utcnow()
+        past = Instance.objects.create(task=self.job, schedule=schedule,
+            status=Status.SUCCESS, ended=now)
+        for node in self.nodes:
+            JobNodeInstance.objects.create(node=node, job_instance=past,
+                status=Status.SUCCESS, started=now, ended=now +
+                timedelta(seconds=node == self.nodes[1] and 10 or 1))
+        self.assertEqual(self.job.node_durations()[n[1]], 10)
+        instance = Instance.objects.create(task=self.job, schedule=schedule)
+        self.job.start_nodes(instance)
+        self.assertEqual(sorted(self.queue.items.values_list('priority',
+            flat=True)), [4, 12])
+        self.assertEqual([i.node for i in self.queue_items()],
+            [self.nodes[1], self.nodes[0]])
@@ -0,0 +1,109 @@
+"""Tests for buffered logging."""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from norc.norc_utils import log
+
+class LogTest(TestCase):
+    """Tests when a Log's buffer is written out."""
+    
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.log')
+        self.log = log.Log(self.path, buffer_size=1024)
+    
+    def written(self):
+        return open(self.path).read()
+    
+    def test_buffered(self):
+        self.log.info('hello')
+        self.assertEqual(self.written(), '')
+        self.log.flush()
+        self.assertTrue(self.written().endswith('INFO: hello\n'))
+    
+    def test_size(self):
+        self.log.info('x' * 1024)
+        self.assertTrue('x' * 1024 in self.written())
+    
+    def test_interval(self):
+        self.log.info('first')
+        self.log.flushed -= log.LOG_FLUSH_INTERVAL
+        self.log.info('second')
+        self.assertTrue('second' in self.written())
+    
+    def test_error(self):
+        """Test that errors and whatever came before them go out at once."""
+        self.log.info('before')
+        self.log.error('oops')
+        written = self.written()
+        self.assertTrue(written.index('before') < written.index('oops'))
+    
+    def test_reentrant(self):
+        """Test that a signal handler interrupting a write can log."""
+        self.assertTrue(self.log.acquire())
+        try:
+            # As a handler would while this thread is in write().
+            self.log.error('Task timed out!')
+        finally:
+            self.log.release()
+        self.assertTrue('Task timed out!' in self.written())
+        self.log.info('after')
+        self.log.flush()
+        self.assertTrue('after' in self.written())
+    
+    def test_unbuffered(self):
+        self.log = log.Log(self.path, buffer_size=0)
+        self.log.info('hello')
+        self.assertTrue('hello' in self.written())
+    
+    def test_flusher(self):
+        self.log.info('hello')
+        log.Flusher.current.flush_all()
+        self.assertTrue('hello' in self.written())
+    
+    def test_fork(self):
+        """Test that a forked child doesn't write its parent's buffer."""
+        self.log.info('parent')
+        pid = log.fork()
+        if pid == 0:
+            self.log.info('child')
+            self.log.close()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.log.flush()
+        self.assertEqual(self.written().count('parent'), 1)
+        self.assertEqual(self.written().count('child'), 1)
+    
+    def test_capture(self):
+        """Test that captured output and messages keep their order."""
+        self.log.start_capture()
+        try:
+            self.log.info('first')
+            print 'printed'
+            self.log.info('second')
+            sys.stdout.flush()
+            os.write(2, 'raw\n')
+        finally:
+            self.log.stop_redirect()
+        self.assertEqual([l.split(': ')[-1] for l in
+            self.written().splitlines()], ['first', 'printed', 'second', 'raw'])
+        self.assertTrue(self.written().startswith('['))
+        self.assertTrue('\nprinted\n' in self.written())
+    
+    def test_timestamp(self):
+        now = time.gmtime()
+        stamp = log.timestamp()
+        self.assertEqual(stamp[:10], time.strftime('%Y/%m/%d', now))
+        self.assertEqual(len(stamp), len('2000/01/01 00:00:00.000000'))
+        self.assertTrue(log.timestamp() >= stamp)
+    
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(self.dir)
+
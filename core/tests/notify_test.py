@@ -0,0 +1,83 @@
+"""Tests for daemon wakeup notifications."""
+
+import os
+import errno
+import select
+import shutil
+import socket
+import tempfile
+
+from django.test import TestCase
+
+from norc import settings
+from norc.core.models import DBQueue, Executor
+from norc.norc_utils import wait_until, notify
+from norc.norc_utils.testing import make_instance
+
+class UnixSocketNotifierTest(TestCase):
+    """Tests notification through UNIX sockets on the local host."""
+    
+    def setUp(self):
+        self.old_settings = settings.NORC_TMP_DIR, settings.NOTIFY_SYSTEM
+        settings.NORC_TMP_DIR = tempfile.mkdtemp()
+        settings.NOTIFY_SYSTEM = 'UnixSocket'
+        notify._notifier = None
+        self.notified = []
+        self.listener = None
+    
+    def listen(self, channels):
+        self.listener = notify.listen(channels, self.notified.append)
+    
+    def test_notify(self):
+        self.listen(['a', 'b'])
+        notify.notify('b')
+        wait_until(lambda: self.notified == ['b'], 2, 0.05)
+        notify.notify('c')
+        notify.notify('a')
+        wait_until(lambda: self.notified == ['b', 'a'], 2, 0.05)
+    
+    def test_push(self):
+        """Test that pushing to a DBQueue wakes its executors."""
+        queue = DBQueue.objects.create(name='test')
+        executor = Executor(queue=queue, concurrent=1)
+        self.listen(executor.queue.wakeup_channels())
+        queue.push(make_instance())
+        wait_until(lambda: len(self.notified) == 1, 2, 0.05)
+    
+    def test_dead_listener(self):
+        """Test that sockets left behind by dead listeners are removed."""
+        d = notify.UnixSocketNotifier.directory('a')
+        os.makedirs(d)
+        path = os.path.join(d, 'dead.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.close()
+        self.listen(['a'])
+        notify.notify('a')
+        wait_until(lambda: self.notified == ['a'], 2, 0.05)
+        self.assertFalse(os.path.exists(path))
+    
+    def test_interrupted(self):
+        """Test that a signal during the wait doesn't end the listener."""
+        calls = []
+        def receive(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                raise select.error(errno.EINTR, 'Interrupted system call')
+            listener.stop()
+            return ['a']
+        listener = notify.Listener(['a'], self.notified.append,
+            notify.get_log())
+        listener.receive = receive
+        listener.run()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.notified, ['a'])
+    
+    def tearDown(self):
+        if self.listener:
+            self.listener.stop()
+            self.listener.join(2)
+        shutil.rmtree(settings.NORC_TMP_DIR)
+        settings.NORC_TMP_DIR, settings.NOTIFY_SYSTEM = self.old_settings
+        notify._notifier = None
+
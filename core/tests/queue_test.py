@@ -1,10 +1,40 @@
 
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.conf import settings as django_settings
 from django.test import TestCase
 
-from norc.core.models import DBQueue, QueueGroup, QueueGroupItem, Instance
+from norc.core.models import (Queue, DBQueue, QueueGroup, QueueGroupItem,
+    Instance)
 from norc.norc_utils import wait_until
 from norc.norc_utils.testing import *
 
+class FakeQueue(object):
+    """Records the timeouts pops are given."""
+    
+    def __init__(self, items):
+        self.items = items
+        self.timeouts = []
+    
+    def pop(self, timeout=None):
+        self.timeouts.append(timeout)
+        return self.items.pop(0) if self.items else None
+    
+
+class QueueTest(TestCase):
+    """Tests the default implementations of Queue."""
+    
+    def test_pop_many(self):
+        """Test that only the first pop waits."""
+        queue = FakeQueue([1, 2])
+        pop_many = Queue.__dict__['pop_many']
+        self.assertEqual(pop_many(queue, 3, 5), [1, 2])
+        self.assertEqual(queue.timeouts, [5, 0, 0])
+        self.assertEqual(pop_many(queue, 3), [])
+        self.assertEqual(queue.timeouts, [5, 0, 0, None])
+    
+
 class DBQueueTest(TestCase):
     """Super simple test that pushes and pops something from the queue."""
     
@@ -16,10 +46,170 @@ class DBQueueTest(TestCase):
         self.queue.push(self.item)
         self.assertEqual(self.queue.peek(), self.item)
         self.assertEqual(self.queue.pop(), self.item)
+        self.assertEqual(self.queue.pop(timeout=0), None)
     
     def test_invalid(self):
         self.assertRaises(AssertionError, lambda: self.queue.push(self.queue))
     
+    def test_pop_order(self):
+        """Test that pops come out in FIFO order and then run dry."""
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(3)]
+        for i in items:
+            self.queue.push(i)
+        popped = [self.queue.pop() for _ in range(3)]
+        self.assertEqual(popped, items)
+        self.assertEqual(self.queue.pop(), None)
+        # Popped items are leased until they're acked.
+        self.assertEqual(self.queue.count(), 0)
+        self.assertEqual(self.queue.items.count(), 3)
+        self.queue.ack(popped)
+        self.assertEqual(self.queue.items.count(), 0)
+    
+    def expire(self):
+        """Makes every lease on the queue run out."""
+        self.queue.items.exclude(claim=None).update(
+            lease_expires=datetime.utcnow() - timedelta(seconds=1))
+    
+    def test_lease_expiry(self):
+        """Test that items not acked in time are delivered again."""
+        self.queue.push(self.item)
+        self.assertEqual(self.queue.pop(), self.item)
+        self.assertEqual(DBQueue.release_expired(), 0)
+        self.assertEqual(self.queue.pop(), None)
+        self.expire()
+        self.assertEqual(DBQueue.release_expired(), 1)
+        again = self.queue.pop()
+        self.assertEqual(again, self.item)
+        self.queue.ack([again])
+        self.assertEqual(self.queue.items.count(), 0)
+    
+    def test_stale_ack(self):
+        """Test that a lost lease's ack leaves the new lease alone."""
+        self.queue.push(self.item)
+        first = self.queue.pop()
+        self.expire()
+        DBQueue.release_expired()
+        second = self.queue.pop()
+        self.queue.ack([first])
+        self.assertEqual(self.queue.items.count(), 1)
+        self.queue.ack([second])
+        self.assertEqual(self.queue.items.count(), 0)
+    
+    def test_stale_ack_pairs(self):
+        """Test that leases are matched by id and token together."""
+        other = Instance.objects.create(task=self.item.task)
+        self.queue.push(self.item)
+        self.queue.push(other)
+        first = self.queue.pop()
+        self.expire()
+        DBQueue.release_expired()
+        again, popped = self.queue.pop_many(2)
+        self.assertEqual(popped, other)
+        # The stale lease's id and the fresh lease's token match the
+        # re-leased item, which must survive.
+        self.queue.ack([first, popped])
+        self.assertEqual(self.queue.items.count(), 1)
+        self.queue.ack([again])
+        self.assertEqual(self.queue.items.count(), 0)
+    
+    def test_renew(self):
+        """Test that renewed leases outlast their original expiry."""
+        self.queue.push(self.item)
+        item = self.queue.pop()
+        self.expire()
+        self.queue.renew([item])
+        self.assertEqual(DBQueue.release_expired(), 0)
+        self.assertEqual(self.queue.pop(), None)
+    
+    def test_duplicates(self):
+        """Test that an item pushed twice is leased twice."""
+        self.queue.push_many([self.item, self.item])
+        popped = self.queue.pop_many(2)
+        self.assertEqual(popped, [self.item, self.item])
+        self.queue.ack(popped[:1])
+        self.assertEqual(self.queue.items.count(), 1)
+    
+    def test_missing_item(self):
+        """Test that items whose object was deleted are dropped."""
+        other = Instance.objects.create(task=self.item.task)
+        self.queue.push(other)
+        self.queue.push(self.item)
+        other.delete()
+        self.assertEqual(self.queue.pop_many(2), [self.item])
+        self.assertEqual(self.queue.items.count(), 1)
+    
+    def test_pop_many(self):
+        """Test that pop_many takes items in order, up to the limit."""
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(5)]
+        for i in items:
+            self.queue.push(i)
+        self.assertEqual(self.queue.pop_many(0), [])
+        self.assertEqual(self.queue.pop_many(3), items[:3])
+        self.assertEqual(self.queue.pop_many(3), items[3:])
+        self.assertEqual(self.queue.pop_many(3), [])
+    
+    def test_push_many(self):
+        """Test that push_many adds items in order with ids assigned."""
+        self.queue.push(self.item)
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(600)]
+        self.queue.push_many(items)
+        self.queue.push_many([])
+        self.assertEqual(self.queue.count(), 601)
+        ids = list(self.queue.items.values_list('id', flat=True))
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual(self.queue.pop_many(601), [self.item] + items)
+        self.assertRaises(AssertionError,
+            lambda: self.queue.push_many([self.queue]))
+    
+    def test_pop_priority(self):
+        """Test that higher priorities are popped first, then FIFO."""
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(4)]
+        self.queue.push(items[0])
+        self.queue.push(items[1], priority=2.5)
+        self.queue.push(items[2])
+        self.queue.push(items[3], priority=7)
+        self.assertEqual(self.queue.peek(), items[3])
+        self.assertEqual(self.queue.pop(), items[3])
+        self.assertEqual(self.queue.pop_many(3),
+            [items[1], items[0], items[2]])
+        # Only the priority pushed with counts, not the item's own.
+        items[0].priority = 5
+        self.queue.push(items[0], priority=1)
+        self.queue.push_many(items[1:], priority=3)
+        self.assertEqual(self.queue.pop_many(4), items[1:] + items[:1])
+    
+    def test_with_items(self):
+        """Test that enqueued items are loaded in bulk."""
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(10)]
+        for i in items:
+            self.queue.push(i)
+        self.queue.peek()
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            loaded = [qi.item for qi in self.queue.items.with_items()]
+            query_count = len(connection.queries)
+        finally:
+            django_settings.DEBUG = False
+        self.assertEqual(loaded, items)
+        self.assertEqual(query_count, 2)
+    
+    def test_skip_claimed(self):
+        """Test that an item claimed by another pop is never returned."""
+        other = Instance.objects.create(task=self.item.task)
+        self.queue.push(other)
+        self.queue.push(self.item)
+        self.queue.items.filter(item_id=other.id).update(claim='other')
+        self.assertEqual(self.queue.count(), 1)
+        self.assertEqual(self.queue.peek(), self.item)
+        self.assertEqual(self.queue.pop(), self.item)
+        self.assertEqual(self.queue.pop(), None)
+    
     def tearDown(self):
         pass
     
@@ -52,6 +242,7 @@ class QueueGroupTest(TestCase):
         self.q3.push(item)
         self.assertEqual(self.group.peek(), item)
         self.assertEqual(self.group.pop(), item)
+        self.assertEqual(self.group.pop(timeout=0), None)
     
     def test_priority(self):
         """Test that things get popped in priority order."""
@@ -64,10 +255,134 @@ class QueueGroupTest(TestCase):
         popped = [self.group.pop() for _ in range(30)]
         self.assertEqual(popped, p1 + p2 + p3)
     
+    def test_pop_many(self):
+        """Test that pop_many fills across queues in priority order."""
+        p1 = [self.new_instance() for _ in range(2)]
+        p2 = [self.new_instance() for _ in range(3)]
+        p3 = [self.new_instance() for _ in range(2)]
+        for i in p3: self.q3.push(i)
+        for i in p2: self.q2.push(i)
+        for i in p1: self.q1.push(i)
+        self.assertEqual(self.group.pop_many(4), p1 + p2[:2])
+        self.assertEqual(self.group.pop_many(4), p2[2:] + p3)
+        self.assertEqual(self.group.pop_many(4), [])
+    
+    def test_single_claim(self):
+        """Test that DBQueue members are popped from with one claim."""
+        p2 = [self.new_instance() for _ in range(3)]
+        p3 = [self.new_instance() for _ in range(2)]
+        self.q3.push_many(p3, priority=5)
+        self.q2.push(p2[0], priority=1)
+        self.q2.push_many(p2[1:], priority=2)
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            popped = self.group.pop_many(4)
+            query_count = len(connection.queries)
+        finally:
+            django_settings.DEBUG = False
+        self.assertEqual(popped, p2[1:] + p2[:1] + p3[:1])
+        self.assertEqual(self.group.pop(), p3[1])
+        self.assertEqual(self.group.pop(), None)
+        # Members, claim (UPDATE, SELECT) and items.
+        self.assertEqual(query_count, 5)
+    
+    def count_queries(self, f):
+        django_settings.DEBUG = True
+        try:
+            connection.queries = []
+            result = f()
+            return result, len(connection.queries)
+        finally:
+            django_settings.DEBUG = False
+    
+    def test_members_cached(self):
+        """Test that an idle pop costs one query until members change."""
+        self.group.pop()
+        self.assertEqual(self.count_queries(self.group.pop), (None, 1))
+        q4 = DBQueue.objects.create(name="Q4")
+        item = self.new_instance()
+        q4.push(item)
+        QueueGroupItem.objects.create(group=self.group, queue=q4,
+            priority=4)
+        self.assertEqual(self.group.pop(), item)
+        self.assertEqual(self.group.count(), 0)
+    
+    def test_weighted(self):
+        """Test that weighted round-robin shares pops by weight."""
+        self.group.policy = 'weighted'
+        self.group.items.filter(priority=1).update(weight=3)
+        QueueGroup.MEMBERS.clear()
+        p1 = [self.new_instance() for _ in range(10)]
+        p2 = [self.new_instance() for _ in range(10)]
+        self.q1.push_many(p1)
+        self.q2.push_many(p2)
+        self.assertEqual(self.group.pop_many(8), p1[:6] + p2[:2])
+        self.assertEqual([self.group.pop() for _ in range(4)],
+            [p1[6], p1[7], p2[2], p1[8]])
+        # Once q1 runs dry, q2 gets everything.
+        self.assertEqual(self.group.pop_many(10), p1[9:] + p2[3:])
+        self.assertEqual(self.count_queries(
+            lambda: self.group.pop_many(4)), ([], 1))
+    
+    def test_deficit(self):
+        """Test that deficit round-robin pops bursts by weight."""
+        self.group.policy = 'deficit'
+        self.group.items.filter(priority=1).update(weight=2)
+        QueueGroup.MEMBERS.clear()
+        p1 = [self.new_instance() for _ in range(5)]
+        p3 = [self.new_instance() for _ in range(3)]
+        self.q1.push_many(p1)
+        self.q3.push_many(p3)
+        self.assertEqual([self.group.pop() for _ in range(6)],
+            [p1[0], p1[1], p3[0], p1[2], p1[3], p3[1]])
+        self.assertEqual(self.group.pop_many(5), [p1[4], p3[2]])
+        self.assertEqual(self.count_queries(
+            lambda: self.group.pop_many(4)), ([], 1))
+    
+    def test_member_failure(self):
+        """Test that a failing member is logged and skipped."""
+        errors = []
+        class FakeLog(object):
+            def error(self, msg, trace=False):
+                errors.append(msg)
+        self.group.log = FakeLog()
+        item = self.new_instance()
+        self.q2.push(item)
+        self.group.policy = 'weighted'
+        broken = self.group.members()[0][0]
+        broken.pop_many = lambda n, timeout=None: 1 / 0
+        self.q1.push(self.new_instance())
+        self.assertEqual(self.group.pop_many(2), [item])
+        self.assertEqual(len(errors), 1)
+    
+    def test_members_dont_wait(self):
+        """Test that members are popped without waiting for a push."""
+        timeouts = []
+        self.group.policy = 'weighted'
+        member = self.group.members()[0][0]
+        pop_many = member.pop_many
+        def record(n, timeout=None):
+            timeouts.append(timeout)
+            return pop_many(n, timeout)
+        member.pop_many = record
+        member.push(self.new_instance())
+        self.assertEqual(len(self.group.pop_many(2)), 1)
+        self.assertEqual(timeouts, [0])
+    
+    def test_ack(self):
+        """Test that a group acks items from any of its DBQueues."""
+        self.q1.push(self.new_instance())
+        self.q3.push(self.new_instance())
+        items = self.group.pop_many(2)
+        self.assertEqual(len(items), 2)
+        self.group.ack(items)
+        self.assertEqual(self.q1.items.count() + self.q3.items.count(), 0)
+    
     def test_no_push(self):
         """Test that pushing to a QueueGroup fails."""
         self.assertRaises(NotImplementedError, lambda: self.group.push(None))
     
     def tearDown(self):
         pass
-    
+
@@ -1,10 +1,12 @@
 
-"""Module for testing anything related to executors."""
+"""Module for testing S3 log backups."""
 
 import os
 from threading import Thread
+from cStringIO import StringIO
 
 from django.test import TestCase
+from boto.s3.multipart import MultiPartUpload
 
 from norc.core.models import Executor, DBQueue, CommandTask, Instance
 from norc.core.constants import Status
@@ -26,3 +28,70 @@ class ExecutorTest(TestCase):
     def tearDown(self):
         pass
     
+
+class S3BackupTest(TestCase):
+    """Tests log backups against S3, or a local S3-compatible server.
+    
+    Only run when BACKUP_SYSTEM is 'AmazonS3'; BACKUP_HOST can point it
+    at a stand-in such as moto_server.
+    
+    """
+    def setUp(self):
+        from norc.norc_utils import aws, backup
+        self.aws = aws
+        self.backup = backup
+        self.key = 'norc_logs/test/s3_backup'
+    
+    def test_small(self):
+        """Test that a small log is uploaded with one PUT and restored."""
+        data = 'line\n' * 1000
+        self.backup.s3_backup(StringIO(data), self.key)
+        self.assertEqual(self.aws.get_s3_key(self.key), data)
+    
+    def test_multipart(self):
+        """Test that a log bigger than a part is uploaded in parts."""
+        data = os.urandom(12 * 1024 * 1024)
+        self.backup.s3_backup(StringIO(data), self.key)
+        self.assertEqual(self.aws.get_s3_key(self.key), data)
+    
+    def test_part_retry(self):
+        """Test that a failed part is retried on its own."""
+        attempts = []
+        original = MultiPartUpload.upload_part_from_file
+        def flaky(upload, fp, part_num, *args, **kwargs):
+            attempts.append(part_num)
+            if attempts.count(part_num) == 1 and part_num == 2:
+                raise IOError("Connection reset.")
+            return original(upload, fp, part_num, *args, **kwargs)
+        MultiPartUpload.upload_part_from_file = flaky
+        try:
+            data = os.urandom(12 * 1024 * 1024)
+            self.backup.s3_backup(StringIO(data), self.key)
+        finally:
+            MultiPartUpload.upload_part_from_file = original
+        self.assertEqual(attempts, [1, 2, 2])
+        self.assertEqual(self.aws.get_s3_key(self.key), data)
+    
+    def test_abort(self):
+        """Test that an upload whose part keeps failing is aborted."""
+        def broken(*args, **kwargs):
+            raise IOError("Connection reset.")
+        original = MultiPartUpload.upload_part_from_file
+        MultiPartUpload.upload_part_from_file = broken
+        try:
+            self.assertRaises(IOError, lambda: self.backup.s3_backup(
+                StringIO(os.urandom(12 * 1024 * 1024)), self.key))
+        finally:
+            MultiPartUpload.upload_part_from_file = original
+        bucket = self.aws.get_s3_bucket()
+        self.assertEqual(list(bucket.list_multipart_uploads()), [])
+    
+    def test_reuse(self):
+        """Test that uploads share a connection and bucket."""
+        self.assertTrue(self.aws.get_s3_connection() is
+            self.aws.get_s3_connection())
+        self.assertTrue(self.aws.get_s3_bucket() is self.aws.get_s3_bucket())
+    
+    def tearDown(self):
+        self.aws.get_s3_bucket().delete_key(self.key)
+
@@ -3,19 +3,94 @@
 
 import unittest
 import re
+import random
+from datetime import datetime, timedelta
 
 from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
 
-from norc.core.models import CommandTask, DBQueue, Schedule, CronSchedule
-from norc.norc_utils import wait_until, log
+from norc.core.models import (CommandTask, DBQueue, Schedule, CronSchedule,
+    fire_times, queue_load)
+from norc.norc_utils import wait_until, log, timestamp
+from norc.norc_utils.cron import CompiledCron
 
-# class ScheduleTest(TestCase):
-#     
-#     def setUp(self):
-#         pass
-#     
-#     def test_run_schedule(self):
-#         pass
+START = datetime(2011, 1, 1, 12)
+END = START + timedelta(hours=1)
+
+def ts(**kwargs):
+    """The timestamp of a time after START."""
+    return int(timestamp(START + timedelta(**kwargs)))
+
+class FireTimesTest(TestCase):
+    """Tests forecasting when schedules will fire."""
+    
+    def simple(self, next, period, reps=0, make_up=False):
+        return Schedule(next=START + timedelta(seconds=next), period=period,
+            repetitions=reps, remaining=reps, make_up=make_up)
+    
+    def cron(self, encoding, base=-1, reps=0, make_up=False):
+        return CronSchedule(encoding=encoding, repetitions=reps,
+            remaining=reps, make_up=make_up,
+            base=START + timedelta(seconds=base))
+    
+    def test_schedule(self):
+        times = self.simple(30, 600).fire_times(START, END)
+        self.assertEqual(list(times), [ts(seconds=30 + 600 * i)
+            for i in range(6)])
+        times = self.simple(30, 600, reps=2).fire_times(START, END)
+        self.assertEqual(list(times), [ts(seconds=30), ts(seconds=630)])
+        self.assertEqual(len(self.simple(3600, 60).fire_times(START, END)), 0)
+        self.assertEqual(list(self.simple(0, 0, 3).fire_times(START, END)),
+            [ts()] * 3)
+    
+    def test_schedule_overdue(self):
+        times = self.simple(-250, 100).fire_times(START, END)
+        self.assertEqual(list(times[:2]), [ts(), ts(seconds=50)])
+        times = self.simple(-250, 100, make_up=True).fire_times(START, END)
+        self.assertEqual(list(times[:4]), [ts()] * 3 + [ts(seconds=50)])
+        times = self.simple(-250, 100, 2, True).fire_times(START, END)
+        self.assertEqual(list(times), [ts()] * 2)
+    
+    def test_cron(self):
+        times = self.cron('o*d*w*h*m0,30s0').fire_times(START, END)
+        self.assertEqual(list(times), [ts(), ts(minutes=30)])
+        times = self.cron('o*d*w*h*m*s0', reps=3).fire_times(START, END)
+        self.assertEqual(list(times), [ts(), ts(minutes=1), ts(minutes=2)])
+        times = self.cron('o*d*w*h*m*s0', base=1200).fire_times(START, END)
+        self.assertEqual(times[0], ts(minutes=21))
+        self.assertEqual(len(times), 39)
+    
+    def test_cron_overdue(self):
+        times = self.cron('o*d*w*h*m*s0', base=-300).fire_times(START, END)
+        self.assertEqual(list(times[:2]), [ts(), ts(minutes=1)])
+        self.assertEqual(len(times), 60)
+        times = self.cron('o*d*w*h*m*s0', base=-300, make_up=True) \
+            .fire_times(START, END)
+        # Four missed runs, then the one due at START itself.
+        self.assertEqual(list(times[:6]), [ts()] * 5 + [ts(minutes=1)])
+    
+    def test_bulk(self):
+        t = CommandTask.objects.create(name='Forecast', command='true')
+        q1 = DBQueue.objects.create(name='q1')
+        q2 = DBQueue.objects.create(name='q2')
+        Schedule.objects.create(task=t, queue=q1, next=START, period=30,
+            repetitions=0, remaining=0)
+        for _ in range(3):
+            CronSchedule.objects.create(task=t, queue=q2, base=START,
+                encoding='o*d*w*h*m0,30s0', repetitions=0, remaining=0)
+        cache = {}
+        for s in CronSchedule.objects.all():
+            s.fire_times(START, END, cache)
+        self.assertEqual(cache.keys(), ['o*d*w*h*m0,30s0'])
+        self.assertEqual(len(fire_times(Schedule.objects.all(),
+            START, END)[0][1]), 120)
+        schedules = list(Schedule.objects.all()) + \
+            list(CronSchedule.objects.all())
+        load = queue_load(schedules, START, END)
+        ct = lambda q: ContentType.objects.get_for_model(q).pk
+        self.assertEqual(sum(load[(ct(q1), q1.pk)].values()), 120)
+        self.assertEqual(load[(ct(q1), q1.pk)][ts(minutes=5)], 2)
+        self.assertEqual(load[(ct(q2), q2.pk)], {ts(minutes=30): 3})
     
 
 class CronScheduleTest(TestCase):
@@ -44,3 +119,51 @@ class CronScheduleTest(TestCase):
         self.assertEqual(make('WEEKLY').pretty_name(), 'WEEKLY')
         self.assertEqual(make('MONTHLY').pretty_name(), 'MONTHLY')
     
+    def test_next(self):
+        nxt = lambda e, dt: CronSchedule(encoding=e).calculate_next(dt)
+        dt = datetime(2011, 1, 31, 23, 59, 59, 500)
+        self.assertEqual(nxt('o*d*w*h*m*s*', dt), datetime(2011, 2, 1))
+        self.assertEqual(nxt('o*d*w*h10m*s0', datetime(2011, 1, 1, 8, 30)),
+            datetime(2011, 1, 1, 10, 0, 0))
+        self.assertEqual(nxt('o*d*w*h*m0,30s0', datetime(2011, 1, 1, 8, 30)),
+            datetime(2011, 1, 1, 9, 0, 0))
+        # Months are honored, and days must match the weekday too.
+        self.assertEqual(nxt('o3d*w*h0m0s0', dt), datetime(2011, 3, 1))
+        self.assertEqual(nxt('o*d13w4h0m0s0', dt), datetime(2011, 5, 13))
+        self.assertEqual(nxt('o2d29w*h0m0s0', dt), datetime(2012, 2, 29))
+        self.assertEqual(nxt('o2d30w*h0m0s0', dt), None)
+    
+    def test_next_matches_search(self):
+        """Compares compiled results with a plain search of every day."""
+        def search(fields, dt):
+            months, days, weekdays, hours, minutes, seconds = fields
+            day = datetime(dt.year, dt.month, dt.day)
+            while True:
+                if day.month in months and day.day in days and \
+                        day.weekday() in weekdays:
+                    for h in hours:
+                        for m in minutes:
+                            for s in seconds:
+                                t = day.replace(hour=h, minute=m, second=s)
+                                if t > dt:
+                                    return t
+                day += timedelta(days=1)
+        pick = lambda r: sorted(random.sample(r, random.randint(1, 3)))
+        for _ in range(200):
+            fields = [pick(range(1, 13)), pick(range(1, 29)), pick(range(7)),
+                pick(range(24)), pick(range(60)), pick(range(60))]
+            compiled = CompiledCron(*fields)
+            dt = datetime(2011, 1, 1) + timedelta(
+                seconds=random.randint(0, 365 * 86400))
+            self.assertEqual(compiled.next_after(dt), search(fields, dt))
+    
+    def test_next_fires(self):
+        s = CronSchedule.create(self.t, self.q, 'o*d*w*h*m0,30s0')
+        fires = s.next_fires(4, datetime(2011, 1, 1, 23, 15))
+        self.assertEqual(fires, [datetime(2011, 1, 1, 23, 30),
+            datetime(2011, 1, 2, 0, 0), datetime(2011, 1, 2, 0, 30),
+            datetime(2011, 1, 2, 1, 0)])
+        other = CronSchedule.objects.get(pk=s.pk)
+        self.assertTrue(CronSchedule.compile(other.encoding) is
+            CronSchedule.compile(s.encoding))
+    
@@ -2,14 +2,19 @@
 """Test schedule handling cases in the SchedulableTask class."""
 
 import os, sys
+import time
+import random
 from threading import Thread
 from datetime import timedelta, datetime
 
 from django.test import TestCase
 
-from norc.core.models import Scheduler, Schedule, CronSchedule
+from norc.core.models import (Scheduler, Schedule, CronSchedule,
+    DBQueue, Instance)
+from norc.core.models import scheduler as scheduler_module
 from norc.core.constants import Status, Request
 from norc.norc_utils import wait_until, log
+from norc.norc_utils.heap import ArrayHeap
 from norc.norc_utils.testing import make_queue, make_task
 
 class SchedulerTest(TestCase):
@@ -138,3 +143,254 @@ class SchedulerTest(TestCase):
         assert not self.thread.isAlive()
         assert not self._scheduler.timer.isAlive()
     
+
+class ClaimFireTest(TestCase):
+    """Tests claiming and firing schedules without the daemon threads."""
+    
+    def setUp(self):
+        self.scheduler = Scheduler.objects.create()
+        self.scheduler.log = log.Log(os.devnull)
+        self.task = make_task()
+        self.queue = make_queue()
+    
+    def fire_due(self):
+        self.scheduler.fire(self.scheduler.heap.pop_due(time.time()))
+    
+    def test_claim(self):
+        old_limit = scheduler_module.SCHEDULER_LIMIT
+        scheduler_module.SCHEDULER_LIMIT = 2
+        try:
+            for i in range(5):
+                Schedule.create(self.task, self.queue, 60, 0)
+            CronSchedule.create(self.task, self.queue, 'HOURLY')
+            self.scheduler.claim()
+        finally:
+            scheduler_module.SCHEDULER_LIMIT = old_limit
+        self.assertEqual(self.scheduler.schedules.count(), 5)
+        self.assertEqual(self.scheduler.cronschedules.count(), 1)
+        self.assertEqual(len(self.scheduler.heap), 6)
+        self.scheduler.claim()
+        self.assertEqual(len(self.scheduler.heap), 6)
+    
+    def test_fire(self):
+        s = Schedule.create(self.task, self.queue, 0, 2, start=-1)
+        self.scheduler.claim()
+        self.fire_due()
+        self.assertEqual(self.queue.count(), 1)
+        self.assertEqual(len(self.scheduler.heap), 1)
+        self.fire_due()
+        self.assertEqual(self.queue.count(), 2)
+        self.assertEqual(len(self.scheduler.heap), 0)
+        self.assertEqual(Schedule.objects.get(pk=s.pk).scheduler, None)
+    
+    def test_fire_batch(self):
+        """Test that a batch of schedules is enqueued and updated in bulk."""
+        other = DBQueue.objects.create(name='other')
+        simple = [Schedule.create(self.task, q, 60, 2, start=-1)
+            for q in [self.queue, other] * 300]
+        cron = [CronSchedule.create(self.task, self.queue, 'o*d*w*h*m*s*')
+            for _ in range(10)]
+        last = Schedule.create(self.task, self.queue, 60, 1, start=-1)
+        time.sleep(1)
+        self.scheduler.claim()
+        self.assertEqual(len(self.scheduler.heap), 611)
+        self.fire_due()
+        self.assertEqual(self.queue.count(), 311)
+        self.assertEqual(other.count(), 300)
+        self.assertEqual(len(self.scheduler.heap), 610)
+        ids = set(Instance.objects.values_list('id', flat=True))
+        self.assertEqual(len(ids), 611)
+        s = Schedule.objects.get(pk=simple[0].pk)
+        self.assertEqual(s.remaining, 1)
+        self.assertEqual(s.next, simple[0].next + timedelta(seconds=60))
+        self.assertEqual(s.instances.count(), 1)
+        c = CronSchedule.objects.get(pk=cron[0].pk)
+        self.assertTrue(c.base > cron[0].base)
+        self.assertEqual(c.scheduler_id, self.scheduler.pk)
+        self.assertEqual(Schedule.objects.get(pk=last.pk).scheduler, None)
+    
+    def test_fire_duplicates(self):
+        s = Schedule.create(self.task, self.queue, 60, 0, start=-1)
+        self.scheduler.claim()
+        self.scheduler.add([s])
+        self.fire_due()
+        self.assertEqual(s.instances.count(), 1)
+        self.assertEqual(len(self.scheduler.heap), 1)
+    
+    def test_fire_unclaimed(self):
+        s = Schedule.create(self.task, self.queue, 0, 2, start=-1)
+        self.scheduler.claim()
+        Schedule.objects.filter(pk=s.pk).update(scheduler=None)
+        self.fire_due()
+        self.assertEqual(s.instances.count(), 0)
+        self.assertEqual(len(self.scheduler.heap), 0)
+    
+    def test_fire_too_early(self):
+        """Test that a schedule that can't be advanced is skipped."""
+        early = Schedule.create(self.task, self.queue, 60, 0, start=60)
+        s = Schedule.create(self.task, self.queue, 60, 0, start=-1)
+        self.scheduler.claim()
+        # As if early had been rescheduled after its entry was pushed.
+        self.scheduler.heap.push(time.time() - 1, 0, early.pk)
+        self.fire_due()
+        self.assertEqual(early.instances.count(), 0)
+        self.assertEqual(s.instances.count(), 1)
+        self.assertEqual(Schedule.objects.get(pk=early.pk).next, early.next)
+    
+    def test_fire_push_failure(self):
+        """Test that schedules whose queue fails are retried later."""
+        other = DBQueue.objects.create(name='other')
+        s = Schedule.create(self.task, self.queue, 60, 0, start=-1)
+        broken = Schedule.create(self.task, other, 60, 0, start=-1)
+        self.scheduler.claim()
+        push_many = DBQueue.push_many
+        def fail(queue, items, priority=None):
+            if queue.pk == other.pk:
+                raise Exception("Push failed.")
+            return push_many(queue, items, priority)
+        DBQueue.push_many = fail
+        try:
+            self.fire_due()
+        finally:
+            DBQueue.push_many = push_many
+        self.assertEqual(s.instances.count(), 1)
+        self.assertEqual(broken.instances.count(), 0)
+        self.assertEqual(Schedule.objects.get(pk=broken.pk).next, broken.next)
+        self.assertEqual(self.scheduler.heap.pop_due(time.time()), [])
+        self.assertEqual(len(self.scheduler.heap), 2)
+        self.scheduler.fire(self.scheduler.heap.pop_due(time.time() + 60))
+        self.assertEqual(broken.instances.count(), 1)
+    
+    def test_fire_save_failure(self):
+        """Test that schedules that can't be saved aren't enqueued."""
+        s = Schedule.create(self.task, self.queue, 60, 0, start=-1)
+        self.scheduler.claim()
+        bulk_update = scheduler_module.bulk_update
+        def fail(objects, names):
+            raise Exception("Update failed.")
+        scheduler_module.bulk_update = fail
+        try:
+            self.fire_due()
+        finally:
+            scheduler_module.bulk_update = bulk_update
+        self.assertEqual(s.instances.count(), 0)
+        self.assertEqual(len(self.scheduler.heap), 1)
+        self.scheduler.fire(self.scheduler.heap.pop_due(time.time() + 60))
+        self.assertEqual(s.instances.count(), 1)
+    
+    def test_reload(self):
+        now = datetime.utcnow()
+        s = CronSchedule.create(self.task, self.queue,
+            'o*d*w*h*m*s%s' % ((now.second - 1) % 60), 1)
+        self.scheduler.claim()
+        self.assertTrue(self.scheduler.heap.peek()[0] > time.time() + 50)
+        CronSchedule.objects.get(pk=s.pk).reschedule('o*d*w*h*m*s*')
+        self.scheduler.request = Request.RELOAD
+        self.scheduler.handle_request()
+        self.assertEqual(len(self.scheduler.heap), 1)
+        self.assertTrue(self.scheduler.heap.peek()[0] < time.time() + 2)
+    
+
+class MultiSchedulerTest(TestCase):
+    """Tests several Schedulers sharing schedules, without threads."""
+    
+    def setUp(self):
+        self.task = make_task()
+        self.queue = make_queue()
+        self.schedulers = [self.make_scheduler() for _ in range(3)]
+        for i in range(30):
+            Schedule.create(self.task, self.queue, 60, 0)
+    
+    def make_scheduler(self):
+        s = Scheduler.objects.create(status=Status.RUNNING,
+            heartbeat=datetime.utcnow())
+        s.log = log.Log(os.devnull)
+        s.last_beat = time.time()
+        return s
+    
+    def claim_all(self):
+        for s in self.schedulers:
+            s.reclaim()
+            s.rebalance()
+            s.claim()
+    
+    def owned(self):
+        return [set(s.schedules.values_list('id', flat=True))
+            for s in self.schedulers]
+    
+    def test_partition(self):
+        self.claim_all()
+        self.assertEqual([s.partition for s in self.schedulers],
+            [(0, 3), (1, 3), (2, 3)])
+        owned = self.owned()
+        self.assertEqual([len(o) for o in owned], [10, 10, 10])
+        self.assertEqual(len(owned[0] | owned[1] | owned[2]), 30)
+        for s, o in zip(self.schedulers, owned):
+            self.assertEqual(set([e[2] for e in s.heap]), o)
+    
+    def test_join(self):
+        self.claim_all()
+        self.schedulers.append(self.make_scheduler())
+        self.claim_all()
+        # Schedules released by a rebalance are claimed on the next pass.
+        self.claim_all()
+        owned = self.owned()
+        self.assertEqual(sum(map(len, owned)), 30)
+        self.assertEqual(len(reduce(set.union, owned)), 30)
+        for s, o in zip(self.schedulers, owned):
+            self.assertEqual(set([e[2] for e in s.heap]), o)
+            self.assertTrue(len(o) in (7, 8))
+    
+    def test_reclaim(self):
+        self.claim_all()
+        dead = self.schedulers.pop()
+        Scheduler.objects.filter(pk=dead.pk).update(
+            heartbeat=datetime.utcnow() - timedelta(minutes=5))
+        self.claim_all()
+        self.assertEqual(dead.schedules.count(), 0)
+        self.claim_all()
+        self.assertEqual(map(len, self.owned()), [15, 15])
+    
+    def test_lease(self):
+        s = Schedule.create(self.task, self.queue, 60, 0, start=-1)
+        scheduler = self.schedulers[0]
+        scheduler.claim()
+        scheduler.last_beat -= scheduler_module.SCHEDULER_LEASE
+        self.assertFalse(scheduler.has_lease())
+        # Without a lease the timer holds on to due schedules.
+        timer = Thread(target=scheduler.timer_run)
+        timer.start()
+        time.sleep(0.5)
+        scheduler.status = Status.ENDED
+        scheduler.timer.flag.set()
+        timer.join()
+        self.assertEqual(s.instances.count(), 0)
+        self.assertEqual(len(scheduler.heap), 31)
+        scheduler.last_beat = time.time()
+        scheduler.fire(scheduler.heap.pop_due(time.time()))
+        self.assertEqual(s.instances.count(), 1)
+
+class ArrayHeapTest(TestCase):
+    """Tests the compact heap the Scheduler keeps schedules in."""
+    
+    def test_order(self):
+        entries = [(random.random(), random.randint(0, 1), i)
+            for i in range(500)]
+        heap = ArrayHeap(entries[:250])
+        for e in entries[250:]:
+            heap.push(*e)
+        self.assertEqual([heap.pop() for _ in range(500)], sorted(entries))
+        self.assertRaises(IndexError, heap.pop)
+    
+    def test_pop_due(self):
+        heap = ArrayHeap([(t, 0, t) for t in range(10)])
+        self.assertEqual(len(heap.pop_due(4.5, 3)), 3)
+        self.assertEqual([e[2] for e in heap.pop_due(4.5)], [3, 4])
+        self.assertEqual(heap.peek(), (5, 0, 5))
+        self.assertEqual(heap.nbytes, 5 * (8 + 1 + heap.ids.itemsize))
+    
+    def test_discard(self):
+        heap = ArrayHeap([(10 - i, i % 2, i) for i in range(10)])
+        self.assertEqual(heap.discard(set([(1, 9), (0, 4), (1, 4)])), 2)
+        popped = [heap.pop()[2] for _ in range(len(heap))]
+        self.assertEqual(popped, [8, 7, 6, 5, 3, 2, 1, 0])
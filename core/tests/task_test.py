@@ -3,9 +3,11 @@
 
 import os, sys
 import time
+import tempfile
 
 from django.test import TestCase
 
+from norc import settings
 from norc.core.models import CommandTask, Instance, Revision
 from norc.core.constants import Status
 from norc.norc_utils import log
@@ -91,11 +93,41 @@ class TestTask(TestCase):
         instance.finally_ = finally_
         self.assertEqual(Status.TIMEDOUT, self.run_instance(instance).status)
     
+    def output(self, capture):
+        """Runs a command with the given LOG_CAPTURE; returns its log."""
+        t = CommandTask.objects.create(command='echo out; echo err >&2')
+        instance = Instance.objects.create(task=t)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        instance.log = log.Log(path)
+        old_capture = settings.LOG_CAPTURE
+        settings.LOG_CAPTURE = capture
+        try:
+            try:
+                instance.start()
+            except SystemExit:
+                pass
+            return open(path).read()
+        finally:
+            settings.LOG_CAPTURE = old_capture
+            os.remove(path)
+    
+    def test_output(self):
+        """Tests that a command's output ends up in the log file."""
+        for capture in ['hook', 'fd']:
+            written = self.output(capture)
+            self.assertTrue(
+                written.index('Starting') < written.index('\nout\n'))
+            self.assertTrue('\nerr\n' in written)
+            self.assertTrue(
+                written.index('$ echo out') < written.index('\nout\n'))
+            self.assertTrue(written.rstrip().endswith('status SUCCESS.'))
+    
     def test_nameless(self):
         "Tests that a task can be nameless."
         t = CommandTask.objects.create(command="echo 'Nameless!'")
         self.assertEqual(Status.SUCCESS, self.run_task(t))
-
+    
     def test_revisions(self):
         r = Revision.objects.create(info="rev")
         t = CommandTask.objects.create(command="ls")
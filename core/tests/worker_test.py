@@ -0,0 +1,96 @@
+"""Tests for the Executor's pre-forked worker pool."""
+
+import os
+import signal
+import time
+
+from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import CommandTask, Instance
+from norc.core.workers import WorkerPool
+from norc.norc_utils import wait_until
+
+class WorkerPoolTest(TestCase):
+    """Tests running instances on pooled workers.
+    
+    Workers are forked with a copy of the test database, so their changes
+    to it can't be seen here; exit statuses are checked instead.
+    
+    """
+    def setUp(self):
+        self.pool = None
+        self.ct = ContentType.objects.get_for_model(Instance)
+    
+    def make_instances(self, command, n=1, timeout=0):
+        task = CommandTask.objects.create(name=command,
+            command=command, timeout=timeout)
+        return [Instance.objects.create(task=task) for _ in range(n)]
+    
+    def finish(self, p):
+        wait_until(lambda: p.poll() != None, 10, 0.05)
+        return p.returncode
+    
+    def test_exit_status(self):
+        success, = self.make_instances('true')
+        failure, = self.make_instances('false')
+        self.pool = WorkerPool(2, 10, 1024)
+        p1 = self.pool.start(self.ct.pk, success)
+        p2 = self.pool.start(self.ct.pk, failure)
+        self.assertNotEqual(p1.pid, p2.pid)
+        self.assertEqual(self.finish(p1), 0)
+        self.assertEqual(self.finish(p2), 1)
+    
+    def test_reuse(self):
+        instances = self.make_instances('true', 3)
+        self.pool = WorkerPool(1, 10, 1024)
+        pids = set()
+        for i in instances:
+            p = self.pool.start(self.ct.pk, i)
+            self.assertEqual(self.finish(p), 0)
+            pids.add(p.pid)
+        self.assertEqual(len(pids), 1)
+    
+    def test_recycle(self):
+        instances = self.make_instances('true', 2)
+        self.pool = WorkerPool(1, 1, 1024)
+        p1 = self.pool.start(self.ct.pk, instances[0])
+        self.assertEqual(self.finish(p1), 0)
+        p2 = self.pool.start(self.ct.pk, instances[1])
+        self.assertEqual(self.finish(p2), 0)
+        self.assertNotEqual(p1.pid, p2.pid)
+    
+    def test_timeout(self):
+        instance, = self.make_instances('sleep 5', timeout=1)
+        self.pool = WorkerPool(1, 10, 1024)
+        start = time.time()
+        self.assertEqual(self.finish(self.pool.start(self.ct.pk, instance)), 1)
+        self.assertTrue(time.time() - start < 4)
+    
+    def test_kill(self):
+        instances = self.make_instances('sleep 5', 2)
+        self.pool = WorkerPool(1, 10, 1024)
+        p = self.pool.start(self.ct.pk, instances[0])
+        time.sleep(1)
+        os.kill(p.pid, signal.SIGTERM)
+        self.assertEqual(self.finish(p), 1)
+        # The dead worker is replaced.
+        p = self.pool.start(self.ct.pk, instances[1])
+        self.assertNotEqual(p.poll(), 1)
+        os.kill(p.pid, signal.SIGKILL)
+        self.assertEqual(self.finish(p), -signal.SIGKILL)
+    
+    def test_inherited(self):
+        instance, = self.make_instances('true')
+        self.pool = WorkerPool(0, 10, 1024)
+        r, w = os.pipe()
+        self.pool.inherited = [r, w]
+        self.assertEqual(self.finish(self.pool.start(self.ct.pk, instance)), 0)
+        # The worker closed its copy, so closing ours ends the pipe.
+        os.close(w)
+        self.assertEqual(os.read(r, 1), '')
+        os.close(r)
+    
+    def tearDown(self):
+        if self.pool:
+            self.pool.close()
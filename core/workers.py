@@ -0,0 +1,273 @@
+"""A pool of pre-forked worker processes for running instances.
+
+Starting every instance with norc_taskrunner means paying for a shell, a
+new Python interpreter, Django setup and a database connection before
+the task even begins.  Workers are instead forked from the Executor once
+all of that is loaded, and then run instance after instance, each one
+received over a pipe.
+
+A worker stands in for the taskrunner process of the instance it is
+running: signals sent to its pid reach the instance's handlers, and a
+timeout or kill ends the worker just as it would have ended the
+taskrunner.  Workers retire themselves after running too many tasks or
+growing too large, and are replaced as they are needed.
+
+The pool is forked before the Executor starts any threads (see
+Executor.prepare()), but replacements are forked from the running
+Executor.  Norc's own logs are reset by log.fork() and the database
+connection is reopened by the worker, but any other lock one of the
+Executor's threads holds at that moment, such as one in a library a
+task uses, is inherited held and may deadlock the replacement.
+
+"""
+
+import os
+import sys
+import errno
+import fcntl
+import signal
+import resource
+import traceback
+
+from django.db import connection, transaction, reset_queries
+from django.contrib.contenttypes.models import ContentType
+
+from norc.norc_utils.log import make_log, fork
+
+def rss_mb():
+    """The resident set size of this process, in megabytes."""
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * resource.getpagesize() / (1024.0 * 1024)
+    except (IOError, IndexError, ValueError):
+        # Without procfs the peak size is the best we can do; it's
+        # given in bytes on OS X and in kilobytes elsewhere.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak /= 1024.0
+        return peak / 1024.0
+
+def exit_code(status):
+    """Converts a waitpid() status to a Popen-style return code."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def set_cloexec(fd):
+    """Keeps fd from leaking into processes the task itself starts."""
+    fcntl.fcntl(fd, fcntl.F_SETFD,
+        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+class WorkerPool(object):
+    """A set of warm worker processes owned by one Executor."""
+    
+    def __init__(self, size, max_tasks, max_rss):
+        """ Parameters:
+        
+        size        How many workers to fork up front.
+        max_tasks   Workers retire after running this many instances.
+        max_rss     Workers retire after growing past this many MB.
+        
+        """
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        # Descriptors of the Executor that workers close after forking.
+        self.inherited = []
+        self.workers = []
+        for _ in range(size):
+            self.workers.append(Worker(self))
+    
+    def start(self, ct_pk, instance):
+        """Runs an instance on an idle worker.
+        
+        Returns an object with the pid, poll() and returncode attributes
+        of the Popen object that would have run the instance otherwise.
+        
+        """
+        for w in self.workers[:]:
+            if not w.busy:
+                if not w.retiring and w.reap() == None:
+                    return w.run(ct_pk, instance)
+                self.workers.remove(w)
+                w.close()
+        w = Worker(self)
+        self.workers.append(w)
+        return w.run(ct_pk, instance)
+    
+    def close(self):
+        """Shuts down idle workers; busy ones are left to finish."""
+        for w in self.workers:
+            w.close(wait=not w.busy)
+        self.workers = []
+    
+
+class WorkerProcess(object):
+    """Stands in for the Popen object of an instance run by a worker."""
+    
+    def __init__(self, worker, instance):
+        self.worker = worker
+        self.pid = worker.pid
+        self.instance = instance
+        self.returncode = None
+    
+    def poll(self):
+        if self.returncode == None:
+            self.returncode = self.worker.poll()
+        return self.returncode
+    
+
+class Worker(object):
+    """The Executor's handle on a single worker process."""
+    
+    def __init__(self, pool):
+        self.busy = False
+        self.retiring = False
+        self.returncode = None
+        self.buffer = ''
+        tasks_r, self.tasks_w = os.pipe()
+        self.results_r, results_w = os.pipe()
+        # The parent's connection can't be shared, so it is closed here
+        # and reopened by each process as it is needed.
+        connection.close()
+        self.pid = fork()
+        if self.pid == 0:
+            code = 1
+            try:
+                try:
+                    os.close(self.tasks_w)
+                    os.close(self.results_r)
+                    for w in pool.workers:
+                        os.close(w.tasks_w)
+                        os.close(w.results_r)
+                    for fd in pool.inherited:
+                        os.close(fd)
+                    serve(tasks_r, results_w, pool.max_tasks, pool.max_rss)
+                    code = 0
+                except:
+                    traceback.print_exc()
+            finally:
+                os._exit(code)
+        os.close(tasks_r)
+        os.close(results_w)
+        set_cloexec(self.tasks_w)
+        set_cloexec(self.results_r)
+        fcntl.fcntl(self.results_r, fcntl.F_SETFL,
+            fcntl.fcntl(self.results_r, fcntl.F_GETFL) | os.O_NONBLOCK)
+    
+    def run(self, ct_pk, instance):
+        """Sends an instance to the worker."""
+        os.write(self.tasks_w, '%s %s\n' % (ct_pk, instance.pk))
+        self.busy = True
+        return WorkerProcess(self, instance)
+    
+    def poll(self):
+        """The return code of the current instance, or None if running."""
+        try:
+            self.buffer += os.read(self.results_r, 64)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        if '\n' in self.buffer:
+            line, self.buffer = self.buffer.split('\n', 1)
+            code, retiring = map(int, line.split())
+            self.busy = False
+            self.retiring = bool(retiring)
+            return code
+        # Timeouts and kills end the worker along with its instance.
+        if self.reap() != None:
+            self.busy = False
+            return self.returncode
+        return None
+    
+    def reap(self):
+        """The return code of the worker itself, or None if it's alive."""
+        if self.returncode == None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = exit_code(status)
+        return self.returncode
+    
+    def close(self, wait=True):
+        """Closes the pipes, which tells an idle worker to exit."""
+        os.close(self.tasks_w)
+        os.close(self.results_r)
+        if wait and self.returncode == None:
+            self.returncode = exit_code(os.waitpid(self.pid, 0)[1])
+    
+
+def serve(tasks_fd, results_fd, max_tasks, max_rss):
+    """The main loop of a worker process.
+    
+    Runs the instances read from tasks_fd one at a time, and answers each
+    with a line holding its exit status and whether the worker is about
+    to retire.
+    
+    """
+    # Shed the Executor's handlers.  Between instances a worker ignores
+    # interrupts from the terminal, since there is nothing to interrupt.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    set_cloexec(tasks_fd)
+    set_cloexec(results_fd)
+    tasks = os.fdopen(tasks_fd)
+    done = 0
+    for line in iter(tasks.readline, ''):
+        ct_pk, target_pk = map(int, line.split())
+        code = run_instance(ct_pk, target_pk)
+        done += 1
+        retiring = done >= max_tasks or rss_mb() > max_rss
+        os.write(results_fd, '%s %s\n' % (code, int(retiring)))
+        # Wake the Executor just like a taskrunner exiting would.
+        try:
+            os.kill(os.getppid(), signal.SIGCHLD)
+        except OSError:
+            pass
+        if retiring:
+            break
+
+def run_instance(ct_pk, target_pk):
+    """Starts an instance in this process, returning its exit status.
+    
+    Output goes to the instance's log, exactly as norc_taskrunner's
+    output does when the Executor starts it.
+    
+    """
+    # Make sure nothing is read from a stale transaction.
+    transaction.commit_unless_managed()
+    ct = ContentType.objects.get_for_id(ct_pk)
+    instance = ct.get_object_for_this_type(pk=target_pk)
+    instance.log = make_log(instance.log_path)
+    saved = os.dup(1), os.dup(2)
+    os.dup2(instance.log.file.fileno(), 1)
+    os.dup2(instance.log.file.fileno(), 2)
+    try:
+        try:
+            instance.start()
+        except SystemExit, e:
+            if e.code == None:
+                return 0
+            return e.code if type(e.code) == int else 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        return 0
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        instance.log.close()
+        reset_queries()
@@ -32,6 +32,41 @@ class BaseEnv(object):
     NORC_LOG_DIR = os.path.join(NORC_DIRECTORY, 'log/')
     NORC_TMP_DIR = os.path.join(NORC_DIRECTORY, 'tmp/')
     BACKUP_SYSTEM = None
+    # Logs are backed up as a zlib stream uploaded in parts of this many
+    # bytes, so only a part at a time is held in memory.  S3's minimum is
+    # 5MB.  See norc_utils/backup.py.
+    BACKUP_PART_SIZE = 8 * 1024 * 1024
+    # Executors back up instance logs with this many threads.  Logs past
+    # the first BACKUP_QUEUE_LIMIT waiting are spilled to a file in
+    # NORC_TMP_DIR, and an Executor shutting down waits at most
+    # BACKUP_SHUTDOWN_TIMEOUT seconds before leaving the rest there for
+    # the next Executor on the host.
+    BACKUP_THREADS = 2
+    BACKUP_QUEUE_LIMIT = 1000
+    BACKUP_SHUTDOWN_TIMEOUT = 10
+    # Another S3-compatible server to back up to, such as a local stand-in
+    # for testing; None is Amazon's.
+    BACKUP_HOST = None
+    BACKUP_PORT = None
+    BACKUP_SECURE = True
+    # How DBQueues claim items on pop: 'auto', 'skip_locked' or 'update'.
+    # See DBQueue.pop_from() in core/models/queue.py.
+    DBQUEUE_POP_MODE = 'auto'
+    # Wakes daemons on pushes and requests: None, 'UnixSocket' (same host
+    # only) or 'PostgreSQL' (LISTEN/NOTIFY).  See norc_utils/notify.py.
+    NOTIFY_SYSTEM = None
+    # How long SQSQueue pops wait for a message to arrive, in seconds (at
+    # most 20).  An Executor on an empty SQSQueue may take this long to
+    # notice requests and finished instances.
+    SQS_WAIT_TIME = 5
+    # The Redis server used by RedisQueues, and how long their pops wait
+    # for a push when the queue is empty.  See redisq/models.py.
+    REDIS_HOST = 'localhost'
+    REDIS_PORT = 6379
+    REDIS_DB = 0
+    REDIS_WAIT_TIME = 1
+    # How long LocalQueue pops wait for a push when the queue is empty.
+    LOCALQUEUE_WAIT_TIME = 1
     # See core/reports.py for options.
     STATUS_TABLES = ['executors', 'queues', 'schedulers', 'tasks']
     EXTERNAL_CLASSES = [];
@@ -72,6 +107,18 @@ class BaseEnv(object):
     # Debugging switches.
     DEBUG = False
     LOGGING_DEBUG = False
+    # Bytes of log messages held in memory before being written out, and
+    # the most seconds they're held.  Errors are written at once.  The
+    # default of 0 writes every message as it's logged, so none are lost
+    # if a process is killed; 64 * 1024 cuts the cost of busy logs.  See
+    # norc_utils/log.py.
+    LOG_BUFFER_SIZE = 0
+    LOG_FLUSH_INTERVAL = 1
+    # How instances capture their output.  'hook' (the default) swaps
+    # sys.stdout and sys.stderr for a LogHook, which only sees Python's
+    # output; 'fd' points file descriptors 1 and 2 at the log file, so
+    # output from subprocesses and C extensions goes straight to disk.
+    LOG_CAPTURE = 'hook'
     TEMPLATE_DEBUG = False
     
     # Miscellaneous Django settings.
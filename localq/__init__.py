@@ -0,0 +1 @@
+"""A Norc queue in a memory-mapped file; see models.py and README."""
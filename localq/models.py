@@ -0,0 +1,280 @@
+import os
+import errno
+import fcntl
+import mmap
+import select
+import struct
+from threading import Lock
+
+from django.db.models import PositiveIntegerField
+from django.db.models.signals import post_delete
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import Queue
+from norc.norc_utils import notify
+from norc.norc_utils.django_extras import bulk_generic_objects
+from norc.settings import NORC_TMP_DIR, LOCALQUEUE_WAIT_TIME
+
+# The header holds a magic string, the capacity in records, and the
+# positions of the next record to pop and the next to push.
+MAGIC = 'NORCRING'
+HEADER = struct.Struct('=8sQQQ')
+HEAD = 16
+TAIL = 24
+# Records start a page in, so the header never shares a page with them.
+DATA = mmap.PAGESIZE
+
+# Each record is its position plus one, which marks it as written, and
+# the item's (content type pk, object pk).
+RECORD = struct.Struct('=QQQ')
+POSITION = struct.Struct('=Q')
+
+class LocalQueueFull(Exception):
+    """Raised when a push doesn't fit in a LocalQueue."""
+    pass
+
+class Ring(object):
+    """A ring buffer of records in a memory-mapped file.
+    
+    Any number of processes on the host can share a ring.  Changes are
+    made under an exclusive flock on the file (and a lock for threads
+    sharing the mapping), and a push only becomes visible once all of
+    its records are written, so a process that dies midway loses
+    nothing.  Poppers wait for pushes by select()ing on a named pipe
+    that pushers write a byte to.
+    
+    """
+    def __init__(self, path, capacity):
+        self.path = path
+        self.lock = Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        self.flock()
+        try:
+            header = os.read(self.fd, HEADER.size)
+            if len(header) == HEADER.size:
+                magic, capacity, _, _ = HEADER.unpack(header)
+                assert magic == MAGIC, "%s isn't a LocalQueue." % path
+            else:
+                os.ftruncate(self.fd, DATA + capacity * RECORD.size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, HEADER.pack(MAGIC, capacity, 0, 0))
+        finally:
+            self.unflock()
+        self.capacity = capacity
+        self.map = mmap.mmap(self.fd, DATA + capacity * RECORD.size)
+        self.fifo_path = path + '.fifo'
+        try:
+            os.mkfifo(self.fifo_path, 0644)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.fifo = None
+    
+    def flock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+    
+    def unflock(self):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+    
+    def get(self, offset):
+        return POSITION.unpack_from(self.map, offset)[0]
+    
+    def set(self, offset, value):
+        POSITION.pack_into(self.map, offset, value)
+    
+    def offset(self, position):
+        return DATA + (position % self.capacity) * RECORD.size
+    
+    def count(self):
+        # The head never passes the tail, so read it first.
+        head = self.get(HEAD)
+        return self.get(TAIL) - head
+    
+    def push(self, pairs):
+        """Appends (content type pk, pk) pairs, all or none."""
+        self.lock.acquire()
+        self.flock()
+        try:
+            tail = self.get(TAIL)
+            if tail - self.get(HEAD) + len(pairs) > self.capacity:
+                raise LocalQueueFull("%s can't fit %s more items." %
+                    (self.path, len(pairs)))
+            for i, (ct_pk, pk) in enumerate(pairs):
+                RECORD.pack_into(self.map, self.offset(tail + i),
+                    tail + i + 1, ct_pk, pk)
+            self.set(TAIL, tail + len(pairs))
+        finally:
+            self.unflock()
+            self.lock.release()
+        self.wake()
+    
+    def read(self, head, n):
+        """Up to n pairs from head on, stopping at any unwritten record."""
+        pairs = []
+        for position in xrange(head, head + n):
+            mark, ct_pk, pk = RECORD.unpack_from(self.map,
+                self.offset(position))
+            if mark != position + 1:
+                break
+            pairs.append((ct_pk, pk))
+        return pairs
+    
+    def peek(self):
+        self.lock.acquire()
+        self.flock()
+        try:
+            pairs = self.read(self.get(HEAD), min(1, self.count()))
+        finally:
+            self.unflock()
+            self.lock.release()
+        return pairs[0] if pairs else None
+    
+    def pop(self, n):
+        """Removes and returns up to n pairs from the front."""
+        self.lock.acquire()
+        self.flock()
+        try:
+            head = self.get(HEAD)
+            pairs = self.read(head, min(n, self.count()))
+            self.set(HEAD, head + len(pairs))
+        finally:
+            self.unflock()
+            self.lock.release()
+        return pairs
+    
+    def wake(self):
+        """Wakes poppers waiting on the ring, if there are any."""
+        try:
+            fd = os.open(self.fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError, e:
+            # Nobody has the pipe open for reading, so nobody's waiting.
+            if e.errno == errno.ENXIO:
+                return
+            raise
+        try:
+            os.write(fd, '!')
+        except OSError, e:
+            # A full pipe will wake them anyway.
+            if e.errno != errno.EAGAIN:
+                raise
+        finally:
+            os.close(fd)
+    
+    def drain(self):
+        try:
+            while os.read(self.fifo, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+    
+    def wait(self, timeout):
+        """Waits up to timeout seconds for a push; False if none came.
+        
+        Wakeups are drained before the ring is checked, so a push made
+        after the check still leaves a byte that ends the wait.
+        
+        """
+        if self.fifo == None:
+            # Opened for writing too, so that the pipe never reports EOF
+            # once pushers have come and gone.
+            self.fifo = os.open(self.fifo_path, os.O_RDWR | os.O_NONBLOCK)
+        self.drain()
+        if self.count() > 0:
+            return True
+        ready = select.select([self.fifo], [], [], timeout)[0]
+        return bool(ready) or self.count() > 0
+    
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+        if self.fifo != None:
+            os.close(self.fifo)
+    
+
+# Rings opened by this process, by queue name.
+_RINGS = {}
+
+def ring_path(name):
+    return os.path.join(NORC_TMP_DIR, 'localqueues', '%s.ring' % name)
+
+class LocalQueue(Queue):
+    """A queue for pipelines whose producers and consumers share a host.
+    
+    Items are kept in a ring buffer in NORC_TMP_DIR/localqueues, shared
+    through a memory-mapped file rather than a database or server, and
+    popped in the order they were pushed; there are no priorities.  Like
+    SQSQueue, popping removes items.  When the queue is empty, pops wait
+    up to LOCALQUEUE_WAIT_TIME seconds for a push.
+    
+    """
+    class Meta:
+        app_label = 'localq'
+        db_table = 'norc_localqueue'
+    
+    # How many items the ring can hold; fixed once its file exists.
+    capacity = PositiveIntegerField(default=65536)
+    
+    @property
+    def ring(self):
+        """This process's Ring for the queue, opened on first use."""
+        pid, ring = _RINGS.get(self.name, (None, None))
+        if pid != os.getpid():
+            path = ring_path(self.name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            ring = Ring(path, self.capacity)
+            _RINGS[self.name] = (os.getpid(), ring)
+        return ring
+    
+    def peek(self):
+        pair = self.ring.peek()
+        if pair != None:
+            return bulk_generic_objects([pair])[0]
+    
+    def pop(self, timeout=None):
+        items = self.pop_many(1, timeout)
+        return items[0] if items else None
+    
+    def pop_many(self, n, timeout=None):
+        """Pops up to n items, waiting up to timeout seconds (by default
+        LOCALQUEUE_WAIT_TIME) for a push if the queue is empty."""
+        if n < 1:
+            return []
+        pairs = self.ring.pop(n)
+        wait = LOCALQUEUE_WAIT_TIME if timeout == None else timeout
+        if not pairs and wait:
+            if self.ring.wait(wait):
+                pairs = self.ring.pop(n)
+        return [o for o in bulk_generic_objects(pairs) if o != None]
+    
+    def push(self, item, priority=None):
+        """Adds an item to the queue.  There are no priorities."""
+        self.push_many([item])
+    
+    def push_many(self, items, priority=None):
+        """Adds the items to the queue; if they don't all fit, none are."""
+        pairs = []
+        for item in items:
+            Queue.validate(item)
+            content_type = ContentType.objects.get_for_model(item)
+            pairs.append((content_type.pk, item.pk))
+        if pairs:
+            self.ring.push(pairs)
+            notify.notify(notify.channel(self))
+    
+    def count(self):
+        return self.ring.count()
+    
+
+def _delete_ring(sender, instance, **kwargs):
+    """Deletes the files of a deleted queue, like DBQueue's cascade."""
+    pid, ring = _RINGS.pop(instance.name, (None, None))
+    if pid == os.getpid():
+        ring.close()
+    path = ring_path(instance.name)
+    for p in [path, path + '.fifo']:
+        if os.path.exists(p):
+            os.remove(p)
+
+post_delete.connect(_delete_ring, sender=LocalQueue)
@@ -0,0 +1,110 @@
+"""Unit tests for the norc.localq module."""
+
+import os
+import time
+from threading import Thread
+
+from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import Instance
+from norc.localq.models import (LocalQueue, LocalQueueFull, Ring,
+    ring_path, _RINGS)
+from norc.norc_utils.testing import make_instance
+
+class LocalQueueTest(TestCase):
+    """Tests pushing and popping with a LocalQueue."""
+    
+    def setUp(self):
+        self.queue = LocalQueue.objects.create(name='test', capacity=4)
+        self.item = make_instance()
+    
+    def new_instances(self, n):
+        return [Instance.objects.create(task=self.item.task)
+            for _ in range(n)]
+    
+    def test_push_peek_pop(self):
+        self.queue.push(self.item)
+        self.assertEqual(self.queue.count(), 1)
+        self.assertEqual(self.queue.peek(), self.item)
+        self.assertEqual(self.queue.pop(), self.item)
+        self.assertEqual(self.queue.count(), 0)
+        self.assertEqual(self.queue.peek(), None)
+    
+    def test_wraparound(self):
+        """Test that items keep their order around the end of the ring."""
+        items = self.new_instances(10)
+        popped = []
+        for i in range(0, 10, 3):
+            self.queue.push_many(items[i:i + 3])
+            popped.extend(self.queue.pop_many(2))
+            popped.extend(self.queue.pop_many(self.queue.count()))
+        self.assertEqual(popped, items)
+    
+    def test_full(self):
+        """Test that a push that doesn't fit adds nothing."""
+        items = self.new_instances(5)
+        self.queue.push_many(items[:3])
+        self.assertRaises(LocalQueueFull,
+            lambda: self.queue.push_many(items[3:]))
+        self.assertEqual(self.queue.count(), 3)
+        self.queue.push(items[3])
+        self.assertEqual(self.queue.pop_many(5), items[:4])
+    
+    def test_reopen(self):
+        """Test that the ring outlives the process that opened it."""
+        items = self.new_instances(3)
+        self.queue.push_many(items)
+        self.queue.pop()
+        _RINGS.clear()
+        self.assertEqual(self.queue.pop_many(3), items[1:])
+    
+    def test_unwritten(self):
+        """Test that a record not marked as written isn't popped."""
+        ring = Ring(ring_path('test'), 4)
+        ring.push([(1, 2), (3, 4)])
+        # As if the first push's marks had never been written.
+        for position in range(2):
+            ring.map[ring.offset(position):ring.offset(position) + 8] = \
+                '\0' * 8
+        self.assertEqual(ring.pop(2), [])
+        ring.close()
+    
+    def test_blocking_pop(self):
+        """Test that a waiting pop gets an item as soon as it's pushed."""
+        ContentType.objects.get_for_model(self.item)
+        def push():
+            time.sleep(0.1)
+            self.queue.push(self.item)
+        t = Thread(target=push)
+        t.start()
+        self.assertEqual(self.queue.pop(), self.item)
+        t.join(5)
+    
+    def test_no_wait(self):
+        """Test that a pop with a timeout of 0 returns at once."""
+        start = time.time()
+        self.assertEqual(self.queue.pop_many(1, timeout=0), [])
+        self.assertTrue(time.time() - start < 0.5)
+    
+    def test_other_process(self):
+        """Test that items pushed by another process are popped here."""
+        ContentType.objects.get_for_model(self.item)
+        self.queue.ring.wait(0)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                time.sleep(0.1)
+                self.queue.push(self.item)
+            finally:
+                os._exit(0)
+        self.assertEqual(self.queue.pop(), self.item)
+        os.waitpid(pid, 0)
+    
+    def test_invalid(self):
+        self.assertRaises(AssertionError, lambda: self.queue.push(self.queue))
+    
+    def tearDown(self):
+        self.queue.delete()
+        self.assertFalse(os.path.exists(ring_path('test')))
+
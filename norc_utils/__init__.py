@@ -2,6 +2,7 @@
 """Some very generic utility functions."""
 
 import time
+import calendar
 
 def wait_until(cond, timeout=60, freq=0.5):
     """Tests the condition repeatedly until <timeout> seconds have passed."""
@@ -17,3 +18,7 @@ def search(ls, cond):
         if cond(e):
             return e
     return None
+
+def timestamp(dt):
+    """Converts a UTC datetime to a timestamp comparable to time.time()."""
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
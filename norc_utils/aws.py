@@ -1,28 +1,117 @@
-
+import os
 import zlib
+from itertools import chain
+from threading import local
+from cStringIO import StringIO
 
-from boto.s3.connection import S3Connection
+from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 from boto.s3.key import Key
 
 from norc.settings import (NORC_LOG_DIR, BACKUP_SYSTEM,
-    AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_BUCKET_NAME)
+    AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, AWS_BUCKET_NAME,
+    BACKUP_HOST, BACKUP_PORT, BACKUP_SECURE)
+
+# How many times each request of an upload is tried.
+NUM_TRIES = 3
+
+class S3Pool(object):
+    """Hands out S3 connections and buckets, one set per thread.
+    
+    Like SQSPool, every thread of every process gets its own connection
+    the first time it needs one, since boto connections can't be shared,
+    and buckets are cached by name so that they're only looked up once.
+    
+    """
+    def __init__(self):
+        self.local = local()
+    
+    def state(self):
+        """This thread's connection and buckets, reset after a fork."""
+        state = self.local
+        if getattr(state, 'pid', None) != os.getpid():
+            state.pid = os.getpid()
+            state.connection = None
+            state.buckets = {}
+        return state
+    
+    def connection(self):
+        state = self.state()
+        if state.connection == None:
+            if BACKUP_HOST:
+                # Anything but Amazon only takes bucket names in the path.
+                state.connection = S3Connection(AWS_ACCESS_KEY_ID,
+                    AWS_SECRET_ACCESS_KEY, host=BACKUP_HOST,
+                    port=BACKUP_PORT, is_secure=BACKUP_SECURE,
+                    calling_format=OrdinaryCallingFormat())
+            else:
+                state.connection = S3Connection(AWS_ACCESS_KEY_ID,
+                    AWS_SECRET_ACCESS_KEY, is_secure=BACKUP_SECURE)
+        return state.connection
+    
+    def bucket(self, name):
+        """The named bucket, which is created if missing."""
+        state = self.state()
+        bucket = state.buckets.get(name)
+        if bucket == None:
+            c = self.connection()
+            bucket = c.lookup(name)
+            if not bucket:
+                bucket = c.create_bucket(name)
+            state.buckets[name] = bucket
+        return bucket
+    
+
+POOL = S3Pool()
 
 def get_s3_connection():
-    return S3Connection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+    return POOL.connection()
 
 def get_s3_bucket(name=AWS_BUCKET_NAME):
-    c = get_s3_connection()
-    b = c.get_bucket(name)
-    if not b:
-        b = c.create_bucket(AWS_BUCKET_NAME)
-    return b
+    return POOL.bucket(name)
+
+def retry(func, *args):
+    """Calls func up to NUM_TRIES times, until it doesn't raise."""
+    for i in range(NUM_TRIES):
+        try:
+            return func(*args)
+        except Exception:
+            if i == NUM_TRIES - 1:
+                raise
+
+def upload_s3_parts(key, parts):
+    """Uploads the concatenation of the strings in parts to key.
+    
+    parts may be a generator, and is consumed one part at a time; every
+    part but the last must be at least 5MB.  A single part is uploaded
+    with one PUT, and more with a multipart upload, retrying each part
+    on its own.  A failed multipart upload is aborted, so that S3 doesn't
+    keep (and charge for) the parts already sent.
+    
+    """
+    parts = iter(parts)
+    first = next(parts, '')
+    second = next(parts, None)
+    bucket = get_s3_bucket()
+    if second == None:
+        k = Key(bucket)
+        k.key = key
+        retry(k.set_contents_from_string, first)
+        return
+    upload = retry(bucket.initiate_multipart_upload, key)
+    try:
+        for i, part in enumerate(chain([first, second], parts)):
+            retry(lambda: upload.upload_part_from_file(StringIO(part), i + 1))
+        retry(upload.complete_upload)
+    except:
+        upload.cancel_upload()
+        raise
 
 def set_s3_key(key, contents):
-    k = Key(get_s3_bucket())
-    k.key = key
-    if not isinstance(contents, basestring):
-        contents = contents.read()
-    k.set_contents_from_string(zlib.compress(contents, 9))
+    # Imported here because backup imports this module.
+    from norc.norc_utils.backup import compressed_parts, BACKUP_PART_SIZE
+    if isinstance(contents, basestring):
+        contents = StringIO(contents)
+    upload_s3_parts(key, compressed_parts(contents, BACKUP_PART_SIZE))
 
 def get_s3_key(key, target=None):
     k = Key(get_s3_bucket())
@@ -1,24 +1,49 @@
-
 import os
+import time
+import zlib
+import fcntl
+from collections import deque
+from threading import Thread, Condition
 
-from norc.settings import NORC_LOG_DIR, BACKUP_SYSTEM
+from norc.settings import (NORC_LOG_DIR, NORC_TMP_DIR, BACKUP_SYSTEM,
+    BACKUP_PART_SIZE)
 
 if BACKUP_SYSTEM == 'AmazonS3':
-    from norc.norc_utils.aws import set_s3_key
-    from norc.settings import (AWS_ACCESS_KEY_ID,
-        AWS_SECRET_ACCESS_KEY, AWS_BUCKET_NAME)
+    from norc.norc_utils.aws import upload_s3_parts
+
+# How much of a file is read and compressed at a time.
+CHUNK_SIZE = 256 * 1024
 
+# zlib's default; 9 costs several times the CPU for a few percent less.
+COMPRESSION_LEVEL = 6
+
+def compressed_parts(fp, part_size, level=COMPRESSION_LEVEL):
+    """Yields the zlib stream of fp's contents in parts of part_size bytes.
+    
+    Only the last part may be smaller, and the file is read CHUNK_SIZE
+    bytes at a time, so at most a part and a chunk are held in memory
+    however large the file is.
+    
+    """
+    z = zlib.compressobj(level)
+    part = []
+    size = 0
+    while True:
+        chunk = fp.read(CHUNK_SIZE)
+        data = z.compress(chunk) if chunk else z.flush()
+        part.append(data)
+        size += len(data)
+        while size >= part_size or (not chunk and size):
+            data = ''.join(part)
+            yield data[:part_size]
+            part = [data[part_size:]]
+            size = len(part[0])
+        if not chunk:
+            break
 
 def s3_backup(fp, target):
-    NUM_TRIES = 3
-    for i in range(NUM_TRIES):
-        try:
-            set_s3_key(target, fp)
-            return True
-        except:
-            if i == NUM_TRIES - 1:
-                raise
-    return False
+    upload_s3_parts(target, compressed_parts(fp, BACKUP_PART_SIZE))
+    return True
 
 BACKUP_SYSTEMS = {
     'AmazonS3': s3_backup,
@@ -38,3 +63,177 @@ def _backup_file(fp, target):
         return BACKUP_SYSTEMS[BACKUP_SYSTEM](fp, target)
     else:
         return False
+
+class BackupPool(object):
+    """Backs up logs in the background with a fixed number of threads.
+    
+    Logs wait in a queue of at most limit paths.  Each uploader thread
+    takes a batch of them at a time and backs them up over its own pooled
+    connection.  Paths that don't fit in the queue are spilled to a
+    pending-upload index in NORC_TMP_DIR shared by every process on the
+    host, and reloaded whenever a queue runs dry, so a backlog costs disk
+    rather than memory and outlives the process that queued it.
+    
+    """
+    # The most paths a thread takes at once.
+    BATCH_SIZE = 10
+    
+    # Seconds of uploads that bytes_per_sec is averaged over.
+    RATE_WINDOW = 60
+    
+    def __init__(self, threads, limit, log, index=None):
+        self.limit = limit
+        self.log = log
+        self.index = index or os.path.join(NORC_TMP_DIR, 'backup_pending')
+        self.cond = Condition()
+        self.pending = deque()
+        self.in_flight = set()
+        self.uploads = deque()
+        self.uploaded = 0
+        self.failed = 0
+        self.closed = False
+        self.threads = []
+        for _ in range(threads):
+            t = Thread(target=self.run)
+            # Never keep the process alive for an upload.
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+    
+    def add(self, path):
+        """Queues the log at path (relative to NORC_LOG_DIR)."""
+        self.cond.acquire()
+        try:
+            if self.closed or len(self.pending) >= self.limit:
+                self.spill([path])
+            else:
+                self.pending.append(path)
+                self.cond.notify()
+        finally:
+            self.cond.release()
+    
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.pending and not self.closed:
+                    if not self.unspill():
+                        self.cond.wait()
+                if self.closed:
+                    return
+                # Leave some for the other threads if there's little.
+                n = min(self.BATCH_SIZE, (len(self.pending) +
+                    len(self.threads) - 1) // len(self.threads))
+                batch = [self.pending.popleft() for _ in range(n)]
+                self.in_flight.update(batch)
+            finally:
+                self.cond.release()
+            for path in batch:
+                if self.closed:
+                    # close() has spilled the rest of the batch.
+                    return
+                self.upload(path)
+    
+    def upload(self, path):
+        try:
+            size = os.path.getsize(os.path.join(NORC_LOG_DIR, path))
+            if backup_log(path):
+                self.finished(path, size)
+                self.log.info("Completed upload of log %s." % path)
+            else:
+                self.finished(path, None)
+                self.log.info("Failed to upload log %s." % path)
+        except Exception:
+            self.finished(path, None)
+            self.log.error("Failed to upload log %s." % path, trace=True)
+    
+    def finished(self, path, size):
+        self.cond.acquire()
+        try:
+            self.in_flight.discard(path)
+            if size == None:
+                self.failed += 1
+            else:
+                self.uploaded += 1
+                self.uploads.append((time.time(), size))
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+    
+    def spill(self, paths):
+        """Appends paths to the host's pending-upload index."""
+        if not os.path.isdir(os.path.dirname(self.index)):
+            os.makedirs(os.path.dirname(self.index))
+        f = open(self.index, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(''.join(p + '\n' for p in paths))
+        finally:
+            f.close()
+    
+    def unspill(self):
+        """Moves up to limit paths from the index to the queue."""
+        if not os.path.exists(self.index) or \
+                os.path.getsize(self.index) == 0:
+            return 0
+        f = open(self.index, 'r+')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            paths = [p for p in f.read().splitlines() if p]
+            f.seek(0)
+            f.truncate()
+            f.write(''.join(p + '\n' for p in paths[self.limit:]))
+        finally:
+            f.close()
+        self.pending.extend(paths[:self.limit])
+        return len(paths[:self.limit])
+    
+    def spilled(self):
+        """How many paths are waiting in the index."""
+        try:
+            return len([p for p in open(self.index).read().splitlines() if p])
+        except IOError:
+            return 0
+    
+    def metrics(self):
+        """The pool's pending, in-flight, uploaded and failed counts, plus
+        the bytes per second backed up over the last RATE_WINDOW seconds."""
+        self.cond.acquire()
+        try:
+            since = time.time() - self.RATE_WINDOW
+            while self.uploads and self.uploads[0][0] < since:
+                self.uploads.popleft()
+            rate = sum([size for _, size in self.uploads]) / \
+                float(self.RATE_WINDOW)
+            return dict(pending=len(self.pending),
+                in_flight=len(self.in_flight), spilled=self.spilled(),
+                uploaded=self.uploaded, failed=self.failed,
+                bytes_per_sec=rate)
+        finally:
+            self.cond.release()
+    
+    def close(self, timeout):
+        """Stops the pool, waiting up to timeout seconds for the queue.
+        
+        Whatever is still pending or in flight then is spilled to the
+        index for the next pool on the host, so a backlog never holds up
+        shutdown for longer than that.  Returns how many were spilled.
+        
+        """
+        end = time.time() + timeout
+        self.cond.acquire()
+        try:
+            if self.closed:
+                return 0
+            while (self.pending or self.in_flight) and time.time() < end:
+                self.cond.wait(end - time.time())
+            left = list(self.pending) + list(self.in_flight)
+            self.pending.clear()
+            self.closed = True
+            self.cond.notifyAll()
+            if left:
+                self.spill(left)
+            return len(left)
+        finally:
+            self.cond.release()
+
@@ -0,0 +1,140 @@
+"""Cron schedules compiled for computing fire times in constant time."""
+
+import calendar
+from datetime import datetime, timedelta
+
+ONE_SECOND = timedelta(seconds=1)
+
+def bitmask(values):
+    """An integer with the bit of each value set."""
+    mask = 0
+    for v in values:
+        mask |= 1 << v
+    return mask
+
+def next_table(mask, size):
+    """Maps each of range(size + 1) to the first allowed value >= it.
+    
+    Values with no allowed value after them, including the sentinel
+    size itself, map to None.
+    
+    """
+    table = [None] * (size + 1)
+    following = None
+    for v in reversed(xrange(size)):
+        if mask >> v & 1:
+            following = v
+        table[v] = following
+    return table
+
+# The index of each single bit; int.bit_length() is new in 2.7.
+BIT_INDEX = dict((1 << i, i) for i in range(64))
+
+def lowest_bit(mask):
+    """The index of the lowest set bit of a positive integer below 2**64."""
+    return BIT_INDEX[mask & -mask]
+
+class CompiledCron(object):
+    """A cron schedule compiled into bitmasks and next-value tables.
+    
+    Months, hours, minutes and seconds each get a table of the first
+    allowed value at or after every possible value, so finding the next
+    fire time is a few lookups rather than scans of the allowed lists.
+    Days of the month and of the week are kept as bitmasks and combined
+    per month, since whether a day fires depends on which weekday the
+    month starts on.  Like the encoding, a day must be allowed by both.
+    
+    """
+    # How many months ahead to look before deciding that a schedule can
+    # never fire (such as on February 30th).  The Gregorian calendar
+    # repeats every 400 years.
+    HORIZON = 400 * 12
+    
+    def __init__(self, months, days, daysofweek, hours, minutes, seconds):
+        self.months = bitmask(months)
+        self.days = bitmask(days)
+        self.hours = bitmask(hours)
+        self.minutes = bitmask(minutes)
+        self.next_month = next_table(self.months, 13)
+        self.next_hour = next_table(self.hours, 24)
+        self.next_minute = next_table(self.minutes, 60)
+        self.next_second = next_table(bitmask(seconds), 60)
+        self.first_minute = min(minutes)
+        self.first_second = min(seconds)
+        # The allowed days of a 31 day month starting on each weekday.
+        self.month_days = [self.days & bitmask([d for d in range(1, 32)
+            if (first + d - 1) % 7 in daysofweek]) for first in range(7)]
+    
+    def next_after(self, dt):
+        """The first fire time after dt, or None if there never is one."""
+        dt = dt.replace(microsecond=0) + ONE_SECOND
+        time = self.time_from(dt.hour, dt.minute, dt.second)
+        if time != None and \
+                self.day_from(dt.year, dt.month, dt.day) == dt.day:
+            return datetime(dt.year, dt.month, dt.day, *time)
+        date = self.date_from(dt.year, dt.month, dt.day + 1)
+        if date == None:
+            return None
+        return datetime(*date + self.time_from(0, 0, 0))
+    
+    def next_fires(self, dt, n):
+        """The next n fire times after dt."""
+        fires = []
+        while len(fires) < n:
+            dt = self.next_after(dt)
+            if dt == None:
+                break
+            fires.append(dt)
+        return fires
+    
+    def fires_between(self, start, end):
+        """The fire times from start up to but not including end."""
+        fires = []
+        dt = self.next_after(start.replace(microsecond=0) - ONE_SECOND)
+        while dt != None and dt < end:
+            if dt >= start:
+                fires.append(dt)
+            dt = self.next_after(dt)
+        return fires
+    
+    def time_from(self, h, m, s):
+        """The first allowed time of day at or after h:m:s, or None."""
+        if self.hours >> h & 1:
+            if self.minutes >> m & 1:
+                second = self.next_second[s]
+                if second != None:
+                    return h, m, second
+            minute = self.next_minute[m + 1]
+            if minute != None:
+                return h, minute, self.first_second
+        hour = self.next_hour[h + 1]
+        if hour != None:
+            return hour, self.first_minute, self.first_second
+        return None
+    
+    def day_from(self, year, month, day):
+        """The first allowed day of a month at or after day, or None."""
+        if not self.months >> month & 1:
+            return None
+        first, length = calendar.monthrange(year, month)
+        allowed = self.month_days[first] & \
+            (((2 << length) - 1) >> day << day)
+        return lowest_bit(allowed) if allowed else None
+    
+    def date_from(self, year, month, day):
+        """The first allowed (year, month, day) on or after a date.
+        
+        day may be past the end of the month.
+        
+        """
+        for _ in xrange(self.HORIZON):
+            found = self.day_from(year, month, day)
+            if found != None:
+                return year, month, found
+            month = self.next_month[month + 1]
+            if month == None:
+                year += 1
+                month = self.next_month[1]
+            day = 1
+        return None
+
@@ -3,7 +3,13 @@
 
 import itertools
 
-from django.db.models import Manager
+from django.db import connection, transaction
+from django.db.models import Manager, AutoField, F, PositiveIntegerField
+from django.contrib.contenttypes.models import ContentType
+
+from norc import settings
+
+POSTGRESQL_ENGINES = ('postgresql', 'postgresql_psycopg2')
 
 # Replaced in Django 1.2 by QuerySet.exists()
 def queryset_exists(q):
@@ -30,6 +36,168 @@ def get_object(model, **kwargs):
 def update_obj(obj):
     return type(obj).objects.get(pk=obj.pk)
 
+# Keeps IN clauses below sqlite's limit of 999 query parameters.
+IN_BULK_CHUNK = 500
+
+def bulk_generic_objects(pairs):
+    """Loads the objects for a list of (content_type_id, pk) pairs.
+    
+    This is the bulk version of a GenericForeignKey lookup: objects are
+    fetched with one IN query per content type, rather than one query
+    per object.  The results are in the same order as pairs, with None
+    in place of any object that doesn't exist.
+    
+    """
+    pks_by_type = {}
+    for ct_id, pk in pairs:
+        pks_by_type.setdefault(ct_id, set()).add(pk)
+    objects = {}
+    for ct_id, pks in pks_by_type.iteritems():
+        manager = ContentType.objects.get_for_id(ct_id) \
+            .model_class()._default_manager
+        for pk, obj in in_bulk(manager, pks).iteritems():
+            objects[(ct_id, pk)] = obj
+    return [objects.get((ct_id, pk)) for ct_id, pk in pairs]
+
+def in_bulk(queryset, pks):
+    """QuerySet.in_bulk() for any number of pks, in IN_BULK_CHUNK chunks."""
+    pks = list(pks)
+    objects = {}
+    for i in range(0, len(pks), IN_BULK_CHUNK):
+        objects.update(queryset.in_bulk(pks[i:i + IN_BULK_CHUNK]))
+    return objects
+
+def max_query_params():
+    """How many parameters a single query can safely be given."""
+    return 999 if settings.DATABASE_ENGINE == 'sqlite3' else 10000
+
+# Whether multi-row INSERTs get consecutive ids; see consecutive_ids().
+_consecutive_ids = None
+
+def consecutive_ids(cursor):
+    """Whether the rows of each multi-row INSERT get consecutive ids.
+    
+    MySQL's InnoDB only guarantees it with innodb_autoinc_lock_mode set
+    to 0 or 1, not 2, the default since MySQL 8.0.  The mode can't be
+    changed while the server runs, so it's only checked once.
+    
+    """
+    global _consecutive_ids
+    if _consecutive_ids == None:
+        _consecutive_ids = True
+        if settings.DATABASE_ENGINE == 'mysql':
+            cursor.execute("SELECT @@innodb_autoinc_lock_mode")
+            _consecutive_ids = int(cursor.fetchone()[0]) != 2
+    return _consecutive_ids
+
+def bulk_insert(objects):
+    """Inserts new model objects of one class with multi-row INSERTs.
+    
+    This is much faster than calling save() on each object, but sends no
+    signals.  The objects' primary keys are set afterwards, returned by
+    the INSERT on PostgreSQL.  Elsewhere they're worked out from the
+    last id inserted, unless the ids of an INSERT may not be consecutive
+    (see consecutive_ids()), in which case the rows are inserted one at
+    a time.
+    
+    """
+    if not objects:
+        return objects
+    opts = type(objects[0])._meta
+    qn = connection.ops.quote_name
+    fields = [f for f in opts.local_fields if not isinstance(f, AutoField)]
+    row = '(%s)' % ', '.join(['%s'] * len(fields))
+    sql = 'INSERT INTO %s (%s) VALUES ' % (qn(opts.db_table),
+        ', '.join([qn(f.column) for f in fields]))
+    chunk = max(1, max_query_params() // len(fields))
+    cursor = connection.cursor()
+    try:
+        for i in range(0, len(objects), chunk):
+            batch = objects[i:i + chunk]
+            values = [[f.get_db_prep_save(f.pre_save(obj, True))
+                for f in fields] for obj in batch]
+            params = list(itertools.chain(*values))
+            if settings.DATABASE_ENGINE in POSTGRESQL_ENGINES:
+                cursor.execute(sql + ', '.join([row] * len(batch)) +
+                    ' RETURNING %s' % qn(opts.pk.column), params)
+                pks = [r[0] for r in cursor.fetchall()]
+            elif consecutive_ids(cursor):
+                cursor.execute(sql + ', '.join([row] * len(batch)), params)
+                pk = connection.ops.last_insert_id(
+                    cursor, opts.db_table, opts.pk.column)
+                # MySQL gives the first id of the statement, others the last.
+                if settings.DATABASE_ENGINE != 'mysql':
+                    pk -= len(batch) - 1
+                pks = range(pk, pk + len(batch))
+            else:
+                pks = []
+                for v in values:
+                    cursor.execute(sql + row, v)
+                    pks.append(connection.ops.last_insert_id(
+                        cursor, opts.db_table, opts.pk.column))
+            for obj, pk in zip(batch, pks):
+                setattr(obj, opts.pk.attname, pk)
+        transaction.commit_unless_managed()
+    except:
+        transaction.rollback_unless_managed()
+        raise
+    return objects
+
+def bulk_update(objects, names):
+    """Saves the named fields of model objects of one class in bulk.
+    
+    Each field is set with a CASE on the primary key, so any number of
+    objects takes a single UPDATE (or one per max_query_params()).
+    
+    """
+    if not objects:
+        return
+    opts = type(objects[0])._meta
+    qn = connection.ops.quote_name
+    fields = [opts.get_field(name) for name in names]
+    pk = qn(opts.pk.column)
+    postgres = settings.DATABASE_ENGINE in POSTGRESQL_ENGINES
+    chunk = max(1, max_query_params() // (2 * len(fields) + 1))
+    cursor = connection.cursor()
+    try:
+        for i in range(0, len(objects), chunk):
+            batch = objects[i:i + chunk]
+            sets = []
+            params = []
+            for f in fields:
+                value = '%s'
+                if postgres:
+                    # Otherwise PostgreSQL types every THEN as text.
+                    value = 'CAST(%%s AS %s)' % \
+                        f.db_type().split(' CHECK')[0]
+                sets.append('%s = CASE %s %s END' % (qn(f.column), pk,
+                    ' '.join(['WHEN %%s THEN %s' % value] * len(batch))))
+                for obj in batch:
+                    params.extend([obj.pk,
+                        f.get_db_prep_save(getattr(obj, f.attname))])
+            params.extend([obj.pk for obj in batch])
+            cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+                qn(opts.db_table), ', '.join(sets), pk,
+                ', '.join(['%s'] * len(batch))), params)
+        transaction.commit_unless_managed()
+    except:
+        transaction.rollback_unless_managed()
+        raise
+
+class CounterField(PositiveIntegerField):
+    """A counter that is only ever changed with UPDATE queries.
+    
+    Saving an object leaves the column as it is in the database, so a
+    copy loaded before the counter was incremented can't put back its
+    old value.
+    
+    """
+    def pre_save(self, model_instance, add):
+        if add:
+            return PositiveIntegerField.pre_save(self, model_instance, add)
+        return F(self.attname)
+    
+
 class QuerySetManager(Manager):
     """
     
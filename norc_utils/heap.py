@@ -0,0 +1,137 @@
+"""A compact min-heap for very large numbers of timed entries."""
+
+from array import array
+
+class ArrayHeap(object):
+    """A min-heap of (time, kind, id) entries stored in flat arrays.
+    
+    time is a float timestamp, kind a small integer (0-255) and id an
+    integer.  Each entry costs 17 bytes, where a tuple of Python objects
+    in a list costs well over a hundred, so millions of entries fit
+    comfortably.  Entries are ordered by time alone.
+    
+    """
+    def __init__(self, entries=()):
+        self.times = array('d')
+        self.kinds = array('B')
+        self.ids = array('l')
+        self.push_many(entries)
+    
+    def __len__(self):
+        return len(self.times)
+    
+    def __iter__(self):
+        """Iterates over the entries in no particular order."""
+        for j in xrange(len(self.times)):
+            yield self.times[j], self.kinds[j], self.ids[j]
+    
+    @property
+    def nbytes(self):
+        """The memory used by the entries."""
+        return sum([a.itemsize * len(a)
+            for a in (self.times, self.kinds, self.ids)])
+    
+    def peek(self):
+        """The earliest entry, or None if the heap is empty."""
+        if not self.times:
+            return None
+        return self.times[0], self.kinds[0], self.ids[0]
+    
+    def push(self, time, kind, id):
+        self.times.append(time)
+        self.kinds.append(kind)
+        self.ids.append(id)
+        self._sift_up(len(self.times) - 1)
+    
+    def push_many(self, entries):
+        """Pushes an iterable of entries.
+        
+        When the new entries outnumber the old ones, they are appended
+        and the heap is rebuilt in linear time instead.
+        
+        """
+        entries = list(entries)
+        if len(entries) > len(self.times):
+            for time, kind, id in entries:
+                self.times.append(time)
+                self.kinds.append(kind)
+                self.ids.append(id)
+            self.heapify()
+        else:
+            for time, kind, id in entries:
+                self.push(time, kind, id)
+    
+    def pop(self):
+        """Removes and returns the earliest entry."""
+        times, kinds, ids = self.times, self.kinds, self.ids
+        if not times:
+            raise IndexError("pop from an empty heap")
+        entry = times[0], kinds[0], ids[0]
+        time, kind, id = times.pop(), kinds.pop(), ids.pop()
+        if times:
+            times[0], kinds[0], ids[0] = time, kind, id
+            self._sift_down(0)
+        return entry
+    
+    def pop_due(self, now, limit=None):
+        """Removes and returns all entries with a time up to now.
+        
+        At most limit entries are returned if it is given.
+        
+        """
+        due = []
+        while self.times and self.times[0] <= now:
+            if limit != None and len(due) >= limit:
+                break
+            due.append(self.pop())
+        return due
+    
+    def discard(self, keys):
+        """Removes every entry whose (kind, id) is in keys.
+        
+        This takes linear time, so it's meant for rare changes only.
+        
+        """
+        keep = [j for j in xrange(len(self.times))
+            if (self.kinds[j], self.ids[j]) not in keys]
+        if len(keep) == len(self.times):
+            return 0
+        removed = len(self.times) - len(keep)
+        self.times = array('d', [self.times[j] for j in keep])
+        self.kinds = array('B', [self.kinds[j] for j in keep])
+        self.ids = array('l', [self.ids[j] for j in keep])
+        self.heapify()
+        return removed
+    
+    def heapify(self):
+        for pos in reversed(xrange(len(self.times) // 2)):
+            self._sift_down(pos)
+    
+    def _sift_up(self, pos):
+        times, kinds, ids = self.times, self.kinds, self.ids
+        time, kind, id = times[pos], kinds[pos], ids[pos]
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if times[parent] <= time:
+                break
+            times[pos], kinds[pos], ids[pos] = \
+                times[parent], kinds[parent], ids[parent]
+            pos = parent
+        times[pos], kinds[pos], ids[pos] = time, kind, id
+    
+    def _sift_down(self, pos):
+        times, kinds, ids = self.times, self.kinds, self.ids
+        n = len(times)
+        time, kind, id = times[pos], kinds[pos], ids[pos]
+        child = 2 * pos + 1
+        while child < n:
+            if child + 1 < n and times[child + 1] < times[child]:
+                child += 1
+            if times[child] >= time:
+                break
+            times[pos], kinds[pos], ids[pos] = \
+                times[child], kinds[child], ids[child]
+            pos = child
+            child = 2 * pos + 1
+        times[pos], kinds[pos], ids[pos] = time, kind, id
+
@@ -3,15 +3,34 @@
 
 import os
 import sys
+import time
+import atexit
+import weakref
 import datetime
 import traceback
+from thread import get_ident
+from threading import Thread
 
-from norc.settings import (LOGGING_DEBUG, NORC_LOG_DIR)
+from norc.settings import (LOGGING_DEBUG, NORC_LOG_DIR,
+    LOG_BUFFER_SIZE, LOG_FLUSH_INTERVAL)
+
+# The last second timestamped, and its formatted string.
+_second = (None, None)
 
 def timestamp():
-    """Returns a string timestamp of the current time."""
+    """Returns a string timestamp of the current time.
+    
+    Only the microseconds change within a second, so the rest is only
+    formatted once a second.
+    
+    """
+    global _second
     now = datetime.datetime.utcnow()
-    return now.strftime('%Y/%m/%d %H:%M:%S') + '.%06d' % now.microsecond
+    second = now.replace(microsecond=0)
+    cached = _second
+    if cached[0] != second:
+        cached = _second = (second, second.strftime('%Y/%m/%d %H:%M:%S'))
+    return cached[1] + '.%06d' % now.microsecond
 
 class LogHook(object):
     """A pseudo file class meant to be set as stdout to intercept writes."""
@@ -27,7 +46,7 @@ class LogHook(object):
             self.write(s)
     
     def flush(self):
-        pass
+        self.log.flush()
     
     def fileno(self):
         return self.log.file.fileno()
@@ -68,14 +87,22 @@ class AbstractLog(object):
     
 
 class Log(AbstractLog):
-    """Implementation of Log that sends logs to a file."""
+    """Implementation of Log that sends logs to a file.
     
-    def __init__(self, log_file, debug=None, echo=False):
+    Messages are buffered in memory and written out once buffer_size
+    bytes are waiting, when LOG_FLUSH_INTERVAL seconds have passed since
+    the last write, on any error, and when the log is flushed or closed.
+    A buffer_size of 0 writes every message as it's logged, so nothing
+    is lost if the process is killed.
+    
+    """
+    def __init__(self, log_file, debug=None, echo=False, buffer_size=None):
         """ Parameters:
         
-        path    Path to the file that all output should go in.
-        debug   Boolean; whether debug output should be logged.
-        echo    Echoes all logging to stdout if True.
+        path        Path to the file that all output should go in.
+        debug       Boolean; whether debug output should be logged.
+        echo        Echoes all logging to stdout if True.
+        buffer_size Bytes to buffer; defaults to LOG_BUFFER_SIZE.
         
         """
         AbstractLog.__init__(self, debug)
@@ -85,15 +112,97 @@ class Log(AbstractLog):
             log_file = open(log_file, 'a')
         self.file = log_file
         self.echo = echo
+        self.buffer_size = buffer_size if buffer_size != None \
+            else LOG_BUFFER_SIZE
+        # Copies of fds 1 and 2 while they're pointed at the log.
+        self.saved_fds = None
+        self.reset()
+    
+    def reset(self):
+        """Empties the buffer, as in a child forked from its owner.
+        
+        The parent still has whatever was buffered and will write it, so
+        the child must not.  See fork().
+        
+        """
+        # Holds the id of the thread writing, if any; see acquire().
+        self.holder = {}
+        self.buffer = []
+        self.buffered = 0
+        self.flushed = time.time()
+        if self.buffer_size:
+            Flusher.watch(self)
     
     def write(self, msg, format_prefix):
         if format_prefix:
             msg = Log.format(msg, format_prefix)
-        self.file.write(msg)
-        self.file.flush()
-        if self.echo:
+        if not self.buffer_size:
+            # While output is captured, messages share stdout's buffer
+            # so they stay in order with what the task prints.
+            (sys.__stdout__ if self.saved_fds else self.file).write(msg)
+            self._flush()
+        else:
+            locked = self.acquire()
+            try:
+                if self.saved_fds:
+                    sys.__stdout__.write(msg)
+                else:
+                    self.buffer.append(msg)
+                    self.buffered += len(msg)
+                if self.buffered >= self.buffer_size or \
+                        time.time() - self.flushed >= LOG_FLUSH_INTERVAL:
+                    self._flush()
+            finally:
+                if locked:
+                    self.release()
+        if self.echo and not self.saved_fds:
             print >>sys.__stdout__, msg,
     
+    def flush(self):
+        """Writes out any buffered messages."""
+        if not self.buffer_size:
+            return self._flush()
+        locked = self.acquire()
+        try:
+            self._flush()
+        finally:
+            if locked:
+                self.release()
+    
+    def acquire(self):
+        """Takes a buffered log, returning False if this thread has it.
+        
+        Signal handlers log (see AbstractInstance), and one that
+        interrupted a write in progress would wait for a Lock forever, so
+        neither the task's timeout nor a kill would ever finish.  Instead
+        the log is taken by setting the holder with setdefault(), which is
+        atomic, so a handler can always tell whether it interrupted its
+        own thread, and then goes ahead without waiting.
+        
+        """
+        me = get_ident()
+        if self.holder.get('id') == me:
+            return False
+        while self.holder.setdefault('id', me) != me:
+            time.sleep(0.0001)
+        return True
+    
+    def release(self):
+        del self.holder['id']
+    
+    def _flush(self):
+        if self.buffer:
+            # Taken before writing, so a handler that flushes in the
+            # middle of this can't write the same messages again.
+            buffer, self.buffer, self.buffered = self.buffer, [], 0
+            self.file.write(''.join(buffer))
+        if self.saved_fds:
+            sys.__stdout__.flush()
+            sys.__stderr__.flush()
+        self.file.flush()
+        if self.buffer_size:
+            self.flushed = time.time()
+    
     def info(self, msg, format=True):
         self.write(msg, Log.INFO if format else False)
     
@@ -101,6 +210,7 @@ class Log(AbstractLog):
         self.write(msg, Log.ERROR if format else False)
         if trace:
             self.write(traceback.format_exc(), False)
+        self.flush()
     
     def debug(self, msg, format=True):
         if self.debug_on:
@@ -110,18 +220,107 @@ class Log(AbstractLog):
         """Redirect all stdout and stderr to this log's files."""
         sys.stdout = sys.stderr = LogHook(self)
     
+    def start_capture(self):
+        """Point this process's stdout and stderr at this log's file.
+        
+        Unlike start_redirect(), this works at the file descriptor level,
+        so output from subprocesses and C extensions goes straight to
+        disk, and prints skip the LogHook.  Only Norc's own messages are
+        formatted.  stop_redirect() undoes it.
+        
+        """
+        self.flush()
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.saved_fds = os.dup(1), os.dup(2)
+        os.dup2(self.file.fileno(), 1)
+        os.dup2(self.file.fileno(), 2)
+    
     def stop_redirect(self):
         """Restore stdout and stderr to their original values."""
         sys.stdout = sys.__stdout__
         sys.stderr = sys.__stderr__
+        if self.saved_fds:
+            self.flush()
+            os.dup2(self.saved_fds[0], 1)
+            os.dup2(self.saved_fds[1], 2)
+            os.close(self.saved_fds[0])
+            os.close(self.saved_fds[1])
+            self.saved_fds = None
     
     def close(self):
+        self.flush()
         self.file.close()
     
 
+class Flusher(Thread):
+    """Flushes this process's buffered logs every LOG_FLUSH_INTERVAL.
+    
+    A write flushes its log once the interval has passed anyway, so this
+    only matters for messages followed by a quiet spell, which are often
+    the ones that say why a task is stuck.
+    
+    """
+    # The flusher of this process, if one has started.
+    current = None
+    
+    @staticmethod
+    def watch(log):
+        flusher = Flusher.current
+        if flusher == None or flusher.pid != os.getpid():
+            flusher = Flusher.current = Flusher()
+            flusher.start()
+        flusher.logs[id(log)] = log
+    
+    def __init__(self):
+        Thread.__init__(self)
+        self.daemon = True
+        self.pid = os.getpid()
+        # By id, since WeakSet is new in 2.7.
+        self.logs = weakref.WeakValueDictionary()
+    
+    def run(self, sleep=time.sleep):
+        try:
+            while True:
+                sleep(LOG_FLUSH_INTERVAL)
+                self.flush_all()
+        except Exception:
+            # Most likely the interpreter shutting down.
+            pass
+    
+    def flush_all(self):
+        for log in self.logs.values():
+            if not log.file.closed:
+                log.flush()
+    
+
+def fork():
+    """os.fork(), after which the child empties its buffered logs.
+    
+    Checking for a fork on every write would cost a getpid() per message,
+    so processes that fork and go on logging should fork with this.
+    
+    """
+    pid = os.fork()
+    if pid == 0:
+        flusher, Flusher.current = Flusher.current, None
+        if flusher != None:
+            for log in flusher.logs.values():
+                log.reset()
+    return pid
+
+def _flush_at_exit():
+    if Flusher.current != None and Flusher.current.pid == os.getpid():
+        Flusher.current.flush_all()
+
+atexit.register(_flush_at_exit)
+
+
 def make_log(norc_path, *args, **kwargs):
     """Make a log object with a subpath of the norc log directory."""
     return Log(os.path.join(NORC_LOG_DIR, norc_path), *args, **kwargs)
     # log_class = BACKUP_LOGS.get(BACKUP_SYSTEM, NorcLog)
     # return log_class(norc_path, *args, **kwargs)
-    
+
@@ -0,0 +1,257 @@
+"""Wakeup notifications for Norc daemons.
+
+Daemons normally find out about new work and requests by polling the
+database.  A notification system lets whoever changes that state wake
+the interested daemons right away, so polling is only needed as a slow
+fallback.  Notifications carry no data; they only tell the listener
+that it's worth looking again, so a lost notification costs latency
+but never correctness.
+
+Which system is used is set by NOTIFY_SYSTEM; see NOTIFY_SYSTEMS below.
+
+"""
+
+import os
+import re
+import glob
+import errno
+import socket
+import select
+from threading import Thread, Event
+
+from norc import settings
+from norc.norc_utils.log import make_log
+
+def channel(obj):
+    """The name of the notification channel for a model object."""
+    return '%s_%s' % (type(obj).__name__.lower(), obj.pk)
+
+class Listener(Thread):
+    """Abstract thread which calls back whenever a channel is notified."""
+    
+    # How often the listener checks whether it has been stopped.
+    POLL_TIMEOUT = 1
+    
+    def __init__(self, channels, callback, log):
+        Thread.__init__(self)
+        self.daemon = True
+        self.channels = channels
+        self.callback = callback
+        self.log = log
+        self.stopped = Event()
+    
+    def run(self):
+        try:
+            try:
+                while not self.stopped.isSet():
+                    try:
+                        notified = self.receive(self.POLL_TIMEOUT)
+                    except select.error, e:
+                        # A signal arrived while waiting.
+                        if e.args[0] != errno.EINTR:
+                            raise
+                        continue
+                    for c in notified:
+                        self.callback(c)
+            except Exception:
+                self.log.error("Notification listener failed.", trace=True)
+        finally:
+            self.close()
+    
+    def receive(self, timeout):
+        """Waits up to timeout seconds; returns channels notified."""
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+    
+    def stop(self):
+        self.stopped.set()
+    
+
+class UnixSocketNotifier(object):
+    """Notifies daemons on the same host through UNIX datagram sockets.
+    
+    Each listener binds one socket per channel in a directory named for
+    the channel, and a notification is a one byte datagram sent to every
+    socket found there.  Sockets of listeners that died without cleaning
+    up are removed by the next notification.
+    
+    """
+    @staticmethod
+    def directory(chan):
+        return os.path.join(settings.NORC_TMP_DIR, 'notify',
+            re.sub(r'[^\w.-]', '_', chan))
+    
+    def notify(self, chan):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            for path in glob.glob(os.path.join(
+                    UnixSocketNotifier.directory(chan), '*.sock')):
+                try:
+                    sock.sendto('!', path)
+                except socket.error, e:
+                    if e.args[0] in (errno.ECONNREFUSED, errno.ENOENT):
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    # EAGAIN means the listener already has a wakeup
+                    # waiting, which is as good as another one.
+        finally:
+            sock.close()
+    
+    def listen(self, channels, callback, log):
+        listener = UnixSocketListener(channels, callback, log)
+        listener.start()
+        return listener
+    
+
+class UnixSocketListener(Listener):
+    
+    def __init__(self, channels, callback, log):
+        Listener.__init__(self, channels, callback, log)
+        self.sockets = {}
+        for chan in channels:
+            d = UnixSocketNotifier.directory(chan)
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # Somebody else made it first.
+                    pass
+            path = os.path.join(d, '%s-%s.sock' % (os.getpid(), id(self)))
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            self.sockets[sock] = (chan, path)
+    
+    def receive(self, timeout):
+        ready = select.select(self.sockets.keys(), [], [], timeout)[0]
+        notified = []
+        for sock in ready:
+            # Drain everything so a burst of pushes causes a single wakeup.
+            sock.setblocking(False)
+            try:
+                while sock.recv(64):
+                    pass
+            except socket.error:
+                pass
+            notified.append(self.sockets[sock][0])
+        return notified
+    
+    def close(self):
+        for sock, (chan, path) in self.sockets.items():
+            sock.close()
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+
+class PostgresNotifier(object):
+    """Notifies daemons on any host through PostgreSQL LISTEN/NOTIFY."""
+    
+    @staticmethod
+    def quote(chan):
+        return '"%s"' % chan.replace('"', '')
+    
+    def notify(self, chan):
+        from django.db import connection, transaction
+        connection.cursor().execute('NOTIFY %s' % PostgresNotifier.quote(chan))
+        transaction.commit_unless_managed()
+    
+    def listen(self, channels, callback, log):
+        listener = PostgresListener(channels, callback, log)
+        listener.start()
+        return listener
+    
+
+class PostgresListener(Listener):
+    
+    def __init__(self, channels, callback, log):
+        import psycopg2
+        import psycopg2.extensions
+        Listener.__init__(self, channels, callback, log)
+        params = dict(database=settings.DATABASE_NAME,
+            user=settings.DATABASE_USER)
+        for k in ['PASSWORD', 'HOST', 'PORT']:
+            v = getattr(settings, 'DATABASE_' + k, None)
+            if v:
+                params[k.lower()] = v
+        self.connection = psycopg2.connect(**params)
+        self.connection.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = self.connection.cursor()
+        for chan in channels:
+            cursor.execute('LISTEN %s' % PostgresNotifier.quote(chan))
+    
+    def receive(self, timeout):
+        if select.select([self.connection], [], [], timeout)[0]:
+            self.connection.poll()
+            notified = set()
+            while self.connection.notifies:
+                notified.add(self.connection.notifies.pop().channel)
+            return list(notified)
+        return []
+    
+    def close(self):
+        self.connection.close()
+    
+
+NOTIFY_SYSTEMS = {
+    'UnixSocket': UnixSocketNotifier,
+    'PostgreSQL': PostgresNotifier,
+}
+
+_notifier = None
+
+def get_notifier():
+    """The configured notifier, or None if notifications are disabled."""
+    global _notifier
+    if settings.NOTIFY_SYSTEM and not _notifier:
+        _notifier = NOTIFY_SYSTEMS[settings.NOTIFY_SYSTEM]()
+    return _notifier
+
+_log = None
+
+def get_log():
+    """The log failures are reported to when no other is given."""
+    global _log
+    if not _log:
+        _log = make_log('notify')
+    return _log
+
+def notify(chan, log=None):
+    """Wakes anything listening on the given channel.
+    
+    Failures are logged but never raised, since the state change that
+    prompted the notification has already been made and pollers will
+    still find it.
+    
+    """
+    notifier = get_notifier()
+    if notifier:
+        try:
+            notifier.notify(chan)
+        except Exception:
+            (log or get_log()).error("Failed to notify %s." % chan,
+                trace=True)
+
+def listen(channels, callback, log=None):
+    """Calls callback(channel) from a thread on every notification.
+    
+    Returns the listener thread, which has a stop() method, or None if
+    notifications are disabled or the listener couldn't be started.
+    Failures are reported to log.
+    
+    """
+    notifier = get_notifier()
+    if notifier:
+        log = log or get_log()
+        try:
+            return notifier.listen(channels, callback, log)
+        except Exception:
+            log.error("Failed to listen on %s." % ', '.join(channels),
+                trace=True)
+    return None
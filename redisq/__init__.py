@@ -0,0 +1 @@
+"""A Norc queue backed by Redis; see models.py and README."""
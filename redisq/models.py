@@ -0,0 +1,194 @@
+import os
+import copy
+import time
+import struct
+
+import redis
+from django.db.models.signals import post_delete
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import Queue
+from norc.core.constants import DBQUEUE_LEASE
+from norc.norc_utils import notify
+from norc.norc_utils.django_extras import bulk_generic_objects
+from norc.settings import REDIS_HOST, REDIS_PORT, REDIS_DB, REDIS_WAIT_TIME
+
+# Entries are 8 random bytes, so that an item pushed twice is two
+# entries, followed by the item's (content type pk, object pk).
+ENTRY = struct.Struct('!8sIQ')
+
+# Leases up to ARGV[1] entries until ARGV[2], taking those handed over
+# by blocking pops first.  KEYS are the queue's keys().
+POP = """
+local entries = {}
+while #entries < tonumber(ARGV[1]) do
+    local entry = redis.call('RPOP', KEYS[2]) or redis.call('RPOP', KEYS[1])
+    if not entry then
+        break
+    end
+    redis.call('ZADD', KEYS[3], ARGV[2], entry)
+    entries[#entries + 1] = entry
+end
+return entries
+"""
+
+# Extends the leases of the entries in ARGV[3:] to ARGV[2], then puts
+# those that ran out before ARGV[1] back at the front of the queue.
+RENEW = """
+for i = 3, #ARGV do
+    redis.call('ZADD', KEYS[3], 'XX', ARGV[2], ARGV[i])
+end
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', ARGV[1])
+for _, entry in ipairs(expired) do
+    redis.call('ZREM', KEYS[3], entry)
+    redis.call('RPUSH', KEYS[1], entry)
+end
+return #expired
+"""
+
+_CLIENT = {}
+
+def client():
+    """This process's Redis client and scripts.
+    
+    redis-py clients keep their own pool of connections and can be
+    shared between threads, but not with a forked child.
+    
+    """
+    if _CLIENT.get('pid') != os.getpid():
+        c = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+        _CLIENT.update(pid=os.getpid(), redis=c,
+            pop=c.register_script(POP), renew=c.register_script(RENEW))
+    return _CLIENT
+
+class RedisQueue(Queue):
+    """A queue kept in Redis, or any server that speaks its protocol.
+    
+    Items wait in the list norc:queue:<name> and are popped in the order
+    they were pushed; Redis has no priorities.  Like DBQueue, popping
+    only leases items, here by moving them to a sorted set scored by
+    when their leases run out.  Unless acked or renewed by then, they go
+    back to the front of the queue, so items are delivered at least once
+    even if an Executor dies with them.
+    
+    """
+    class Meta:
+        app_label = 'redisq'
+        db_table = 'norc_redisqueue'
+    
+    @property
+    def key(self):
+        return 'norc:queue:%s' % self.name
+    
+    def keys(self):
+        """The waiting list, the hand-over list and the lease set."""
+        return [self.key, self.key + ':claimed', self.key + ':leased']
+    
+    def peek(self):
+        entry = client()['redis'].lindex(self.key, -1)
+        if entry != None:
+            return bulk_generic_objects([ENTRY.unpack(entry)[1:]])[0]
+    
+    def pop(self, timeout=None):
+        items = self.pop_many(1, timeout)
+        return items[0] if items else None
+    
+    def pop_many(self, n, timeout=None):
+        """Leases up to n items with a single script call.
+        
+        If the queue is empty, waits up to timeout seconds for a push, by
+        default REDIS_WAIT_TIME.  The blocking pop moves the entry it gets
+        to the hand-over list, from which the next pop leases it, so that
+        an entry is never lost between the two steps.
+        
+        """
+        if n < 1:
+            return []
+        c = client()
+        entries = c['pop'](keys=self.keys(), args=[n, lease_expiry()])
+        wait = REDIS_WAIT_TIME if timeout == None else timeout
+        # A wait of 0 would make Redis block forever.
+        if not entries and wait:
+            if c['redis'].brpoplpush(self.key, self.keys()[1],
+                    wait) != None:
+                entries = c['pop'](keys=self.keys(),
+                    args=[n, lease_expiry()])
+        return self.resolve(entries)
+    
+    def resolve(self, entries):
+        """Loads the items of leased entries, dropping missing ones.
+        
+        Each item is given the (key, entry) of its lease as redis_lease,
+        for acking.
+        
+        """
+        objects = bulk_generic_objects(
+            [ENTRY.unpack(e)[1:] for e in entries])
+        items = []
+        missing = []
+        for entry, obj in zip(entries, objects):
+            if obj == None:
+                missing.append(entry)
+                continue
+            if getattr(obj, 'redis_lease', None):
+                # The item was pushed more than once.
+                obj = copy.copy(obj)
+            obj.redis_lease = (self.key, entry)
+            items.append(obj)
+        if missing:
+            client()['redis'].zrem(self.keys()[2], *missing)
+        return items
+    
+    def push(self, item, priority=None):
+        """Adds an item to the queue.  Redis has no priorities."""
+        self.push_many([item])
+    
+    def push_many(self, items, priority=None):
+        """Adds the items to the queue atomically, with one LPUSH."""
+        entries = []
+        for item in items:
+            Queue.validate(item)
+            content_type = ContentType.objects.get_for_model(item)
+            entries.append(
+                ENTRY.pack(os.urandom(8), content_type.pk, item.pk))
+        if entries:
+            client()['redis'].lpush(self.key, *entries)
+            notify.notify(notify.channel(self))
+    
+    def leases(self, items):
+        """The entries of this queue's leases on items."""
+        return [i.redis_lease[1] for i in items
+            if getattr(i, 'redis_lease', (None,))[0] == self.key]
+    
+    def ack(self, items):
+        """Removes popped items for good."""
+        entries = self.leases(items)
+        if entries:
+            client()['redis'].zrem(self.keys()[2], *entries)
+        for i in items:
+            if getattr(i, 'redis_lease', (None,))[0] == self.key:
+                i.redis_lease = None
+    
+    def renew(self, items):
+        """Extends the leases of popped items and releases expired ones.
+        
+        Executors renew every heartbeat, which is what returns items
+        whose Executor was lost to the queue.
+        
+        """
+        return client()['renew'](keys=self.keys(),
+            args=[time.time(), lease_expiry()] + self.leases(items))
+    
+    def count(self):
+        return client()['redis'].llen(self.key)
+    
+
+def lease_expiry():
+    """When a lease taken now runs out; leases last as long as DBQueue's."""
+    return time.time() + DBQUEUE_LEASE
+
+def _delete_keys(sender, instance, **kwargs):
+    """Deletes the items of a deleted queue, like DBQueue's cascade."""
+    client()['redis'].delete(*instance.keys())
+
+post_delete.connect(_delete_keys, sender=RedisQueue)
@@ -0,0 +1,96 @@
+"""Unit tests for the norc.redisq module."""
+
+import time
+from threading import Thread
+
+from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+
+from norc.core.models import Instance
+from norc.redisq.models import RedisQueue, client
+from norc.norc_utils.testing import make_instance
+
+class RedisQueueTest(TestCase):
+    """Tests pushing and popping with a RedisQueue."""
+    
+    def setUp(self):
+        self.queue = RedisQueue.objects.create(name='test')
+        client()['redis'].delete(*self.queue.keys())
+        self.item = make_instance()
+    
+    def new_instances(self, n):
+        return [Instance.objects.create(task=self.item.task)
+            for _ in range(n)]
+    
+    def test_push_peek_pop(self):
+        self.queue.push(self.item)
+        self.assertEqual(self.queue.count(), 1)
+        self.assertEqual(self.queue.peek(), self.item)
+        self.assertEqual(self.queue.pop(), self.item)
+        self.assertEqual(self.queue.count(), 0)
+    
+    def test_pop_many(self):
+        """Test that items come out in the order pushed, up to n."""
+        items = self.new_instances(5)
+        self.queue.push_many(items)
+        self.queue.push_many([])
+        self.assertEqual(self.queue.pop_many(0), [])
+        self.assertEqual(self.queue.pop_many(3), items[:3])
+        self.assertEqual(self.queue.pop_many(3), items[3:])
+    
+    def test_blocking_pop(self):
+        """Test that a waiting pop gets an item as soon as it's pushed."""
+        # Pushing from the thread mustn't need the test database.
+        ContentType.objects.get_for_model(self.item)
+        def push():
+            time.sleep(0.1)
+            self.queue.push(self.item)
+        t = Thread(target=push)
+        t.start()
+        self.assertEqual(self.queue.pop(), self.item)
+        t.join(5)
+    
+    def test_no_wait(self):
+        """Test that a pop with a timeout of 0 returns at once."""
+        start = time.time()
+        self.assertEqual(self.queue.pop_many(1, timeout=0), [])
+        self.assertTrue(time.time() - start < 0.5)
+    
+    def test_lease_expiry(self):
+        """Test that items not acked in time are delivered again."""
+        items = self.new_instances(2)
+        self.queue.push_many(items)
+        popped = self.queue.pop_many(2)
+        self.assertEqual(self.queue.renew([]), 0)
+        # Let the second lease run out while the first is renewed.
+        r = client()['redis']
+        r.zadd(self.queue.keys()[2], {popped[1].redis_lease[1]: 0})
+        self.assertEqual(self.queue.renew(popped[:1]), 1)
+        again = self.queue.pop()
+        self.assertEqual(again, items[1])
+        self.queue.ack(popped[:1] + [again])
+        self.assertEqual(r.zcard(self.queue.keys()[2]), 0)
+        self.assertEqual(self.queue.count(), 0)
+    
+    def test_duplicates(self):
+        """Test that an item pushed twice is delivered twice."""
+        self.queue.push_many([self.item, self.item])
+        popped = self.queue.pop_many(2)
+        self.assertEqual(popped, [self.item, self.item])
+        self.queue.ack(popped[:1])
+        self.assertEqual(client()['redis'].zcard(self.queue.keys()[2]), 1)
+    
+    def test_missing_item(self):
+        """Test that items whose object was deleted are dropped."""
+        other = self.new_instances(1)[0]
+        self.queue.push_many([other, self.item])
+        other.delete()
+        self.assertEqual(self.queue.pop_many(2), [self.item])
+    
+    def test_invalid(self):
+        self.assertRaises(AssertionError, lambda: self.queue.push(self.queue))
+    
+    def tearDown(self):
+        self.queue.delete()
+        self.assertFalse(client()['redis'].exists(self.queue.key))
+
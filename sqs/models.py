@@ -1,12 +1,91 @@
 
+import os
 import pickle
+import struct
+from threading import local
 
 from boto.sqs.connection import SQSConnection
 from boto.sqs.message import Message
+from django.db.models.signals import post_delete
 from django.contrib.contenttypes.models import ContentType
 
 from norc.core.models import Queue
-from norc.settings import AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY
+from norc.norc_utils import notify
+from norc.norc_utils.django_extras import bulk_generic_objects
+from norc.settings import (AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY,
+    SQS_WAIT_TIME)
+
+# Message bodies are a packed (content type pk, object pk) pair behind a
+# zero byte, which no pickle starts with.
+BODY = struct.Struct('!cIQ')
+MAGIC = '\x00'
+
+# The most messages SQS will send or receive in one request.
+SQS_BATCH = 10
+
+class SQSBatchError(Exception):
+    """Raised when some messages of a batch couldn't be sent."""
+    pass
+
+def encode(content_type_pk, pk):
+    return BODY.pack(MAGIC, content_type_pk, pk)
+
+def decode(body):
+    """The (content type pk, object pk) of a message body.
+    
+    Messages sent before bodies were packed are pickled tuples, told
+    apart by their first byte rather than their length, which can match.
+    
+    """
+    if len(body) == BODY.size and body[0] == MAGIC:
+        return BODY.unpack(body)[1:]
+    return pickle.loads(body)
+
+class SQSPool(object):
+    """Hands out SQS connections and queue handles, one set per thread.
+    
+    boto connections can't be shared between threads, or with a forked
+    child, so every thread of every process gets its own connection the
+    first time it needs one.  Queue handles are bound to the connection
+    they were looked up on, so they're cached by name alongside it.
+    
+    """
+    def __init__(self):
+        self.local = local()
+    
+    def state(self):
+        """This thread's connection and handles, reset after a fork."""
+        state = self.local
+        if getattr(state, 'pid', None) != os.getpid():
+            state.pid = os.getpid()
+            state.connection = None
+            state.queues = {}
+        return state
+    
+    def connection(self):
+        state = self.state()
+        if state.connection == None:
+            state.connection = SQSConnection(
+                AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
+        return state.connection
+    
+    def queue(self, name):
+        """The handle of the named queue, which is created if missing."""
+        state = self.state()
+        queue = state.queues.get(name)
+        if queue == None:
+            c = self.connection()
+            queue = c.lookup(name)
+            if not queue:
+                queue = c.create_queue(name, 1)
+            state.queues[name] = queue
+        return queue
+    
+    def forget(self, name):
+        self.state().queues.pop(name, None)
+    
+
+POOL = SQSPool()
 
 class SQSQueue(Queue):
     
@@ -14,13 +93,18 @@ class SQSQueue(Queue):
         app_label = 'sqs'
         db_table = 'norc_sqsqueue'
     
-    def __init__(self, *args, **kwargs):
-        Queue.__init__(self, *args, **kwargs)
-        c = SQSConnection(AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY)
-        self.queue = c.lookup(self.name)
-        if not self.queue:
-            self.queue = c.create_queue(self.name, 1)
-        self.connection = c
+    @property
+    def queue(self):
+        """The boto queue, looked up the first time it's used.
+        
+        Loading SQSQueues from the database makes no SQS requests.
+        
+        """
+        return POOL.queue(self.name)
+    
+    @property
+    def connection(self):
+        return POOL.connection()
     
     @staticmethod
     def get_item(content_type_pk, content_pk):
@@ -31,21 +115,90 @@ class SQSQueue(Queue):
     # def peek(self):
     #     message = self.queue.read(0)
     #     if message:
-    #         return SQSQueue.get_item(*pickle.loads(message.get_body()))
+    #         return SQSQueue.get_item(*decode(message.get_body()))
+    
+    def pop(self, timeout=None):
+        items = self.pop_many(1, timeout)
+        return items[0] if items else None
     
-    def pop(self):
-        message = self.queue.read()
-        if message:
-            self.queue.delete_message(message)
-            return SQSQueue.get_item(*pickle.loads(message.get_body()))
+    def pop_many(self, n, timeout=None):
+        """Receives up to 10 messages per request and deletes in batches.
+        
+        The first receive long polls for up to timeout seconds (by default
+        SQS_WAIT_TIME, and at most 20), so an empty queue costs one request
+        per wait instead of one per poll.  Once messages arrive, the rest
+        are taken without waiting.  Messages are only deleted once their
+        items have been loaded, so a failed lookup leaves them on the queue.
+        
+        Deletes that fail are retried once.  Messages that still can't be
+        deleted will be received again once their visibility timeout runs
+        out, which is the same as an Executor dying before deleting them.
+        
+        """
+        batches = []
+        received = 0
+        wait = SQS_WAIT_TIME if timeout == None else min(int(timeout), 20)
+        while received < n:
+            batch = self.queue.get_messages(
+                min(SQS_BATCH, n - received), wait_time_seconds=wait)
+            if not batch:
+                break
+            batches.append(batch)
+            received += len(batch)
+            wait = 0
+        objects = bulk_generic_objects([decode(m.get_body())
+            for b in batches for m in b])
+        for batch in batches:
+            failed = failures(self.queue.delete_message_batch(batch), batch,
+                lambda m: m.id)
+            if failed:
+                self.queue.delete_message_batch(failed)
+        return [o for o in objects if o != None]
     
-    def push(self, item):
-        Queue.validate(item)
-        content_type = ContentType.objects.get_for_model(item)
-        body = (content_type.pk, item.pk)
-        message = self.queue.new_message(pickle.dumps(body))
-        self.queue.write(message)
+    def push(self, item, priority=None):
+        """Adds an item to the queue.  SQS has no priorities."""
+        self.push_many([item])
+    
+    def push_many(self, items, priority=None):
+        """Sends the items in batches of 10, the most SQS allows.
+        
+        SQSBatchError is raised if any of them couldn't be sent; the rest
+        have been pushed.
+        
+        """
+        messages = []
+        for item in items:
+            Queue.validate(item)
+            content_type = ContentType.objects.get_for_model(item)
+            body = encode(content_type.pk, item.pk)
+            messages.append((str(len(messages)),
+                self.queue.new_message(body).get_body_encoded(), 0))
+        failed = []
+        for i in range(0, len(messages), SQS_BATCH):
+            batch = messages[i:i + SQS_BATCH]
+            failed.extend(failures(self.queue.write_batch(batch), batch,
+                lambda m: m[0]))
+        if len(failed) < len(messages):
+            notify.notify(notify.channel(self))
+        if failed:
+            raise SQSBatchError("Failed to send %s of %s items to %s." %
+                (len(failed), len(messages), self.name))
     
     def count(self):
         return self.queue.count()
     
+
+def failures(results, entries, entry_id):
+    """The entries of a batch request that SQS reported as failed.
+    
+    Batch requests don't raise when only some of their entries fail.
+    
+    """
+    failed = set([e['id'] for e in results.errors])
+    return [e for e in entries if entry_id(e) in failed]
+
+def _forget_queue(sender, instance, **kwargs):
+    """Drops the cached handle of a deleted queue."""
+    POOL.forget(instance.name)
+
+post_delete.connect(_forget_queue, sender=SQSQueue)
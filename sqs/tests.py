@@ -1,9 +1,17 @@
 
 """Unit tests for the norc.sqs module."""
 
+import base64
+import pickle
+import itertools
+
 from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
 
-from norc.sqs.models import SQSQueue
+from norc.core.models import Instance
+from norc.sqs.models import (SQSQueue, SQSBatchError, POOL,
+    encode, decode)
+from norc.settings import SQS_WAIT_TIME
 from norc.norc_utils import wait_until
 from norc.norc_utils.testing import make_instance
 
@@ -25,9 +33,162 @@ class SQSQueueTest(TestCase):
         wait_until(get_item)
         self.assertEqual(self.item, self.i)
     
+    def test_pop_many(self):
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(3)]
+        for i in items:
+            self.queue.push(i)
+        popped = []
+        def get_items():
+            popped.extend(self.queue.pop_many(3 - len(popped)))
+            return len(popped) == 3
+        wait_until(get_items)
+        self.assertEqual(set(items), set(popped))
+    
+    def test_handle_cached(self):
+        """Test that loading a queue reuses this thread's handle."""
+        loaded = SQSQueue.objects.get(pk=self.queue.pk)
+        self.assertTrue(loaded.queue is self.queue.queue)
+        self.assertTrue(loaded.connection is self.queue.connection)
+    
     def test_invalid(self):
         self.assertRaises(AssertionError, lambda: self.queue.push(self.queue))
     
     def tearDown(self):
         pass
     
+
+class FakeMessage(object):
+    
+    ids = itertools.count()
+    
+    def __init__(self, body):
+        self.id = str(FakeMessage.ids.next())
+        self.body = body
+    
+    def get_body(self):
+        return self.body
+    
+    def get_body_encoded(self):
+        return base64.b64encode(self.body)
+    
+
+class FakeResults(object):
+    
+    def __init__(self, failed):
+        self.errors = [{'id': i, 'code': 'InternalError'} for i in failed]
+    
+
+class FakeSQS(object):
+    """A local stand-in for a boto SQS queue that records its requests.
+    
+    Entries whose ids are in fail fail once, as in a partly failed batch.
+    
+    """
+    def __init__(self):
+        self.messages = []
+        self.requests = []
+        self.fail = set()
+    
+    def failed(self, ids):
+        failed = [i for i in ids if i in self.fail]
+        self.fail.difference_update(failed)
+        return FakeResults(failed)
+    
+    def new_message(self, body):
+        return FakeMessage(body)
+    
+    def write_batch(self, entries):
+        assert len(entries) <= 10
+        self.requests.append(('send', len(entries)))
+        results = self.failed([e[0] for e in entries])
+        failed = [r['id'] for r in results.errors]
+        self.messages.extend([FakeMessage(base64.b64decode(e[1]))
+            for e in entries if not e[0] in failed])
+        return results
+    
+    def get_messages(self, n, wait_time_seconds=None):
+        assert n <= 10
+        self.requests.append(('receive', wait_time_seconds))
+        batch, self.messages = self.messages[:n], self.messages[n:]
+        return batch
+    
+    def delete_message_batch(self, messages):
+        self.requests.append(('delete', len(messages)))
+        return self.failed([m.id for m in messages])
+    
+
+class SQSFakeTest(TestCase):
+    """Tests SQSQueue's requests against a fake SQS queue."""
+    
+    def setUp(self):
+        self.queue = SQSQueue(name='fake')
+        self.sqs = POOL.state().queues['fake'] = FakeSQS()
+        self.item = make_instance()
+    
+    def test_encoding(self):
+        body = encode(12, 345678)
+        self.assertEqual(len(body), 13)
+        self.assertEqual(decode(body), (12, 345678))
+        # Messages sent before bodies were packed still decode, even
+        # pickles as long as a packed body.
+        self.assertEqual(decode(pickle.dumps((12, 345678))), (12, 345678))
+        old = pickle.dumps((1, 1))
+        self.assertEqual(len(old), 12)
+        self.assertEqual(decode(old), (1, 1))
+        self.assertEqual(decode(encode(1, 1)), (1, 1))
+    
+    def test_batches(self):
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(25)]
+        self.queue.push_many(items)
+        self.assertEqual(self.sqs.requests,
+            [('send', 10), ('send', 10), ('send', 5)])
+        ct = ContentType.objects.get_for_model(Instance)
+        self.assertEqual(decode(self.sqs.messages[0].get_body()),
+            (ct.pk, items[0].pk))
+        self.sqs.requests = []
+        self.assertEqual(self.queue.pop_many(30), items)
+        # Only the first receive waits; an empty one ends the pop, and
+        # nothing is deleted until the items have been loaded.
+        self.assertEqual(self.sqs.requests, [('receive', SQS_WAIT_TIME),
+            ('receive', 0), ('receive', 0), ('receive', 0),
+            ('delete', 10), ('delete', 10), ('delete', 5)])
+    
+    def test_send_failure(self):
+        items = [Instance.objects.create(task=self.item.task)
+            for _ in range(5)]
+        self.sqs.fail = set(['3'])
+        self.assertRaises(SQSBatchError, self.queue.push_many, items)
+        self.assertEqual(self.queue.pop_many(5),
+            items[:3] + items[4:])
+    
+    def test_delete_failure(self):
+        """Test that deletes SQS reports as failed are retried."""
+        self.queue.push_many([self.item, make_instance()])
+        self.sqs.fail = set([self.sqs.messages[0].id])
+        self.sqs.requests = []
+        self.assertEqual(len(self.queue.pop_many(2)), 2)
+        self.assertEqual(self.sqs.requests, [('receive', SQS_WAIT_TIME),
+            ('receive', 0), ('delete', 2), ('delete', 1)])
+    
+    def test_failed_lookup(self):
+        ct = ContentType.objects.get_for_model(Instance)
+        self.sqs.messages = [FakeMessage(encode(ct.pk + 1000, 1))]
+        self.assertRaises(Exception, self.queue.pop_many, 5)
+        self.assertEqual(self.sqs.requests,
+            [('receive', SQS_WAIT_TIME), ('receive', 0)])
+    
+    def test_no_wait(self):
+        self.assertEqual(self.queue.pop_many(5, timeout=0), [])
+        self.assertEqual(self.queue.pop_many(5, timeout=60), [])
+        self.assertEqual(self.sqs.requests, [('receive', 0), ('receive', 20)])
+    
+    def test_pop(self):
+        self.queue.push(self.item)
+        self.assertEqual(self.queue.pop(), self.item)
+        self.assertEqual(self.queue.pop(timeout=0), None)
+    
+    def tearDown(self):
+        POOL.forget('fake')
+
@@ -37,6 +37,7 @@ function formatDate(date) {
 
 var DETAIL_KEYS = {
     executors: 'instances',
+    queues: 'queue_items',
     tasks: 'instances',
 };
 